@@ -0,0 +1,321 @@
+"""
+Offline stand-in for Discord gateway and REST API so the real Bot and cogs can be driven locally.
+
+Nothing of discord.py is mocked away, only the transport:
+    - REST: HTTPClient.request of the bot is replaced, every HTTPClient method still builds it's Route
+      and the fake answers with payloads shaped like the API ones, after injected latency and
+      occasional 429 responses (retried after retry_after, same as discord.py does)
+    - gateway: payloads are fed to the bot ConnectionState parsers (parse_message_create,
+      parse_guild_member_update..) so events go trough the same code path as real ones. Member chunk
+      requests are answered trough a fake websocket.
+
+Usage:
+    world = FakeDiscord(FakeDiscordSettings(guilds=50, members_per_guild=200))
+    world.attach(bot)
+    world.connect()  # creates guilds in bot cache, marks bot as ready
+"""
+import re
+import random
+import asyncio
+import logging
+from types import SimpleNamespace
+from collections import Counter, namedtuple
+from typing import Dict, List, Union
+
+import discord
+from discord.user import ClientUser
+
+from helpers import tracing
+
+
+logger = logging.getLogger(__name__)
+
+FakeDiscordSettings = namedtuple(
+    "FakeDiscordSettings",
+    "guilds members_per_guild licensed_roles_per_guild latency rate_limit_chance retry_after seed"
+)
+FakeDiscordSettings.__new__.__defaults__ = (3, 0.05, 0.01, 0.5, 0)
+
+_ADMINISTRATOR = "8"
+_TIMESTAMP = "2020-01-01T00:00:00.000000+00:00"
+
+
+class FakeGuild:
+    """Raw payloads of one fake guild, this is the 'server side' state."""
+
+    def __init__(self, guild_id: int, owner_id: int, channel_id: int, roles: List[dict], members: Dict[int, dict]):
+        self.id = guild_id
+        self.owner_id = owner_id
+        self.channel_id = channel_id
+        self.roles = roles
+        self.members = members
+
+    @property
+    def everyone_role_id(self) -> int:
+        return self.id
+
+    @property
+    def admin_role_id(self) -> int:
+        return int(self.roles[1]["id"])
+
+    @property
+    def licensed_role_ids(self) -> List[int]:
+        return [int(role["id"]) for role in self.roles[3:]]
+
+    def payload(self, bot_member: dict) -> dict:
+        return {
+            "id": str(self.id),
+            "name": f"guild-{self.id}",
+            "owner_id": str(self.owner_id),
+            "member_count": len(self.members) + 1,
+            "roles": self.roles,
+            # Like with GUILD_CREATE only a part of the members is sent, bot member is always there
+            "members": [bot_member],
+            "channels": [{
+                "id": str(self.channel_id), "type": 0, "name": "general", "position": 0,
+                "permission_overwrites": [], "guild_id": str(self.id)
+            }],
+            "features": [],
+            "premium_tier": 0,
+            "large": len(self.members) >= 250
+        }
+
+
+class FakeGatewaySocket:
+    """Stands in for DiscordWebSocket where cogs/discord.py send gateway requests."""
+
+    def __init__(self, world: "FakeDiscord"):
+        self.world = world
+        self.latency = world.settings.latency
+
+    async def request_chunks(self, guild_id, query=None, *, limit, user_ids=None, presences=False, nonce=None):
+        self.world.stats["gateway request_chunks"] += 1
+        self.world.loop.create_task(self._send_chunk(int(guild_id), user_ids or [], nonce))
+
+    async def _send_chunk(self, guild_id: int, user_ids: list, nonce: str):
+        await asyncio.sleep(self.world.latency())
+        guild = self.world.guilds[guild_id]
+        members = [guild.members[user_id] for user_id in user_ids if user_id in guild.members]
+        self.world.state.parse_guild_members_chunk({
+            "guild_id": str(guild_id),
+            "members": members,
+            "not_found": [str(user_id) for user_id in user_ids if user_id not in guild.members],
+            "chunk_index": 0,
+            "chunk_count": 1,
+            "nonce": nonce
+        })
+
+    async def change_presence(self, *, activity=None, status=None, afk=False, since=0.0):
+        pass
+
+
+class FakeDiscord:
+    """
+    Fake guilds, members, roles and channels plus the REST/gateway stand-ins serving them.
+    stats counts served requests per route, total requests, 429s and gateway requests.
+    """
+
+    def __init__(self, settings: FakeDiscordSettings):
+        self.settings = settings
+        self.random = random.Random(settings.seed)
+        self.stats = Counter()
+        self.bot = None
+        self.state = None
+        self.loop = None
+        self._next_snowflake = 700_000_000_000_000_000
+        self.bot_user = self._user_payload(self.snowflake(), "licensy", bot=True)
+        self.guilds: Dict[int, FakeGuild] = {}
+        self._channels: Dict[int, FakeGuild] = {}
+        for _ in range(settings.guilds):
+            guild = self._construct_guild()
+            self.guilds[guild.id] = guild
+            self._channels[guild.channel_id] = guild
+        self._routes = {
+            ("POST", "/channels/{channel_id}/messages"): self._create_message,
+            ("PATCH", "/channels/{channel_id}/messages/{message_id}"): self._create_message,
+            ("DELETE", "/channels/{channel_id}/messages/{message_id}"): self._no_content,
+            ("PUT", "/channels/{channel_id}/messages/{message_id}/reactions/{emoji}/@me"): self._no_content,
+            ("DELETE", "/channels/{channel_id}/messages/{message_id}/reactions/{emoji}/{member_id}"): self._no_content,
+            ("DELETE", "/channels/{channel_id}/messages/{message_id}/reactions"): self._no_content,
+            ("PUT", "/guilds/{guild_id}/members/{user_id}/roles/{role_id}"): self._add_role,
+            ("DELETE", "/guilds/{guild_id}/members/{user_id}/roles/{role_id}"): self._remove_role,
+            ("POST", "/users/@me/channels"): self._create_dm,
+            ("GET", "/users/{user_id}"): self._get_user,
+            ("GET", "/guilds/{guild_id}/members/{member_id}"): self._get_member,
+        }
+        self._route_patterns = {}
+
+    # WORLD ##############################################################################
+
+    def snowflake(self) -> int:
+        self._next_snowflake += self.random.randint(1, 1 << 22)
+        return self._next_snowflake
+
+    @staticmethod
+    def _user_payload(user_id: int, name: str, bot: bool = False) -> dict:
+        return {"id": str(user_id), "username": name, "discriminator": f"{user_id % 10000:04}", "avatar": None, "bot": bot}
+
+    @staticmethod
+    def _role_payload(role_id: int, name: str, position: int, permissions: str = "0") -> dict:
+        return {
+            "id": str(role_id), "name": name, "position": position, "color": 0, "hoist": False,
+            "managed": False, "mentionable": False, "permissions": permissions, "permissions_new": permissions
+        }
+
+    def _member_payload(self, user_id: int, role_ids: list) -> dict:
+        return {
+            "user": self._user_payload(user_id, f"member-{user_id}"),
+            "roles": [str(role_id) for role_id in role_ids],
+            "joined_at": _TIMESTAMP,
+            "nick": None, "deaf": False, "mute": False
+        }
+
+    def _construct_guild(self) -> FakeGuild:
+        guild_id = self.snowflake()
+        licensed_count = self.settings.licensed_roles_per_guild
+        # Position order: everyone 0, licensed roles 1.., admin, bot (top so it can manage all others)
+        roles = [
+            self._role_payload(guild_id, "@everyone", 0),
+            self._role_payload(self.snowflake(), "admin", licensed_count + 1, _ADMINISTRATOR),
+            self._role_payload(self.snowflake(), "licensy", licensed_count + 2, _ADMINISTRATOR)
+        ]
+        roles.extend(self._role_payload(self.snowflake(), f"licensed-{i}", i + 1) for i in range(licensed_count))
+        members = {}
+        for _ in range(self.settings.members_per_guild):
+            member_id = self.snowflake()
+            members[member_id] = self._member_payload(member_id, [])
+        owner_id = next(iter(members))
+        # First member is admin, used as author of admin commands
+        members[owner_id]["roles"].append(roles[1]["id"])
+        return FakeGuild(guild_id, owner_id, self.snowflake(), roles, members)
+
+    def _bot_member_payload(self, guild: FakeGuild) -> dict:
+        return {"user": self.bot_user, "roles": [guild.roles[2]["id"]], "joined_at": _TIMESTAMP, "deaf": False, "mute": False}
+
+    def attach(self, bot):
+        """Replaces REST transport and gateway socket of param bot."""
+        self.bot = bot
+        self.state = bot._connection
+        self.loop = bot.loop
+        # Wrapped the same way Bot wraps the real one, so traces include fake API calls
+        bot.http.request = tracing.traced_request(self.request)
+        socket = FakeGatewaySocket(self)
+        self.state._get_websocket = lambda guild_id=None, *, shard_id=None: socket
+
+    def connect(self):
+        """Does what READY and GUILD_CREATE would: caches bot user and guilds, then marks the bot as ready."""
+        self.state.user = ClientUser(state=self.state, data=self.bot_user)
+        for guild in self.guilds.values():
+            self.state._add_guild_from_data(guild.payload(self._bot_member_payload(guild)))
+        self.bot._ready.set()
+        self.bot.dispatch("ready")
+
+    def latency(self) -> float:
+        return self.settings.latency * self.random.uniform(0.5, 1.5)
+
+    # GATEWAY EVENTS #####################################################################
+
+    def send_message(self, guild_id: int, author_id: int, content: str) -> int:
+        """
+        Dispatches MESSAGE_CREATE as if param author wrote param content in guild channel.
+        :return: int message id, use it to match command_completion/command_error events
+        """
+        guild = self.guilds[guild_id]
+        member = guild.members[author_id]
+        message_id = self.snowflake()
+        self.state.parse_message_create({
+            "id": str(message_id), "channel_id": str(guild.channel_id), "guild_id": str(guild_id),
+            "author": member["user"],
+            "member": {key: value for key, value in member.items() if key != "user"},
+            "content": content, "timestamp": _TIMESTAMP, "edited_timestamp": None, "tts": False,
+            "mention_everyone": False, "mentions": [], "mention_roles": [], "attachments": [], "embeds": [],
+            "pinned": False, "type": 0
+        })
+        return message_id
+
+    def update_member_roles(self, guild_id: int, member_id: int, role_ids: list):
+        """Changes member roles server side and dispatches GUILD_MEMBER_UPDATE."""
+        member = self.guilds[guild_id].members[member_id]
+        member["roles"] = [str(role_id) for role_id in role_ids]
+        self.state.parse_guild_member_update({"guild_id": str(guild_id), **member})
+
+    # REST ###############################################################################
+
+    async def request(self, route, *, files=None, form=None, **kwargs):
+        """Replacement for HTTPClient.request"""
+        while True:
+            await asyncio.sleep(self.latency())
+            if self.random.random() < self.settings.rate_limit_chance:
+                # discord.py sleeps for retry_after and retries the same request
+                self.stats["429"] += 1
+                await asyncio.sleep(self.settings.retry_after)
+                continue
+            break
+
+        handler = self._routes.get((route.method, route.path))
+        self.stats["requests"] += 1
+        self.stats[f"{route.method} {route.path}"] += 1
+        if handler is None:
+            logger.warning(f"Fake Discord has no handler for {route.method} {route.path}")
+            return None
+        return handler(self._route_parameters(route), kwargs.get("json"))
+
+    def _route_parameters(self, route) -> Dict[str, str]:
+        pattern = self._route_patterns.get(route.path)
+        if pattern is None:
+            regex = re.sub(r"\\{(\w+)\\}", r"(?P<\1>[^/]+)", re.escape(route.path))
+            pattern = self._route_patterns[route.path] = re.compile(regex + "$")
+        return pattern.search(route.url).groupdict()
+
+    @staticmethod
+    def _not_found(message: str):
+        response = SimpleNamespace(status=404, reason="Not Found")
+        return discord.NotFound(response, {"code": 10000, "message": message})
+
+    def _create_message(self, parameters: dict, payload: Union[dict, None]) -> dict:
+        payload = payload or {}
+        return {
+            "id": parameters.get("message_id") or str(self.snowflake()), "channel_id": parameters["channel_id"],
+            "author": self.bot_user, "content": payload.get("content") or "", "timestamp": _TIMESTAMP,
+            "edited_timestamp": None, "tts": False, "mention_everyone": False, "mentions": [],
+            "mention_roles": [], "attachments": [], "embeds": [payload["embed"]] if payload.get("embed") else [],
+            "pinned": False, "type": 0
+        }
+
+    @staticmethod
+    def _no_content(_parameters: dict, _payload):
+        return None
+
+    def _change_role(self, parameters: dict, add: bool):
+        guild = self.guilds[int(parameters["guild_id"])]
+        member = guild.members.get(int(parameters["user_id"]))
+        if member is None:
+            raise self._not_found("Unknown Member")
+        roles = [role for role in member["roles"] if role != parameters["role_id"]]
+        if add:
+            roles.append(parameters["role_id"])
+        # Real gateway sends the update to the bot after the REST call
+        self.loop.call_soon(self.update_member_roles, guild.id, int(parameters["user_id"]), roles)
+
+    def _add_role(self, parameters: dict, _payload):
+        self._change_role(parameters, add=True)
+
+    def _remove_role(self, parameters: dict, _payload):
+        self._change_role(parameters, add=False)
+
+    def _create_dm(self, _parameters: dict, payload: dict) -> dict:
+        user_id = int(payload["recipient_id"])
+        return {
+            "id": str(self.snowflake()), "type": 1, "last_message_id": None,
+            "recipients": [self._user_payload(user_id, f"member-{user_id}")]
+        }
+
+    def _get_user(self, parameters: dict, _payload) -> dict:
+        user_id = int(parameters["user_id"])
+        return self._user_payload(user_id, f"member-{user_id}")
+
+    def _get_member(self, parameters: dict, _payload) -> dict:
+        member = self.guilds[int(parameters["guild_id"])].members.get(int(parameters["member_id"]))
+        if member is None:
+            raise self._not_found("Unknown Member")
+        return member
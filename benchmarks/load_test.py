@@ -0,0 +1,296 @@
+"""
+End to end load test of the real Bot and cogs against the offline Discord stand-in (benchmarks/fake_discord.py).
+
+Commands are sent as MESSAGE_CREATE events and role changes as GUILD_MEMBER_UPDATE events at a
+constant rate, each command is timed from the message event until command_completion/command_error.
+
+Usage (from repository root):
+    python3 -m benchmarks.load_test [--guilds 50] [--members-per-guild 200] [--rate 1000] [--duration 10]
+                                    [--latency 0.05] [--rate-limit-chance 0.01] [--mix redeem=4,generate=1,...]
+
+The database is created in a temporary directory, production databases are never touched.
+Note that generate has a 10s per guild cooldown so most of it's invocations end in CommandOnCooldown,
+that is expected and shows up in the error breakdown.
+"""
+import sys
+import json
+import random
+import asyncio
+import logging
+import argparse
+import tempfile
+from time import perf_counter
+from collections import Counter, defaultdict
+from typing import Dict, List
+
+import bot as bot_module
+from database_handler import DatabaseHandler
+from benchmarks.fake_discord import FakeDiscord, FakeDiscordSettings
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MIX = "redeem=4,generate=1,member_data=3,role_change=2"
+# Licenses generated per guild before the run, redeem picks from these
+_LICENSES_PER_GUILD = 200
+# How long to wait for commands still running after the last event was sent
+_DRAIN_SECONDS = 30
+
+
+class CommandTracker:
+    """Times commands from the message event until command_completion/command_error."""
+
+    def __init__(self, bot):
+        # message id -> (command name, send time)
+        self.pending = {}
+        self.durations = defaultdict(list)
+        self.errors = defaultdict(Counter)
+        bot.add_listener(self.on_command_completion)
+        bot.add_listener(self.on_command_error)
+
+    def track(self, message_id: int, name: str):
+        self.pending[message_id] = (name, perf_counter())
+
+    async def on_command_completion(self, ctx):
+        self._finish(ctx, None)
+
+    async def on_command_error(self, ctx, error):
+        self._finish(ctx, error)
+
+    def _finish(self, ctx, error):
+        pending = self.pending.pop(ctx.message.id, None)
+        if pending is None:
+            return
+        name, start = pending
+        self.durations[name].append(perf_counter() - start)
+        if error is not None:
+            self.errors[name][type(error).__name__] += 1
+
+    async def drain(self):
+        """Waits for pending commands, up to _DRAIN_SECONDS."""
+        drain_start = perf_counter()
+        while self.pending and perf_counter() - drain_start < _DRAIN_SECONDS:
+            await asyncio.sleep(0.05)
+
+    def report(self) -> dict:
+        commands = {}
+        for name, durations in self.durations.items():
+            durations.sort()
+            errors = sum(self.errors[name].values())
+            commands[name] = {
+                "completed": len(durations),
+                "p50": durations[len(durations) // 2],
+                "p99": durations[min(len(durations) - 1, int(len(durations) * 0.99))],
+                "error_rate": errors / len(durations),
+                "errors": dict(self.errors[name])
+            }
+        return {
+            "commands": commands,
+            "unfinished": dict(Counter(name for name, _start in self.pending.values()))
+        }
+
+
+class LoadGenerator:
+    def __init__(self, world: FakeDiscord, licenses: Dict[int, List[str]], mix: Dict[str, int], seed: int):
+        """
+        :param world: FakeDiscord attached to a ready bot
+        :param licenses: dict guild id -> list of licenses that can be redeemed
+        :param mix: dict event kind -> weight
+        """
+        self.world = world
+        self.licenses = licenses
+        self.kinds = list(mix)
+        self.weights = list(mix.values())
+        self.random = random.Random(seed)
+        self.guild_ids = list(world.guilds)
+        # Owner is the only admin, it's kept for admin commands
+        self.member_ids = {guild.id: list(guild.members)[1:] or [guild.owner_id] for guild in world.guilds.values()}
+        self.tracker = CommandTracker(world.bot)
+        self.sent = Counter()
+
+    def _random_member_id(self, guild) -> int:
+        return self.random.choice(self.member_ids[guild.id])
+
+    def send_event(self):
+        kind = self.random.choices(self.kinds, self.weights)[0]
+        guild = self.world.guilds[self.random.choice(self.guild_ids)]
+        self.sent[kind] += 1
+        if kind == "role_change":
+            member_id = self._random_member_id(guild)
+            role_id = self.random.choice(guild.licensed_role_ids)
+            roles = [int(role) for role in guild.members[member_id]["roles"]]
+            roles = [role for role in roles if role != role_id] if role_id in roles else roles + [role_id]
+            self.world.update_member_roles(guild.id, member_id, roles)
+            return
+
+        if kind == "redeem":
+            guild_licenses = self.licenses[guild.id]
+            # Once used up redeem measures the invalid license path
+            license = guild_licenses.pop() if guild_licenses else "invalid"
+            content = f"!redeem {license}"
+            author_id = self._random_member_id(guild)
+        elif kind == "generate":
+            content = "!generate 5"
+            author_id = guild.owner_id
+        else:
+            content = f"!{kind}"
+            author_id = self._random_member_id(guild)
+        self.tracker.track(self.world.send_message(guild.id, author_id, content), kind)
+
+    async def run(self, rate: float, duration: float) -> float:
+        """
+        Sends events at param rate per second for param duration seconds, then waits for pending commands.
+        Events are sent in small batches each tick so high rates don't depend on sleep precision.
+        :return: float achieved events per second
+        """
+        start = perf_counter()
+        sent = 0
+        while perf_counter() - start < duration:
+            due = int((perf_counter() - start) * rate)
+            for _ in range(due - sent):
+                self.send_event()
+            sent = max(sent, due)
+            await asyncio.sleep(0.001)
+        send_duration = perf_counter() - start
+        await self.tracker.drain()
+        return sent / send_duration
+
+    def report(self, achieved_rate: float) -> dict:
+        return {
+            "events_sent": dict(self.sent),
+            "events_per_second": achieved_rate,
+            **self.tracker.report(),
+            "rate_limited_requests": self.world.stats["429"],
+            "rest_requests": self.world.stats["requests"]
+        }
+
+
+def log_report(report: dict):
+    logger.info(f"Events sent: {report['events_sent']} ({report['events_per_second']:.0f}/s)")
+    logger.info(f"REST requests: {report['rest_requests']}, rate limited: {report['rate_limited_requests']}")
+    for name, result in sorted(report["commands"].items()):
+        logger.info(f"{name:<16} completed {result['completed']:>7}  p50 {result['p50'] * 1000:9.1f}ms  "
+                    f"p99 {result['p99'] * 1000:9.1f}ms  errors {result['error_rate']:6.1%} {result['errors'] or ''}")
+    if report["unfinished"]:
+        logger.warning(f"Commands that didn't finish within {_DRAIN_SECONDS}s: {report['unfinished']}")
+
+
+async def register_guilds(world: FakeDiscord, database: DatabaseHandler, prefix: str):
+    """Registers fake guilds with their first licensed role as default."""
+    await database.setup_new_guilds(set(world.guilds), prefix)
+    for guild in world.guilds.values():
+        await database.change_default_guild_role(guild.id, guild.licensed_role_ids[0])
+
+
+async def prepare_database(world: FakeDiscord, database: DatabaseHandler, prefix: str) -> Dict[int, List[str]]:
+    """
+    Registers fake guilds and generates licenses to redeem.
+    :return: dict guild id -> list of generated licenses
+    """
+    await register_guilds(world, database, prefix)
+    licenses = {}
+    for guild in world.guilds.values():
+        licenses[guild.id] = []
+        for _ in range(0, _LICENSES_PER_GUILD, 25):
+            role_id = world.random.choice(guild.licensed_role_ids)
+            licenses[guild.id].extend(await database.generate_guild_licenses(25, guild.id, role_id, 720))
+    return licenses
+
+
+def parse_mix(mix: str) -> Dict[str, int]:
+    """
+    :param mix: string in format kind=weight,kind=weight
+    :return: dict kind -> int weight
+    """
+    kinds = {}
+    for entry in mix.split(","):
+        kind, weight = entry.split("=")
+        if kind not in ("redeem", "generate", "member_data", "role_change"):
+            raise ValueError(f"Unknown event kind {kind}")
+        kinds[kind] = int(weight)
+    return kinds
+
+
+async def start_bot(world: FakeDiscord, database_directory: str):
+    """
+    Creates the real Bot with it's database in param directory and attaches param world to it.
+    Bot is not connected yet, call world.connect() once the database is prepared.
+    :return: Bot
+    """
+    DatabaseHandler.DB_PATH = database_directory + "/"
+    # No network access and nothing to report to
+    if "top_gg_api" in bot_module.startup_extensions:
+        bot_module.startup_extensions.remove("top_gg_api")
+    bot = bot_module.Bot()
+    try:
+        await bot._setup()
+    except Exception:
+        await stop_bot(bot)
+        raise
+    world.attach(bot)
+    return bot
+
+
+async def stop_bot(bot):
+    bot.loop_monitor.stop()
+    bot.traffic_recorder.close()
+    if bot.main_db is not None:
+        await bot.main_db.close()
+
+
+def stop_logging():
+    """Flushes log records of the code under test, call after the report was logged."""
+    bot_module.logger_handlers.stop_queue_logging(
+        bot_module.root_logger, bot_module.log_queue_handler, bot_module.log_queue_listener
+    )
+
+
+async def main(arguments) -> dict:
+    settings = FakeDiscordSettings(
+        guilds=arguments.guilds,
+        members_per_guild=arguments.members_per_guild,
+        latency=arguments.latency,
+        rate_limit_chance=arguments.rate_limit_chance,
+        seed=arguments.seed
+    )
+    world = FakeDiscord(settings)
+    with tempfile.TemporaryDirectory() as temp_directory:
+        bot = await start_bot(world, temp_directory)
+        try:
+            licenses = await prepare_database(world, bot.main_db, bot.config["default_prefix"])
+            world.connect()
+            generator = LoadGenerator(world, licenses, parse_mix(arguments.mix), arguments.seed)
+            logger.info(f"Sending {arguments.rate}/s events for {arguments.duration}s to {arguments.guilds} guilds ..")
+            achieved_rate = await generator.run(arguments.rate, arguments.duration)
+            report = generator.report(achieved_rate)
+        finally:
+            await stop_bot(bot)
+    log_report(report)
+    stop_logging()
+    return report
+
+
+def _parse_arguments():
+    parser = argparse.ArgumentParser(description="Load test the bot against an offline Discord stand-in.")
+    parser.add_argument("--guilds", type=int, default=50)
+    parser.add_argument("--members-per-guild", type=int, default=200)
+    parser.add_argument("--rate", type=float, default=1000, help="events per second")
+    parser.add_argument("--duration", type=float, default=10, help="seconds to send events for")
+    parser.add_argument("--latency", type=float, default=0.05, help="mean REST/gateway latency in seconds")
+    parser.add_argument("--rate-limit-chance", type=float, default=0.01, help="chance of a REST request getting 429")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="event kinds and their weights")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="optional path to write the JSON report to")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    parsed_arguments = _parse_arguments()
+    # Per command logs of the code under test would flood the console
+    logging.getLogger("cogs").setLevel(logging.WARNING)
+    logging.getLogger("database_handler").setLevel(logging.WARNING)
+    load_report = asyncio.get_event_loop().run_until_complete(main(parsed_arguments))
+    if parsed_arguments.output:
+        with open(parsed_arguments.output, "w") as output_file:
+            json.dump(load_report, output_file, indent=4)
+    sys.exit(1 if load_report["unfinished"] else 0)
@@ -0,0 +1,231 @@
+"""
+Replays a traffic log recorded by helpers/traffic_recorder.py against the real Bot and cogs running on
+the offline Discord stand-in (benchmarks/fake_discord.py).
+
+Every recorded guild gets a fake guild and every recorded member a fake member of it, administrators
+are mapped to the guild owner so admin commands pass the same checks as in production.
+Anonymized arguments are turned back into valid ones: mentions and ids point to mapped members/roles
+and each recorded license gets a real generated license of the mapped guild.
+Messages that were not commands are sent as plain messages so prefix lookups are replayed too.
+The real expiry loop is stopped, expiry passes run when they were recorded.
+DMs are not supported by the stand-in and are skipped.
+
+Usage (from repository root):
+    python3 -m benchmarks.replay traffic/traffic-0-20201018-120000.jsonl [--speed 10] [--latency 0.05]
+"""
+import sys
+import json
+import asyncio
+import logging
+import argparse
+import tempfile
+from time import perf_counter
+from collections import Counter, defaultdict
+from typing import Dict, List
+
+from helpers.traffic_recorder import read_events
+from benchmarks.fake_discord import FakeDiscord, FakeDiscordSettings
+from benchmarks.load_test import CommandTracker, start_bot, stop_bot, stop_logging, register_guilds
+
+
+logger = logging.getLogger(__name__)
+
+_GENERATE_BATCH = 25
+
+
+class Replayer:
+    def __init__(self, events: List[dict], latency: float, rate_limit_chance: float, seed: int):
+        """
+        :param events: events returned by read_events
+        """
+        self.events = events
+        guild_members = defaultdict(dict)
+        for event in events:
+            if event.get("g") is None:
+                continue
+            members = guild_members[event["g"]]
+            member = event.get("a", event.get("m"))
+            if not event.get("adm"):
+                members.setdefault(member, len(members))
+            for argument in event.get("x", ()):
+                if argument.startswith(("U:", "I:")):
+                    members.setdefault(int(argument[2:]), len(members))
+        self.recorded_guild_ids = list(guild_members)
+        self.world = FakeDiscord(FakeDiscordSettings(
+            # Owner plus one fake member for every recorded one
+            guilds=len(self.recorded_guild_ids),
+            members_per_guild=max((len(members) for members in guild_members.values()), default=0) + 1,
+            latency=latency,
+            rate_limit_chance=rate_limit_chance,
+            seed=seed
+        ))
+        # Recorded guild id -> fake guild
+        self.guilds = dict(zip(self.recorded_guild_ids, self.world.guilds.values()))
+        # Recorded guild id -> recorded member id -> fake member id
+        self.members = {}
+        for recorded_guild_id, recorded_members in guild_members.items():
+            fake_member_ids = list(self.guilds[recorded_guild_id].members)[1:]
+            self.members[recorded_guild_id] = {
+                recorded_member_id: fake_member_ids[index] for recorded_member_id, index in recorded_members.items()
+            }
+        # License token -> generated license
+        self.licenses: Dict[str, str] = {}
+        self.tracker = None
+        self.replayed = Counter()
+        self.skipped = Counter()
+        self.max_lag = 0.0
+
+    async def generate_licenses(self, database):
+        """Generates a real license in the mapped guild for every recorded license token."""
+        tokens = defaultdict(list)
+        for event in self.events:
+            for argument in event.get("x", ()):
+                if argument.startswith("L:") and event.get("g") is not None and argument not in self.licenses:
+                    self.licenses[argument] = None
+                    tokens[event["g"]].append(argument)
+        for recorded_guild_id, guild_tokens in tokens.items():
+            guild = self.guilds[recorded_guild_id]
+            for i in range(0, len(guild_tokens), _GENERATE_BATCH):
+                batch = guild_tokens[i:i + _GENERATE_BATCH]
+                role_id = self.world.random.choice(guild.licensed_role_ids)
+                licenses = await database.generate_guild_licenses(len(batch), guild.id, role_id, 720)
+                self.licenses.update(zip(batch, licenses))
+        logger.info(f"Generated {len(self.licenses)} licenses for recorded license tokens.")
+
+    def _member_id(self, event: dict, recorded_member_id: int) -> int:
+        guild = self.guilds[event["g"]]
+        member_id = self.members[event["g"]].get(recorded_member_id)
+        return guild.owner_id if member_id is None else member_id
+
+    def _argument(self, event: dict, argument: str) -> str:
+        kind, _, value = argument.partition(":")
+        if kind == "U":
+            return f"<@{self._member_id(event, int(value))}>"
+        if kind == "I":
+            return str(self._member_id(event, int(value)))
+        if kind == "R":
+            role_ids = self.guilds[event["g"]].licensed_role_ids
+            return f"<@&{role_ids[int(value) % len(role_ids)]}>"
+        if kind == "L":
+            return self.licenses[argument]
+        if argument == "*":
+            return "x"
+        return argument
+
+    def replay_event(self, event: dict):
+        if event["e"] == "x":
+            self.replayed["expiry pass"] += 1
+            self.world.loop.create_task(self.world.bot.get_cog("LicenseHandler").run_expiry_pass())
+            return
+        if event["g"] is None:
+            self.skipped["dm"] += 1
+            return
+        guild = self.guilds[event["g"]]
+        if event["e"] == "r":
+            self.replayed["role change"] += 1
+            member_id = self._member_id(event, event["m"])
+            role_id = self.world.random.choice(guild.licensed_role_ids)
+            roles = [int(role) for role in guild.members[member_id]["roles"]]
+            roles = [role for role in roles if role != role_id] if role_id in roles else roles + [role_id]
+            self.world.update_member_roles(guild.id, member_id, roles)
+        else:
+            author_id = guild.owner_id if event["adm"] else self._member_id(event, event["a"])
+            if event["c"] is None:
+                self.replayed["message"] += 1
+                mention = f"<@{self.world.bot.user.id}> " if event["men"] else ""
+                self.world.send_message(guild.id, author_id, f"{mention}hello")
+                return
+            self.replayed[event["c"]] += 1
+            # Mentions in commands are part of the arguments, fake guilds are registered with default prefix
+            arguments = " ".join(self._argument(event, argument) for argument in event["x"])
+            content = f"!{event['c']} {arguments}"
+            self.tracker.track(self.world.send_message(guild.id, author_id, content), event["c"])
+
+    async def run(self, speed: float) -> float:
+        """
+        Sends events at their recorded time divided by param speed, then waits for pending commands.
+        :return: float duration of sending in seconds
+        """
+        self.tracker = CommandTracker(self.world.bot)
+        # Only recorded expiry passes run
+        self.world.bot.get_cog("LicenseHandler").license_check.cancel()
+        start = perf_counter()
+        for event in self.events:
+            due = event["t"] / 1000 / speed
+            delay = due - (perf_counter() - start)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            else:
+                self.max_lag = max(self.max_lag, -delay)
+            self.replay_event(event)
+        duration = perf_counter() - start
+        await self.tracker.drain()
+        return duration
+
+    def report(self, duration: float, speed: float) -> dict:
+        recorded_duration = self.events[-1]["t"] / 1000 if self.events else 0
+        return {
+            "speed": speed,
+            "recorded_seconds": recorded_duration,
+            "replay_seconds": duration,
+            "max_lag_seconds": self.max_lag,
+            "replayed": dict(self.replayed),
+            "skipped": dict(self.skipped),
+            **self.tracker.report(),
+            "rate_limited_requests": self.world.stats["429"],
+            "rest_requests": self.world.stats["requests"]
+        }
+
+
+def log_report(report: dict):
+    logger.info(f"Replayed {report['recorded_seconds']:.0f}s of traffic in {report['replay_seconds']:.1f}s "
+                f"({report['speed']}x), falling behind schedule by at most {report['max_lag_seconds'] * 1000:.0f}ms")
+    logger.info(f"Events: {report['replayed']} skipped: {report['skipped'] or 0}")
+    logger.info(f"REST requests: {report['rest_requests']}, rate limited: {report['rate_limited_requests']}")
+    for name, result in sorted(report["commands"].items()):
+        logger.info(f"{name:<16} completed {result['completed']:>7}  p50 {result['p50'] * 1000:9.1f}ms  "
+                    f"p99 {result['p99'] * 1000:9.1f}ms  errors {result['error_rate']:6.1%} {result['errors'] or ''}")
+    if report["unfinished"]:
+        logger.warning(f"Commands that didn't finish: {report['unfinished']}")
+
+
+async def main(arguments) -> dict:
+    events = read_events(arguments.log)
+    replayer = Replayer(events, arguments.latency, arguments.rate_limit_chance, arguments.seed)
+    logger.info(f"Loaded {len(events)} events of {len(replayer.guilds)} guilds.")
+    with tempfile.TemporaryDirectory() as temp_directory:
+        bot = await start_bot(replayer.world, temp_directory)
+        try:
+            await register_guilds(replayer.world, bot.main_db, bot.config["default_prefix"])
+            await replayer.generate_licenses(bot.main_db)
+            replayer.world.connect()
+            duration = await replayer.run(arguments.speed)
+            report = replayer.report(duration, arguments.speed)
+        finally:
+            await stop_bot(bot)
+    log_report(report)
+    stop_logging()
+    return report
+
+
+def _parse_arguments():
+    parser = argparse.ArgumentParser(description="Replay recorded traffic against an offline Discord stand-in.")
+    parser.add_argument("log", help="traffic log written by the traffic recorder")
+    parser.add_argument("--speed", type=float, default=1, help="1 replays in real time, 10 is 10 times faster")
+    parser.add_argument("--latency", type=float, default=0.05, help="mean REST/gateway latency in seconds")
+    parser.add_argument("--rate-limit-chance", type=float, default=0.01, help="chance of a REST request getting 429")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="optional path to write the JSON report to")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    parsed_arguments = _parse_arguments()
+    # Per command logs of the code under test would flood the console
+    logging.getLogger("cogs").setLevel(logging.WARNING)
+    logging.getLogger("database_handler").setLevel(logging.WARNING)
+    replay_report = asyncio.get_event_loop().run_until_complete(main(parsed_arguments))
+    if parsed_arguments.output:
+        with open(parsed_arguments.output, "w") as output_file:
+            json.dump(replay_report, output_file, indent=4)
+    sys.exit(1 if replay_report["unfinished"] else 0)
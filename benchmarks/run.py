@@ -0,0 +1,250 @@
+"""
+Benchmarks DatabaseHandler and LicenseHandler hot paths against a temporary database filled with
+a synthetic population.
+
+Usage (from repository root):
+    python3 -m benchmarks.run [--guilds 10000] [--members 1000000] [--licenses 500000]
+                              [--output benchmarks/results.json] [--baseline benchmarks/baseline.json]
+                              [--threshold 0.1] [--save-baseline]
+
+Results are written as JSON. If baseline file exists each benchmark median is compared to it and
+the exit code is 1 if any of them is slower by more than threshold (0.1 = 10%).
+Use --save-baseline on the commit you compare against, baselines are only comparable on the same machine.
+"""
+import sys
+import json
+import random
+import asyncio
+import logging
+import argparse
+import platform
+import tempfile
+import statistics
+from pathlib import Path
+from time import perf_counter
+from types import SimpleNamespace
+from typing import Callable, Dict, List
+
+from cogs.licenses import LicenseHandler
+from helpers.paginator import Paginator
+from database_handler import DatabaseHandler
+from helpers.licence_helper import construct_expiration_date, get_current_time
+from benchmarks.synthetic_data import Population, GeneratedIds, populate
+
+
+logger = logging.getLogger(__name__)
+
+
+class _FakeMember:
+    """Has every role of it's guild so expiry always goes down the role removal path."""
+
+    def __init__(self, member_id: int, roles: list):
+        self.id = member_id
+        self.roles = roles
+        self.mention = f"<@{member_id}>"
+
+    async def remove_roles(self, *_roles):
+        pass
+
+    async def send(self, *_args, **_kwargs):
+        pass
+
+
+class _FakeMemberCache:
+    def __init__(self, role_ids: Dict[int, List[int]]):
+        self.role_ids = role_ids
+
+    async def get_member(self, guild, member_id: int):
+        roles = [SimpleNamespace(id=role_id) for role_id in self.role_ids[guild.id]]
+        return _FakeMember(member_id, roles)
+
+
+def _construct_bot(database: DatabaseHandler, generated: GeneratedIds) -> SimpleNamespace:
+    """Only what LicenseHandler needs for expiry pass, Discord calls are no-ops."""
+    guilds = {guild_id: SimpleNamespace(id=guild_id, name=str(guild_id)) for guild_id in generated.guild_ids}
+    return SimpleNamespace(
+        main_db=database,
+        shutting_down=False,
+        cluster=SimpleNamespace(is_writer=False, add_listener=lambda *_: None),
+        member_cache=_FakeMemberCache(generated.role_ids),
+        get_guild=guilds.get,
+        owns_guild=lambda _guild_id: True
+    )
+
+
+async def _measure(name: str, function: Callable, iterations: int) -> dict:
+    """
+    :param function: coroutine function taking iteration index
+    :return: dict of timings in seconds
+    """
+    durations = []
+    for i in range(iterations):
+        start = perf_counter()
+        await function(i)
+        durations.append(perf_counter() - start)
+    durations.sort()
+    result = {
+        "iterations": iterations,
+        "median": statistics.median(durations),
+        "p95": durations[min(len(durations) - 1, int(len(durations) * 0.95))],
+        "min": durations[0],
+        "total": sum(durations)
+    }
+    logger.info(f"{name:<32} median {result['median'] * 1000:10.3f}ms  p95 {result['p95'] * 1000:10.3f}ms  "
+                f"({iterations} iterations)")
+    return result
+
+
+async def run_benchmarks(database: DatabaseHandler, generated: GeneratedIds, iterations: int) -> dict:
+    rng = random.Random(0)
+    results = {}
+    guild_ids = generated.guild_ids
+    # Consumed by redeem benchmark, each license can be redeemed once
+    licenses = list(generated.licenses)
+    rng.shuffle(licenses)
+
+    async def count_queries(_):
+        guild_id = rng.choice(guild_ids)
+        await database.get_guild_licensed_roles_total_count(guild_id)
+        await database.get_licensed_roles_total_count()
+        await database.get_guild_license_total_count(guild_id)
+        await database.get_stored_license_total_count()
+
+    async def redeem_sequence(_):
+        # Same database calls as LicenseHandler.redeem/activate_license for a member without the role
+        license = licenses.pop()
+        guild_id, role_id = await database.get_license_data(license)
+        await database.is_valid_license(license, guild_id)
+        duration = await database.get_license_duration_hours(license)
+        member_id = rng.randint(10 ** 17, 10 ** 18)
+        await database.add_new_licensed_member(member_id, guild_id, construct_expiration_date(duration), role_id)
+        await database.delete_license(license)
+
+    async def generate_licenses(_):
+        guild_id = rng.choice(guild_ids)
+        await database.generate_guild_licenses(25, guild_id, generated.role_ids[guild_id][0], 720)
+
+    log_lines = "\n".join(f"{get_current_time()} INFO cogs.licenses: line {i} " + "x" * rng.randint(20, 200)
+                          for i in range(10_000))
+
+    async def make_chunks(_):
+        Paginator.make_chunks("Last 10000 log lines.\n\n", log_lines, "\n", 1900)
+
+    license_handler = LicenseHandler(_construct_bot(database, generated))
+
+    async def expiry_pass(_):
+        await license_handler.check_all_active_licenses()
+
+    # Guilds are deleted so they are picked without repeating
+    removed_guild_ids = rng.sample(guild_ids, min(iterations, len(guild_ids)))
+
+    async def remove_guild_data(i):
+        await database.remove_all_guild_data(removed_guild_ids[i], guild_table_too=True)
+
+    results["count_queries"] = await _measure("count_queries", count_queries, iterations)
+    results["redeem_sequence"] = await _measure("redeem_sequence", redeem_sequence, min(iterations, len(licenses)))
+    results["generate_guild_licenses"] = await _measure("generate_guild_licenses", generate_licenses, iterations)
+    results["paginator_make_chunks"] = await _measure("paginator_make_chunks", make_chunks, iterations)
+    # Removes all expired rows so only the first pass does real work
+    results["check_all_active_licenses"] = await _measure("check_all_active_licenses", expiry_pass, 1)
+    results["check_all_active_licenses_idle"] = await _measure("check_all_active_licenses_idle", expiry_pass, 3)
+    results["remove_all_guild_data"] = await _measure(
+        "remove_all_guild_data", remove_guild_data, len(removed_guild_ids)
+    )
+
+    async def aggregate_queries(_):
+        guild_id = rng.choice(guild_ids)
+        await database.get_guild_role_subscription_counts(guild_id)
+        await database.get_expiring_count(24, guild_id)
+        await database.get_expiring_count(24)
+        await database.get_top_licensed_guilds(10)
+
+    results["aggregate_queries"] = await _measure("aggregate_queries", aggregate_queries, min(iterations, 20))
+    await database.enable_subscription_columns()
+    results["aggregate_queries_columns"] = await _measure("aggregate_queries_columns", aggregate_queries, iterations)
+    return results
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> List[str]:
+    """
+    :return: list of strings describing benchmarks whose median is slower than baseline by more than param threshold
+    """
+    regressions = []
+    for name, result in results["benchmarks"].items():
+        baseline_result = baseline["benchmarks"].get(name)
+        if baseline_result is None:
+            continue
+        change = result["median"] / baseline_result["median"] - 1 if baseline_result["median"] else 0
+        line = (f"{name:<32} {baseline_result['median'] * 1000:10.3f}ms -> {result['median'] * 1000:10.3f}ms "
+                f"({change:+.1%})")
+        if change > threshold:
+            regressions.append(line)
+            logger.warning(f"REGRESSION {line}")
+        else:
+            logger.info(f"ok         {line}")
+    return regressions
+
+
+async def main(arguments) -> int:
+    population = Population(
+        arguments.guilds, arguments.members, arguments.licenses,
+        arguments.roles_per_guild, arguments.expired_ratio, arguments.seed
+    )
+    with tempfile.TemporaryDirectory() as temp_directory:
+        DatabaseHandler.DB_PATH = temp_directory + "/"
+        database = await DatabaseHandler.create_instance("benchmark")
+        logger.info(f"Generating {population} ..")
+        start = perf_counter()
+        generated = await populate(database.connection, population)
+        logger.info(f"Generated in {perf_counter() - start:.1f}s")
+        try:
+            benchmarks = await run_benchmarks(database, generated, arguments.iterations)
+        finally:
+            await database.connection.close()
+
+    results = {
+        "population": population._asdict(),
+        "python": platform.python_version(),
+        "machine": platform.platform(),
+        "benchmarks": benchmarks
+    }
+    Path(arguments.output).write_text(json.dumps(results, indent=4))
+    logger.info(f"Results written to {arguments.output}")
+
+    baseline_path = Path(arguments.baseline)
+    if arguments.save_baseline:
+        baseline_path.write_text(json.dumps(results, indent=4))
+        logger.info(f"Baseline saved to {baseline_path}")
+        return 0
+    if not baseline_path.is_file():
+        logger.info("No baseline to compare against.")
+        return 0
+    baseline = json.loads(baseline_path.read_text())
+    if baseline["population"] != results["population"]:
+        logger.warning("Baseline was made with a different population, comparison is not meaningful.")
+    regressions = compare(results, baseline, arguments.threshold)
+    return 1 if regressions else 0
+
+
+def _parse_arguments():
+    parser = argparse.ArgumentParser(description="Benchmark database and license hot paths.")
+    parser.add_argument("--guilds", type=int, default=10_000)
+    parser.add_argument("--members", type=int, default=1_000_000, help="rows in LICENSED_MEMBERS")
+    parser.add_argument("--licenses", type=int, default=500_000, help="rows in GUILD_LICENSES")
+    parser.add_argument("--roles-per-guild", type=int, default=3)
+    parser.add_argument("--expired-ratio", type=float, default=0.01, help="part of members that already expired")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--output", default="benchmarks/results.json")
+    parser.add_argument("--baseline", default="benchmarks/baseline.json")
+    parser.add_argument("--threshold", type=float, default=0.1, help="allowed slowdown of median, 0.1 = 10%%")
+    parser.add_argument("--save-baseline", action="store_true", help="save results as the new baseline")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    # Per query/row logs of the code under test would dominate the timings
+    logging.getLogger("database_handler").setLevel(logging.WARNING)
+    logging.getLogger("cogs.licenses").setLevel(logging.WARNING)
+    sys.exit(asyncio.get_event_loop().run_until_complete(main(_parse_arguments())))
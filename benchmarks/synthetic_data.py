@@ -0,0 +1,96 @@
+"""
+Fills a database with a synthetic population shaped like production data.
+
+Ids are generated as Discord snowflakes (17-19 digit ints) and expiration dates use the same string
+format as the bot (construct_expiration_date saved trough sqlite3 datetime adapter).
+"""
+import random
+import string
+from datetime import timedelta
+from collections import namedtuple
+
+from helpers.licence_helper import get_current_time
+
+
+Population = namedtuple("Population", "guilds members licenses roles_per_guild expired_ratio seed")
+# Ids picked while generating, used by benchmarks to target existing rows
+GeneratedIds = namedtuple("GeneratedIds", "guild_ids role_ids licenses")
+
+_SNOWFLAKE_MIN = 100_000_000_000_000_000
+_SNOWFLAKE_MAX = 999_999_999_999_999_999
+_DATE_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+_INSERT_BATCH = 50_000
+
+
+def _snowflakes(rng: random.Random, amount: int) -> list:
+    ids = set()
+    while len(ids) < amount:
+        ids.add(rng.randint(_SNOWFLAKE_MIN, _SNOWFLAKE_MAX))
+    return list(ids)
+
+
+def _license(rng: random.Random) -> str:
+    return "".join(rng.choices(string.ascii_letters + string.digits, k=30))
+
+
+async def populate(connection, population: Population) -> GeneratedIds:
+    """
+    Inserts param population trough raw connection in batched transactions, it does not go trough
+    DatabaseHandler so generating doesn't pollute the timings.
+    :param connection: aiosqlite connection to database created by DatabaseHandler
+    :param population: sizes of each table
+    :return: GeneratedIds
+    """
+    rng = random.Random(population.seed)
+    now = get_current_time()
+    guild_ids = _snowflakes(rng, population.guilds)
+    role_ids = {guild_id: _snowflakes(rng, population.roles_per_guild) for guild_id in guild_ids}
+
+    guild_rows = ((guild_id, "!", role_ids[guild_id][0], 720) for guild_id in guild_ids)
+    await connection.executemany(
+        "INSERT INTO GUILDS(GUILD_ID, PREFIX, DEFAULT_LICENSE_ROLE_ID, DEFAULT_LICENSE_DURATION_HOURS) VALUES(?,?,?,?)",
+        guild_rows
+    )
+
+    def member_rows():
+        for member_id in _snowflakes(rng, population.members):
+            guild_id = rng.choice(guild_ids)
+            if rng.random() < population.expired_ratio:
+                expiration = now - timedelta(minutes=rng.randint(1, 600))
+            else:
+                expiration = now + timedelta(hours=rng.randint(1, 24 * 365))
+            yield member_id, guild_id, f"{expiration:{_DATE_FORMAT}}", rng.choice(role_ids[guild_id])
+
+    licenses = []
+
+    def license_rows():
+        for _ in range(population.licenses):
+            guild_id = rng.choice(guild_ids)
+            license = _license(rng)
+            licenses.append(license)
+            yield license, guild_id, rng.choice(role_ids[guild_id]), rng.choice((24, 168, 720))
+
+    await _insert_batched(
+        connection,
+        "INSERT INTO LICENSED_MEMBERS(MEMBER_ID, GUILD_ID, EXPIRATION_DATE, LICENSED_ROLE_ID) VALUES(?,?,?,?)",
+        member_rows()
+    )
+    await _insert_batched(
+        connection,
+        "INSERT OR IGNORE INTO GUILD_LICENSES(LICENSE, GUILD_ID, LICENSED_ROLE_ID, LICENSE_DURATION_HOURS) "
+        "VALUES(?,?,?,?)",
+        license_rows()
+    )
+    await connection.commit()
+    return GeneratedIds(guild_ids, role_ids, licenses)
+
+
+async def _insert_batched(connection, query: str, rows):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == _INSERT_BATCH:
+            await connection.executemany(query, batch)
+            batch = []
+    if batch:
+        await connection.executemany(query, batch)
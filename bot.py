@@ -1,22 +1,45 @@
+import time
+# Taken before any other import so imports are part of the startup report
+process_start_time = time.perf_counter()
+
+import os
 import sys
 import logging
 import asyncio
 import traceback
+from typing import Set, Tuple
 
 import discord
 from discord.ext import commands
 
 from helpers.misc import maximize_size
+from helpers.loop_monitor import LoopMonitor
+from helpers.cluster import Cluster
+from helpers.member_cache import MemberCachePolicy, construct_intents
+from helpers.admission import AdmissionController
+from helpers.startup_timer import StartupTimer
+from helpers.traffic_recorder import TrafficRecorder
 from config_handler import ConfigHandler
 from database_handler import DatabaseHandler
-from helpers import logger_handlers, embed_handler
+from helpers import logger_handlers, embed_handler, metrics, tracing, warm_snapshot
 from helpers.licence_helper import get_current_time
 
 
+startup_timer = StartupTimer(process_start_time)
+startup_timer.mark("imports")
 root_logger = logging.getLogger()
 root_logger.setLevel(logging.INFO)
-root_logger.addHandler(logger_handlers.get_console_handler())
-root_logger.addHandler(logger_handlers.get_file_handler())
+# Set by cluster.py, each cluster process logs to it's own file
+cluster_id = os.environ.get("LICENSY_CLUSTER_ID")
+log_file_name = "log.txt" if cluster_id is None else f"log-cluster-{cluster_id}.txt"
+# Handlers do their I/O on a listener thread so logging never blocks the event loop
+log_file_handler = logger_handlers.get_file_handler(log_file_name)
+log_queue_handler, log_queue_listener = logger_handlers.get_queue_logging(
+    logger_handlers.get_console_handler(),
+    log_file_handler
+)
+root_logger.addHandler(log_queue_handler)
+log_queue_listener.start()
 logger = logging.getLogger("discord")
 logger.setLevel(logging.WARNING)
 
@@ -27,21 +50,177 @@ startup_extensions = [
     "bot_information",
     "help",
     "top_gg_api",
-    "cmd_errors"
+    "cmd_errors",
+    "metrics",
+    "maintenance"
 ]
 
 
-class Bot(commands.Bot):
-    def __init__(self, **kwargs):
+class Bot(commands.AutoShardedBot):
+    def __init__(self, cluster: Cluster = None, **kwargs):
+        """
+        :param cluster: passed when started trough cluster.py, together with shard_ids and shard_count kwargs
+        """
+        self.startup_timer = startup_timer
         self.config = ConfigHandler("config")
-        self.main_db = asyncio.get_event_loop().run_until_complete(DatabaseHandler.create_instance())
+        self.log_file_handler = log_file_handler
+        self.log_queue_handler = log_queue_handler
+        self._configure_logging()
+        self.cluster = Cluster() if cluster is None else cluster
+        # Opened in start() concurrently with login
+        self.main_db = None
         self.up_time_start_time = get_current_time()
+        self.member_cache = MemberCachePolicy(self)
         super(Bot, self).__init__(
             command_prefix=self.prefix_callable,
             help_command=None,
             description=self.config["bot_description"],
-            case_insensitive=True, **kwargs
+            case_insensitive=True,
+            intents=construct_intents(self.config["gateway_intents"]),
+            # Members are cached only for licensed guilds by MemberCachePolicy, messages are never read from cache
+            member_cache_flags=MemberCachePolicy.construct_cache_flags(),
+            chunk_guilds_at_startup=False,
+            max_messages=None,
+            **kwargs
         )
+        tracing.configure(self.config["trace_buffer_size"])
+        self.http.request = tracing.traced_request(self.http.request)
+        self.loop_monitor = LoopMonitor(self.loop, self.config["loop_lag_warning_seconds"])
+        self.loop_monitor.start()
+        self.admission_controller = AdmissionController(self.loop_monitor, self.config["load_shedding"])
+        # Contexts of commands that passed checks and are still running, waited for on graceful shutdown
+        self.commands_in_flight = set()
+        self.shutting_down = False
+        recording_settings = self.config["traffic_recording"]
+        self.traffic_recorder = TrafficRecorder(recording_settings["max_file_mb"])
+        if recording_settings["enabled"]:
+            self.traffic_recorder.start("traffic/", f"traffic-{self.cluster.cluster_id}")
+        self.before_invoke(self._before_command_invoke)
+        self.after_invoke(self._after_command_invoke)
+
+    def _configure_logging(self):
+        """Applies optional logging settings from config to the already running queue logging."""
+        if self.config["log_json_format"]:
+            logger_handlers.use_json_formatter(log_queue_listener.handlers)
+        sample_rate = self.config["log_sample_rate_per_second"]
+        if sample_rate:
+            log_queue_handler.addFilter(logger_handlers.RateSamplingFilter(sample_rate))
+
+    async def start(self, token: str, *, reconnect: bool = True):
+        """
+        Logs in while the database is opened and extensions are loaded, then connects to gateway.
+        Extensions are loaded only after database is available since their tasks use it right away.
+        """
+        self.startup_timer.mark("bot init")
+        with self.startup_timer.stage("login and setup"):
+            await asyncio.gather(self.login(token), self._setup())
+        await self.connect(reconnect=reconnect)
+
+    async def _setup(self):
+        with self.startup_timer.stage("database"):
+            slow_query_threshold = self.config["slow_query_threshold_ms"]
+            self.main_db = await DatabaseHandler.create_instance(
+                slow_query_threshold=slow_query_threshold / 1000 if slow_query_threshold else None
+            )
+            if self.cluster.is_writer:
+                await self.main_db.enable_incremental_vacuum()
+                if self.config["subscription_columns"]:
+                    await self.main_db.enable_subscription_columns()
+            await self.cluster.connect(self.main_db)
+        if self.config["warm_restart_snapshot"]:
+            with self.startup_timer.stage("snapshot"):
+                await self.load_snapshot()
+        with self.startup_timer.stage("extensions"):
+            self.load_startup_extensions()
+
+    @property
+    def snapshot_path(self) -> str:
+        return f"{DatabaseHandler.DB_PATH}warm-snapshot-{self.cluster.cluster_id}.bin"
+
+    async def load_snapshot(self):
+        """Restores caches from warm restart snapshot if it exists and is not stale."""
+        change_counter = await self.main_db.get_change_counter()
+        state = await self.loop.run_in_executor(None, warm_snapshot.load, self.snapshot_path, change_counter)
+        if state is None:
+            return
+        self.main_db.guild_cache.update(state["guild_cache"])
+        self.member_cache.licensed_guild_ids = state["licensed_guild_ids"]
+        self.member_cache.restored = True
+        root_logger.info(f"Restored warm restart snapshot ({len(state['guild_cache']):,} guilds cached).")
+
+    async def save_snapshot(self):
+        """
+        Saves caches to warm restart snapshot, call after last database write before shutting down.
+        Any database write after this makes the snapshot stale.
+        """
+        state = {
+            "guild_cache": self.main_db.guild_cache,
+            "licensed_guild_ids": self.member_cache.licensed_guild_ids
+        }
+        change_counter = await self.main_db.get_change_counter()
+        size = await self.loop.run_in_executor(None, warm_snapshot.save, self.snapshot_path, change_counter, state)
+        root_logger.info(f"Saved warm restart snapshot ({size:,} bytes, database change counter {change_counter}).")
+
+    def load_startup_extensions(self):
+        root_logger.info("Loaded extensions:")
+        for extension in startup_extensions:
+            cog_path = f"cogs.{extension}"
+            start = time.perf_counter()
+            try:
+                self.load_extension(cog_path)
+                root_logger.info(f"\t{cog_path} ({time.perf_counter() - start:.3f}s)")
+            except Exception as e:
+                exc = f"{type(e).__name__}: {e}"
+                root_logger.error(f"{exc} Failed to load extension {cog_path}")
+                traceback_msg = traceback.format_exception(etype=type(e), value=e, tb=e.__traceback__)
+                root_logger.warning(traceback_msg)
+
+    def owns_guild(self, guild_id: int) -> bool:
+        """
+        :return: True if param guild is handled by shards of this process.
+                 Always True if not clustered.
+        """
+        if self.shard_ids is None:
+            return True
+        return (guild_id >> 22) % self.shard_count in self.shard_ids
+
+    async def guild_database_diff(self) -> Tuple[Set[int], Set[int]]:
+        """
+        Compares guilds the bot is in with guilds registered in database.
+        When clustered only guilds of this process are compared.
+        :return: tuple(set of guild ids not registered in database,
+                       set of guild ids registered in database that the bot doesn't see)
+        """
+        loaded_guild_ids = {guild.id for guild in self.guilds}
+        stored_guild_ids = await self.main_db.get_all_guild_ids()
+        stored_guild_ids = {guild_id for guild_id in stored_guild_ids if self.owns_guild(guild_id)}
+        return loaded_guild_ids - stored_guild_ids, stored_guild_ids - loaded_guild_ids
+
+    async def process_commands(self, message):
+        # New commands are ignored while in-flight ones are drained
+        if self.shutting_down or message.author.bot:
+            return
+        # Same as default implementation, context is needed to record and trace the command
+        trace = tracing.start_trace()
+        ctx = None
+        try:
+            ctx = await self.get_context(message)
+            self.traffic_recorder.record_message(ctx)
+            await self.invoke(ctx)
+        finally:
+            # Messages that are not commands are not kept
+            tracing.finish_trace(trace, None if ctx is None or ctx.command is None else ctx.command.qualified_name)
+
+    async def _before_command_invoke(self, ctx):
+        ctx.invoke_start_time = time.perf_counter()
+        self.commands_in_flight.add(ctx)
+
+    async def _after_command_invoke(self, ctx):
+        # Called even if the command raised, in that case ctx.command_failed is set
+        self.commands_in_flight.discard(ctx)
+        duration = time.perf_counter() - ctx.invoke_start_time
+        status = "error" if ctx.command_failed else "ok"
+        metrics.command_duration.observe(duration, ctx.command.qualified_name, status)
 
     async def prefix_callable(self, bot_client, message):
         try:
@@ -66,6 +245,14 @@ class Bot(commands.Bot):
             f"\tDiscordPy version: {discord.__version__}"
         )
         root_logger.info("Successfully logged in and booted...!")
+        if not self.startup_timer.reported:
+            self.startup_timer.mark("gateway ready")
+            self.startup_timer.report()
+        await self.member_cache.cache_licensed_members()
+
+    async def on_member_update(self, before, after):
+        if before.roles != after.roles:
+            self.traffic_recorder.record_role_change(after)
 
     @staticmethod
     async def on_connect():
@@ -111,19 +298,20 @@ class Bot(commands.Bot):
                 await log_channel.send(embed=embed)
 
 
+def main(**bot_kwargs):
+    """
+    Runs the bot, blocks until the bot is closed.
+    :param bot_kwargs: passed to Bot, cluster.py uses this to pass cluster and shard info
+    """
+    bot = Bot(**bot_kwargs)
+    try:
+        bot.run(bot.config["token"])
+    finally:
+        bot.loop_monitor.stop()
+        bot.traffic_recorder.close()
+        logger_handlers.stop_queue_logging(root_logger, log_queue_handler, log_queue_listener)
+
+
 if __name__ == "__main__":
-    bot = Bot()
-    root_logger.info("Loaded extensions:")
-    for extension in startup_extensions:
-        cog_path = f"cogs.{extension}"
-        try:
-            bot.load_extension(cog_path)
-            root_logger.info(f"\t{cog_path}")
-        except Exception as e:
-            exc = f"{type(e).__name__}: {e}"
-            root_logger.error(f"{exc} Failed to load extension {cog_path}")
-            traceback_msg = traceback.format_exception(etype=type(e), value=e, tb=e.__traceback__)
-            root_logger.warning(traceback_msg)
-
-    bot.run(bot.config["token"])
+    main()
 
@@ -0,0 +1,61 @@
+"""
+Starts the bot as multiple processes (clusters) where each process runs a range of shards.
+
+Usage:
+    python3 cluster.py <cluster_count> <shards_per_cluster>
+
+Cluster 0 owns the database writer connection and the expiry scheduler, other clusters
+forward their database writes to it, see helpers.cluster.Cluster
+"""
+import os
+import sys
+import time
+import secrets
+import multiprocessing
+
+from config_handler import ConfigHandler
+
+
+def run_cluster(cluster_id: int, shard_ids: list, shard_count: int, ipc_port: int, ipc_token: str):
+    # Has to be set before importing bot since logging is set up on import
+    os.environ["LICENSY_CLUSTER_ID"] = str(cluster_id)
+    import bot
+    from helpers.cluster import Cluster
+
+    cluster = Cluster(cluster_id, ipc_port, ipc_token)
+    bot.main(cluster=cluster, shard_ids=shard_ids, shard_count=shard_count)
+
+
+def main():
+    if len(sys.argv) != 3:
+        print(__doc__)
+        sys.exit(1)
+
+    cluster_count, shards_per_cluster = int(sys.argv[1]), int(sys.argv[2])
+    shard_count = cluster_count * shards_per_cluster
+    ipc_port = ConfigHandler("config")["cluster_ipc_port"]
+    ipc_token = secrets.token_hex(32)
+
+    processes = []
+    for cluster_id in range(cluster_count):
+        shard_ids = list(range(cluster_id * shards_per_cluster, (cluster_id + 1) * shards_per_cluster))
+        process = multiprocessing.Process(
+            target=run_cluster, name=f"cluster-{cluster_id}",
+            args=(cluster_id, shard_ids, shard_count, ipc_port, ipc_token)
+        )
+        process.start()
+        processes.append(process)
+        print(f"Started cluster {cluster_id} with shards {shard_ids} (pid {process.pid})")
+        # Writer has to be listening before the others connect, and Discord limits identify rate anyway
+        time.sleep(5)
+
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        for process in processes:
+            process.terminate()
+
+
+if __name__ == "__main__":
+    main()
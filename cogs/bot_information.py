@@ -1,12 +1,13 @@
-import os
 import time
-import psutil
+import asyncio
 import logging
 
 import discord
 from discord.ext import commands, tasks
 
 from helpers.licence_helper import get_current_time
+from helpers.admission import low_priority
+from helpers.system_stats import SystemStatsSampler
 from helpers.embed_handler import info, success, failure
 from helpers.misc import construct_load_bar_string, construct_embed, time_ago, embed_space
 
@@ -20,7 +21,9 @@ class BotInformation(commands.Cog):
         self.developers = []
         # Fetch developers only once, at start
         self.bot.loop.create_task(self._set_developers())
-        self.process = psutil.Process(os.getpid())
+        self.system_stats = SystemStatsSampler()
+        self.system_stats_loop.change_interval(seconds=self.bot.config["system_stats_interval_seconds"])
+        self.system_stats_loop.start()
         self.activity = 0
         self.activity_loop.start()
         self.github_source = "https://github.com/albertopoljak/Licensy"
@@ -42,6 +45,11 @@ class BotInformation(commands.Cog):
         await self.bot.wait_until_ready()
         logger.info("Activity loop started!")
 
+    @tasks.loop(seconds=30.0)
+    async def system_stats_loop(self):
+        # psutil calls are blocking so keep them off the event loop
+        await self.bot.loop.run_in_executor(None, self.system_stats.sample)
+
     @commands.Cog.listener()
     async def on_message(self, message):
         # If bot is mentioned in message (both in guild and DM) show it's prefix
@@ -62,13 +70,15 @@ class BotInformation(commands.Cog):
 
         First value is REST API latency.
         Second value is Discord Gateway latency.
+        Third value is event loop lag.
         """
         before = time.monotonic()
         message = await ctx.send(embed=info("Pong", ctx.me))
         ping = (time.monotonic() - before) * 1000
         content = (
             f":ping_pong:   |   {int(ping)}ms\n"
-            f":timer:   |   {self.bot.latency * 1000:.0f}ms"
+            f":timer:   |   {self.bot.latency * 1000:.0f}ms\n"
+            f":hourglass:   |   {self.bot.loop_monitor.lag * 1000:.0f}ms"
         )
         await message.edit(embed=info(content, ctx.me, title="Results:"))
 
@@ -100,6 +110,7 @@ class BotInformation(commands.Cog):
 
     @commands.command(aliases=["hierarchy"])
     @commands.guild_only()
+    @low_priority()
     async def role_hierarchy(self, ctx):
         """Shows role hierarchy in guild and highlights top role which bot can currently manage."""
         roles = []
@@ -129,39 +140,36 @@ class BotInformation(commands.Cog):
         """Link to source code on Github."""
         await ctx.send(embed=info(self.github_source, ctx.me, title="Source code"))
 
-    @commands.command(aliases=["stats", "status", "server"])
+    @commands.command(aliases=["status", "server"])
     @commands.cooldown(1, 10, commands.BucketType.guild)
+    @low_priority()
     async def about(self, ctx):
         """Show bot information (stats/links/etc)."""
-        avg_members = round(len(self.bot.users) / len(self.bot.guilds))
+        # Members are not all cached so user cache can't be used for counting
+        total_members = sum(guild.member_count for guild in self.bot.guilds)
+        avg_members = round(total_members / len(self.bot.guilds))
         avg_members_string = f"{avg_members} users/server"
 
         active_licenses = await self.bot.main_db.get_licensed_roles_total_count()
         stored_licenses = await self.bot.main_db.get_stored_license_total_count()
 
-        bot_ram_usage = self.process.memory_full_info().rss / 1024 ** 2
-        bot_ram_usage = f"{bot_ram_usage:.2f} MB"
-        bot_ram_usage_field = construct_load_bar_string(self.process.memory_percent(), bot_ram_usage)
-
-        virtual_memory = psutil.virtual_memory()
-        server_ram_usage = f"{virtual_memory.used/1024/1024:.0f} MB"
-        server_ram_usage_field = construct_load_bar_string(virtual_memory.percent, server_ram_usage)
+        try:
+            stats = self.system_stats.latest()
+        except IndexError:
+            # Called before the first sample was taken
+            stats = await self.bot.loop.run_in_executor(None, self.system_stats.sample)
 
-        cpu_count = psutil.cpu_count()
+        bot_ram_usage = f"{stats.bot_ram_mb:.2f} MB"
+        bot_ram_usage_field = construct_load_bar_string(stats.bot_ram_percent, bot_ram_usage)
 
-        bot_cpu_usage = self.process.cpu_percent()
-        if bot_cpu_usage > 100:
-            bot_cpu_usage = bot_cpu_usage / cpu_count
-        bot_cpu_usage_field = construct_load_bar_string(bot_cpu_usage)
+        server_ram_usage = f"{stats.server_ram_used_mb:.0f} MB"
+        server_ram_usage_field = construct_load_bar_string(stats.server_ram_percent, server_ram_usage)
 
-        server_cpu_usage = psutil.cpu_percent()
-        if server_cpu_usage > 100:
-            server_cpu_usage = server_cpu_usage / cpu_count
-        server_cpu_usage_field = construct_load_bar_string(server_cpu_usage)
+        bot_cpu_usage_field = construct_load_bar_string(stats.bot_cpu_percent)
+        server_cpu_usage_field = construct_load_bar_string(stats.server_cpu_percent)
 
-        io_counters = self.process.io_counters()
-        io_read_bytes = f"{io_counters.read_bytes/1024/1024:.3f}MB"
-        io_write_bytes = f"{io_counters.write_bytes/1024/1024:.3f}MB"
+        io_read_bytes = f"{stats.io_read_mb:.3f}MB"
+        io_write_bytes = f"{stats.io_write_mb:.3f}MB"
 
         footer = (
             f"[Invite]({self._get_bot_invite_link()})"
@@ -187,7 +195,7 @@ class BotInformation(commands.Cog):
             "Library": "discord.py",
             "Servers": len(self.bot.guilds),
             "Average users:": avg_members_string,
-            "Total users": len(self.bot.users),
+            "Total users": total_members,
             "Commands": len(self.bot.commands),
             "Active licenses:": active_licenses,
             "Stored licenses:": stored_licenses,
@@ -206,10 +214,9 @@ class BotInformation(commands.Cog):
         # before the bot is connected to discord thus getting an exception
         await self.bot.wait_until_ready()
         developer_ids = self.bot.config["developers"].values()
-        developers = []
-        for value_id in developer_ids:
-            developer = await self.bot.fetch_user(value_id)
-            developers.append(developer.mention)
+        # Fetched concurrently so startup tasks are not waiting on sequential HTTP calls
+        fetched = await asyncio.gather(*(self.bot.fetch_user(value_id) for value_id in developer_ids))
+        developers = [developer.mention for developer in fetched]
         if not developers:
             logger.critical(f"Developers ({developer_ids}) could not be found on discord!")
             self.developers = ["Unknown"]
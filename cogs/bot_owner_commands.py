@@ -1,11 +1,17 @@
+import time
 import logging
 import asyncio
+import cProfile
+import threading
 
 import discord
-from discord.ext import commands
+from discord.ext import commands, tasks
 
+from helpers import profiler, tracing
+from helpers.memory_tracker import MemoryTracker
 from helpers.misc import tail
 from helpers.paginator import Paginator
+from helpers.shutdown import GracefulShutdown
 from helpers.converters import license_duration
 from helpers.embed_handler import success, failure
 from helpers.licence_helper import construct_expiration_date
@@ -18,6 +24,36 @@ UPDATE_CHANNEL_ID = 625404542535598090
 class BotOwnerCommands(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
+        self._profiling = False
+        self.memory_tracker = MemoryTracker()
+        snapshot_interval = self.bot.config["memory_snapshot_interval_minutes"]
+        if snapshot_interval:
+            self.memory_snapshot_loop.change_interval(minutes=snapshot_interval)
+            self.memory_snapshot_loop.start()
+
+    def cog_unload(self):
+        self.memory_snapshot_loop.cancel()
+
+    @tasks.loop(minutes=60.0)
+    async def memory_snapshot_loop(self):
+        """Periodically logs allocation sites that grew the most since the previous periodic snapshot."""
+        if not self.memory_tracker.is_tracing():
+            self.memory_tracker.start()
+        previous = self.memory_tracker.snapshots.get("periodic")
+        current = await self.bot.loop.run_in_executor(None, self.memory_tracker.take_snapshot, "periodic")
+        if previous is None:
+            return
+
+        growers = await self.bot.loop.run_in_executor(None, self.memory_tracker.compare, previous, current, 10)
+        if growers:
+            growers = "\n".join(growers)
+            logger.info(f"Top memory growers since last periodic snapshot:\n{growers}")
+
+    @memory_snapshot_loop.before_loop
+    async def before_memory_snapshot_loop(self):
+        logger.info("Starting memory snapshot loop..")
+        await self.bot.wait_until_ready()
+        logger.info("Memory snapshot loop started!")
 
     @commands.command(hidden=True)
     @commands.is_owner()
@@ -39,13 +75,13 @@ class BotOwnerCommands(commands.Cog):
 
     @commands.command(hidden=True)
     @commands.is_owner()
-    async def disconnect(self, _ctx):
-        """Closes database connection and disconnects the bot.
+    async def disconnect(self, ctx):
+        """Drains in-flight work, closes database connection and disconnects the bot.
         Used for gracefully shutting it down in need of update.
         """
-        await self.bot.main_db.connection.commit()
-        await self.bot.main_db.connection.close()
-        logger.info("Database closed.")
+        shutdown = GracefulShutdown(self.bot, self.bot.config["shutdown_drain_seconds"])
+        report = await shutdown.run(ctx)
+        await ctx.send(embed=success(report, ctx.me))
         await self.bot.logout()
         logger.info("Disconnected.")
 
@@ -113,7 +149,7 @@ class BotOwnerCommands(commands.Cog):
     @commands.is_owner()
     async def show_log(self, ctx, lines: int = 100):
         """
-        Shows last n lines from log.txt
+        Shows last n lines from log file of this process.
 
         Max lines 10 000.
         Sends multiple messages at once if needed.
@@ -121,12 +157,256 @@ class BotOwnerCommands(commands.Cog):
         if lines > 10_000:
             lines = 10_000
 
-        log = "".join(tail(lines))
+        log = "".join(tail(lines, self.bot.log_file_handler.baseFilename))
         await Paginator.paginate(
             self.bot, ctx.author, ctx.author, log,
             title=f"Last {lines} log lines.\n\n", prefix="```DNS\n"
         )
 
+    @commands.command(hidden=True)
+    @commands.is_owner()
+    async def search_log(self, ctx, snowflake_id: int, max_lines: int = 500):
+        """
+        Shows log lines, from all retained logs, that contain passed ID (guild, member, role..).
+
+        Max lines 10 000, newest matches are shown.
+        Sends multiple messages at once if needed.
+        """
+        if max_lines > 10_000:
+            max_lines = 10_000
+
+        matches = await self.bot.loop.run_in_executor(
+            None, self.bot.log_file_handler.search, snowflake_id, max_lines
+        )
+        if not matches:
+            await ctx.send(embed=failure(f"No log lines found for {snowflake_id}."))
+            return
+
+        await Paginator.paginate(
+            self.bot, ctx.author, ctx.author, "".join(matches),
+            title=f"{len(matches)} log lines for {snowflake_id}.\n\n", prefix="```DNS\n"
+        )
+
+    @commands.command(hidden=True)
+    @commands.is_owner()
+    async def profile(self, ctx, seconds: int = 30, top: int = 30):
+        """
+        Runs cProfile on the event loop for n seconds.
+
+        Max seconds 600.
+        Saves .prof (pstats) and summary to profiles directory and sends summary in DM.
+        """
+        if self._profiling:
+            await ctx.send(embed=failure("Profiler is already running."))
+            return
+        seconds = min(seconds, 600)
+
+        self._profiling = True
+        profile = cProfile.Profile()
+        await ctx.send(embed=success(f"Profiling for {seconds}s..", ctx.me))
+        try:
+            # cProfile only profiles the thread that enabled it, in our case event loop thread
+            profile.enable()
+            await asyncio.sleep(seconds)
+        finally:
+            profile.disable()
+            self._profiling = False
+
+        summary, paths = await self.bot.loop.run_in_executor(None, profiler.save_cprofile, profile, top)
+        await self._send_profile_summary(ctx, summary, paths)
+
+    @commands.command(hidden=True)
+    @commands.is_owner()
+    async def sample_profile(self, ctx, seconds: int = 30, interval_ms: int = 5, top: int = 30):
+        """
+        Runs sampling profiler on the event loop thread for n seconds.
+
+        Lower overhead than profile command.
+        Max seconds 600, minimum interval 1ms.
+        Saves collapsed stacks (flamegraph input) and summary to profiles directory and sends summary in DM.
+        """
+        if self._profiling:
+            await ctx.send(embed=failure("Profiler is already running."))
+            return
+        seconds = min(seconds, 600)
+        interval_ms = max(interval_ms, 1)
+
+        self._profiling = True
+        sampler = profiler.SamplingProfiler(threading.get_ident(), interval_ms / 1000)
+        await ctx.send(embed=success(f"Sampling every {interval_ms}ms for {seconds}s..", ctx.me))
+        try:
+            sampler.start()
+            await asyncio.sleep(seconds)
+        finally:
+            sampler.stop()
+            self._profiling = False
+
+        summary, paths = await self.bot.loop.run_in_executor(None, profiler.save_sampling_profile, sampler, top)
+        await self._send_profile_summary(ctx, summary, paths)
+
+    async def _send_profile_summary(self, ctx, summary: str, paths: list):
+        logger.info(f"Profile saved to {', '.join(paths)}")
+        files = "\n".join(paths)
+        await Paginator.paginate(
+            self.bot, ctx.author, ctx.author, summary,
+            title=f"Saved:\n{files}\n\n", prefix="```DNS\n"
+        )
+
+    @commands.command(hidden=True)
+    @commands.is_owner()
+    async def trace_start(self, ctx, frames: int = 1):
+        """
+        Starts tracemalloc.
+
+        :param frames: number of frames stored per allocation (more frames = more overhead)
+        """
+        if self.memory_tracker.is_tracing():
+            await ctx.send(embed=failure("Already tracing."))
+            return
+        self.memory_tracker.start(frames)
+        await ctx.send(embed=success(f"Started tracing memory allocations with {frames} frame(s).", ctx.me))
+
+    @commands.command(hidden=True)
+    @commands.is_owner()
+    async def trace_stop(self, ctx):
+        """
+        Stops tracemalloc and drops all snapshots.
+
+        If memory_snapshot_interval_minutes is configured the next periodic snapshot starts tracing again.
+        """
+        self.memory_tracker.stop()
+        msg = "Stopped tracing memory allocations."
+        if self.memory_snapshot_loop.is_running():
+            msg += " Periodic snapshots will start it again."
+        await ctx.send(embed=success(msg, ctx.me))
+
+    @commands.command(hidden=True)
+    @commands.is_owner()
+    async def trace_snapshot(self, ctx, name: str):
+        """Takes named tracemalloc snapshot."""
+        if not self.memory_tracker.is_tracing():
+            await ctx.send(embed=failure("Not tracing, call trace_start first."))
+            return
+        await self.bot.loop.run_in_executor(None, self.memory_tracker.take_snapshot, name)
+        msg = (
+            f"Snapshot **{name}** taken.\n"
+            f"{self.memory_tracker.traced_memory()}\n"
+            f"Snapshots: {', '.join(self.memory_tracker.snapshot_names())}"
+        )
+        await ctx.send(embed=success(msg, ctx.me))
+
+    @commands.command(hidden=True)
+    @commands.is_owner()
+    async def trace_diff(self, ctx, old_name: str, new_name: str, top: int = 25):
+        """Shows allocation sites (file:line) that grew the most between two named snapshots."""
+        try:
+            growers = await self.bot.loop.run_in_executor(None, self.memory_tracker.diff, old_name, new_name, top)
+        except KeyError as e:
+            await ctx.send(embed=failure(f"Snapshot {e} not found."))
+            return
+
+        if not growers:
+            await ctx.send(embed=success(f"Nothing grew between **{old_name}** and **{new_name}**.", ctx.me))
+            return
+
+        await Paginator.paginate(
+            self.bot, ctx.author, ctx.author, "\n".join(growers),
+            title=f"Top {len(growers)} growers from {old_name} to {new_name}.\n\n", prefix="```DNS\n"
+        )
+
+    @commands.command(hidden=True)
+    @commands.is_owner()
+    async def slow_traces(self, ctx, count: int = 10, *, name: str = None):
+        """
+        Shows slowest recent command/expiry pass traces broken down by stage.
+
+        :param name: only show traces of this command, example: slow_traces 5 redeem
+        """
+        traces = tracing.slowest(count, name)
+        if not traces:
+            await ctx.send(embed=failure("No traces recorded yet."))
+            return
+
+        breakdowns = "\n\n".join(tracing.format_trace(trace) for trace in traces)
+        await Paginator.paginate(
+            self.bot, ctx.author, ctx.author, breakdowns,
+            title=f"Slowest {len(traces)} of last {len(tracing.recent_traces)} traces.\n\n", prefix="```DNS\n"
+        )
+
+    @commands.command(hidden=True)
+    @commands.is_owner()
+    async def export_traces(self, ctx):
+        """Saves all recent traces to traces directory in Chrome trace event format."""
+        traces = list(tracing.recent_traces)
+        if not traces:
+            await ctx.send(embed=failure("No traces recorded yet."))
+            return
+
+        path = await self.bot.loop.run_in_executor(None, tracing.export, traces)
+        logger.info(f"Traces saved to {path}")
+        await ctx.send(embed=success(f"Saved {len(traces)} traces to {path}", ctx.me))
+
+    @commands.command(hidden=True)
+    @commands.is_owner()
+    async def query_stats(self, ctx, sort_by: str = "total", top: int = 15):
+        """
+        Shows database statements that took the most time since start.
+
+        :param sort_by: total, p99, max or count
+        """
+        database = self.bot.main_db
+        try:
+            worst = database.query_stats.format_worst(top, sort_by)
+        except ValueError as e:
+            await ctx.send(embed=failure(str(e)))
+            return
+
+        if not worst:
+            await ctx.send(embed=failure("No queries recorded yet."))
+            return
+
+        threshold = database.slow_query_threshold
+        slow_log = "disabled" if threshold is None else f"over {threshold * 1000:.0f}ms"
+        await Paginator.paginate(
+            self.bot, ctx.author, ctx.author, worst,
+            title=f"Top {top} statements by {sort_by}, slow query log {slow_log}.\n\n", prefix="```DNS\n"
+        )
+
+    @commands.command(hidden=True)
+    @commands.is_owner()
+    async def subscription_report(self, ctx, top: int = 10):
+        """
+        Shows active subscriptions, how many expire soon and guilds with most subscriptions.
+
+        Answered from in-memory subscription columns when they are enabled, from database otherwise.
+        """
+        database = self.bot.main_db
+        start = time.perf_counter()
+        total = await database.get_licensed_roles_total_count()
+        expiring_hour = await database.get_expiring_count(1)
+        expiring_day = await database.get_expiring_count(24)
+        expiring_week = await database.get_expiring_count(24 * 7)
+        top_guilds = await database.get_top_licensed_guilds(top)
+        duration = time.perf_counter() - start
+
+        columns = database.subscription_columns
+        if columns is None:
+            source = "database"
+        else:
+            source = f"memory columns ({'NumPy' if columns.vectorized else 'no NumPy'})"
+        guild_lines = "\n".join(f"{guild_id:<20} {count:>10,}" for guild_id, count in top_guilds)
+        message = (
+            f"Active subscriptions: {total:,}\n"
+            f"Expiring in next hour: {expiring_hour:,}\n"
+            f"Expiring in next 24h: {expiring_day:,}\n"
+            f"Expiring in next 7 days: {expiring_week:,}\n\n"
+            f"Top {top} guilds:\n{guild_lines}\n\n"
+            f"Computed from {source} in {duration * 1000:.1f}ms"
+        )
+        await Paginator.paginate(
+            self.bot, ctx.author, ctx.author, message, title="Subscription report\n\n", prefix="```DNS\n"
+        )
+
     @commands.command()
     @commands.is_owner()
     async def valid(self, ctx, license: str):
@@ -139,16 +419,18 @@ class BotOwnerCommands(commands.Cog):
     @commands.command(hidden=True)
     @commands.is_owner()
     async def guilds_diagnostic(self, ctx):
-        loaded_guilds = tuple(guild.id for guild in self.bot.guilds)
-        db_guilds = await self.bot.main_db.get_all_guild_ids()
-        difference = set(loaded_guilds).symmetric_difference(set(db_guilds))
-        difference = None if len(difference) == 0 else difference
+        unregistered, not_loaded = await self.bot.guild_database_diff()
         message = (
-            f"Loaded guilds: {len(loaded_guilds)}\n"
-            f"Database guilds: {len(db_guilds)}\n"
-            f"Difference: {difference}"
+            f"Loaded guilds: {len(self.bot.guilds)}\n"
+            f"Not registered in database: {len(unregistered)}\n"
+            f"Registered but not loaded: {len(not_loaded)}\n\n"
+            f"Not registered: {unregistered or None}\n"
+            f"Not loaded: {not_loaded or None}"
+        )
+        await Paginator.paginate(
+            self.bot, ctx.author, ctx.author, message,
+            title="Guilds diagnostic\n\n", prefix="```DNS\n"
         )
-        await ctx.send(embed=success(message, ctx.me))
 
     @commands.command(hidden=True)
     @commands.is_owner()
@@ -185,6 +467,9 @@ class BotOwnerCommands(commands.Cog):
         prefix, role_id, expiration = await self.bot.main_db.get_guild_info(guild_id)
         stored_license_count = await self.bot.main_db.get_guild_license_total_count(guild_id)
         active_license_count = await self.bot.main_db.get_guild_licensed_roles_total_count(guild_id)
+        ended_counts = {}
+        for _month, reason, count in await self.bot.main_db.get_guild_history_counts(guild_id, 3):
+            ended_counts[reason] = ended_counts.get(reason, 0) + count
 
         if role_id is None:
             role_id = "**Not set!**"
@@ -195,7 +480,11 @@ class BotOwnerCommands(commands.Cog):
             f"Default license role: {role_id}\n"
             f"Default license expiration time: **{expiration}h**\n"
             f"Stored licenses: **{stored_license_count}**\n"
-            f"Active role subscriptions: **{active_license_count}**")
+            f"Active role subscriptions: **{active_license_count}**\n"
+            f"Ended subscriptions in last 3 months: "
+            f"expired **{ended_counts.get(self.bot.main_db.HISTORY_EXPIRED, 0)}**, "
+            f"revoked **{ended_counts.get(self.bot.main_db.HISTORY_REVOKED, 0)}**, "
+            f"role removed **{ended_counts.get(self.bot.main_db.HISTORY_ROLE_REMOVED, 0)}**")
 
         await ctx.send(embed=success(f"{db_msg}\n\n{loaded_msg}", ctx.me))
 
@@ -6,8 +6,8 @@ from asyncio import TimeoutError
 from discord.ext import commands
 from discord.errors import Forbidden
 
-from helpers.embed_handler import failure
-from helpers.errors import RoleNotFound, DefaultGuildRoleNotSet, DatabaseMissingData
+from helpers.embed_handler import failure, warning
+from helpers.errors import RoleNotFound, DefaultGuildRoleNotSet, DatabaseMissingData, BotBusy
 
 
 logger = logging.getLogger(__name__)
@@ -87,6 +87,11 @@ class CmdErrors(commands.Cog):
                 pass
             return
 
+        if isinstance(error, BotBusy):
+            # Has to be before CheckFailure since it's a subclass of it
+            await ctx.send(embed=warning(error.message))
+            return
+
         if isinstance(error, commands.CheckFailure):
             await ctx.send(embed=failure("You do not have permission to use this command."))
             return
@@ -1,9 +1,12 @@
 import logging
+from datetime import datetime
 
 import discord
 from discord.ext import commands
 from aiosqlite import IntegrityError
 
+from helpers.paginator import Paginator
+from helpers.admission import low_priority
 from helpers.converters import license_duration
 from helpers.embed_handler import success, failure
 
@@ -17,15 +20,15 @@ class Guild(commands.Cog):
         self.bot.loop.create_task(self.startup_guild_database_check())
 
     async def startup_guild_database_check(self):
-        db_guilds_ids = await self.bot.main_db.get_all_guild_ids()
         logger.info("Starting database guild checkup..")
         await self.bot.wait_until_ready()
         # Checks for new guilds
-        for guild in self.bot.guilds:
-            if guild.id not in db_guilds_ids:
-                logger.info(f"Guild {guild.id} {guild} found but not registered. "
-                            f"Adding entry to database.")
-                await self.bot.main_db.setup_new_guild(guild.id, self.bot.config["default_prefix"])
+        unregistered_guild_ids, _ = await self.bot.guild_database_diff()
+        if unregistered_guild_ids:
+            logger.info(f"Found {len(unregistered_guild_ids):,} guilds that are not registered. "
+                        f"Adding entries to database.")
+            logger.debug(f"Unregistered guilds: {unregistered_guild_ids}")
+            await self.bot.main_db.setup_new_guilds(unregistered_guild_ids, self.bot.config["default_prefix"])
 
         # Do not code the other way around
         # aka deleting database data if the guild in database doesn't exist in bot guilds
@@ -106,6 +109,7 @@ class Guild(commands.Cog):
         prefix, role_id, expiration = await self.bot.main_db.get_guild_info(ctx.guild.id)
         stored_license_count = await self.bot.main_db.get_guild_license_total_count(ctx.guild.id)
         active_license_count = await self.bot.main_db.get_guild_licensed_roles_total_count(ctx.guild.id)
+        expiring_count = await self.bot.main_db.get_expiring_count(24, ctx.guild.id)
 
         # If the bot just joined the guild it can happen that the default license role is not set.
         if role_id is not None:
@@ -136,11 +140,67 @@ class Guild(commands.Cog):
             f"Default license role: {default_license_role}\n"
             f"Default license expiration time: **{expiration}h**\n\n"
             f"Stored licenses: **{stored_license_count}**\n"
-            f"Active role subscriptions: **{active_license_count}**"
+            f"Active role subscriptions: **{active_license_count}**\n"
+            f"Expiring in next 24h: **{expiring_count}**"
         )
 
         await ctx.send(embed=success(msg, ctx.me))
 
+    @commands.command()
+    @commands.cooldown(1, 10, commands.BucketType.guild)
+    @commands.has_permissions(administrator=True)
+    @commands.guild_only()
+    @low_priority()
+    async def stats(self, ctx, days: int = 7, role: discord.Role = None):
+        """
+        Shows redeemed, expired, revoked, role removed and generated subscriptions over time.
+
+        Role removed are subscriptions that ended because their role was removed without the revoke command.
+
+        Shows last 7 days if days is not passed, maximum is 90.
+        Up to 2 days are shown per hour, more per day.
+        If role is passed only subscriptions of that role are counted.
+
+        """
+        if not 1 <= days <= 90:
+            await ctx.send(embed=failure("Days have to be between 1 and 90!"))
+            return
+        bucket_hours = 1 if days <= 2 else 24
+        rollups = await self.bot.main_db.get_guild_rollups(ctx.guild.id, days * 24, bucket_hours,
+                                                           None if role is None else role.id)
+        if not rollups:
+            await ctx.send(embed=failure(f"Nothing happened in the last {days} days."))
+            return
+
+        title = (f"Subscriptions in guild '{ctx.guild.name}'"
+                 f"{f' for role {role.name}' if role is not None else ''}, last {days} days:\n\n")
+        await Paginator.paginate(self.bot, ctx.author, ctx, Guild.draw_rollups(rollups, bucket_hours), title=title)
+
+    @staticmethod
+    def draw_rollups(rollups, bucket_hours: int, bar_width: int = 20) -> str:
+        """
+        :param rollups: list of tuples (bucket start epoch, redeemed, expired, revoked, role removed, generated)
+        :param bucket_hours: 1 labels rows with hours, else with days
+        :return: table with a bar of redeemed (+) and ended (-) subscriptions per row
+        """
+        time_format = "%m-%d %H:00" if bucket_hours == 1 else "%Y-%m-%d"
+        largest = max(max(row[1], row[2] + row[3] + row[4]) for row in rollups) or 1
+        lines = [f"{'Time':<11} {'Redeemed':>8} {'Expired':>8} {'Revoked':>8} {'Removed':>8} {'Generated':>9}"]
+        totals = [0, 0, 0, 0, 0]
+        for start, *counts in rollups:
+            # Rollup epochs are server local time stored as UTC, see DatabaseHandler._current_epoch
+            label = datetime.utcfromtimestamp(start).strftime(time_format)
+            bar = "+" * round(counts[0] / largest * bar_width)
+            bar += "-" * round((counts[1] + counts[2] + counts[3]) / largest * bar_width)
+            lines.append(f"{label:<11} {Guild._format_counts(counts)} {bar}")
+            totals = [total + count for total, count in zip(totals, counts)]
+        lines.append(f"{'Total':<11} {Guild._format_counts(totals)}")
+        return "\n".join(lines)
+
+    @staticmethod
+    def _format_counts(counts) -> str:
+        return f"{counts[0]:>8,} {counts[1]:>8,} {counts[2]:>8,} {counts[3]:>8,} {counts[4]:>9,}"
+
 
 def setup(bot):
     bot.add_cog(Guild(bot))
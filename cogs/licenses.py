@@ -1,34 +1,65 @@
+import time
 import logging
 from datetime import datetime
+from typing import Set, Tuple
 
-import texttable
 import discord.utils
-from dateutil import parser
 from aiosqlite import IntegrityError
 from discord.errors import Forbidden
 from discord.ext import commands, tasks
 
-from helpers import misc
+from helpers import misc, metrics, tracing
+from helpers.misc import lazy_import
 from helpers.paginator import Paginator
+from helpers.admission import low_priority
 from helpers.converters import positive_integer, license_duration
 from helpers.errors import RoleNotFound, DatabaseMissingData, GuildNotFound
 from helpers.embed_handler import success, warning, failure, info, simple_embed
 from helpers.licence_helper import construct_expiration_date, get_remaining_time, get_current_time
 
 logger = logging.getLogger(__name__)
+# Only needed by expiry loop and table commands
+parser = lazy_import("dateutil.parser")
+texttable = lazy_import("texttable")
 
 
 class LicenseHandler(commands.Cog):
+    # Expired rows are moved to history in transactions of this many rows
+    ARCHIVE_BATCH_SIZE = 500
+
     def __init__(self, bot):
         self.bot = bot
-        self.license_check.start()
+        self.expiry_pass_running = False
+        # (member id, role id) of licensed roles the bot itself is removing and archives with their own
+        # reason, on_member_update ignores role removal events they cause
+        self.removing_roles: Set[Tuple[int, int]] = set()
+        # Only the database writer schedules expiry, other clusters run their pass when told to
+        if self.bot.cluster.is_writer:
+            self.license_check.start()
+        else:
+            self.bot.cluster.add_listener("expiry_pass", self.run_expiry_pass)
 
     @tasks.loop(seconds=60.0)
     async def license_check(self):
+        await self.bot.cluster.broadcast("expiry_pass")
+        await self.run_expiry_pass()
+
+    async def run_expiry_pass(self):
+        if self.bot.shutting_down:
+            return
+        if self.expiry_pass_running:
+            logger.warning("Previous expiry pass is still running, skipping this one.")
+            return
+        self.expiry_pass_running = True
+        self.bot.traffic_recorder.record_expiry_pass()
+        trace = tracing.start_trace()
         try:
             await self.check_all_active_licenses()
         except Exception as e:
             logger.critical(e)
+        finally:
+            self.expiry_pass_running = False
+            tracing.finish_trace(trace, "expiry pass")
 
     @license_check.before_loop
     async def before_printer(self):
@@ -41,37 +72,90 @@ class LicenseHandler(commands.Cog):
         Checks all active member licenses in database and if license is expired then remove
         the role from member and send some message.
 
-        TODO: Move query to database handler
+        Per row messages are logged at debug level, the pass itself logs one summary line.
+        When clustered only guilds from shards of this process are checked.
         """
-        async with self.bot.main_db.connection.execute("SELECT * FROM LICENSED_MEMBERS") as cursor:
-            async for row in cursor:
-                member_id = int(row[0])
-                member_guild_id = int(row[1])
-                expiration_date = parser.parse(row[2])
-                licensed_role_id = int(row[3])
-                if await LicenseHandler.has_license_expired(expiration_date):
-                    logger.info(f"Expired license for member:{member_id} role:{licensed_role_id} guild:{member_guild_id}")
-                    try:
-                        await self.remove_role(member_id, member_guild_id, licensed_role_id)
-                    except RoleNotFound as e1:
-                        logger.warning(e1)
-                        logger.warning(f"Role expired but can't be removed from member because he doesn't have it! "
-                                       f"Someone must have manually removed it before it expired.\t"
-                                       f"Member ID:{member_id}, guild ID:{member_guild_id}, role ID:{licensed_role_id}"
-                                       f"Continuing to db entry removal...")
-                    except GuildNotFound as e2:
-                        # If guild is not found log it and continue to guild database deletion
-                        logger.warning(e2)
-                        logger.warning(f"Guild {member_guild_id} saved in database but not found in bot guilds!"
-                                       "Removing all entries of it from database!")
+        start = time.monotonic()
+        expired_count = 0
+        missing_role_count = 0
+        left_guild_count = 0
+        failed_count = 0
+        expired_guild_ids = set()
+        expired_rows = []
+        async for row in self.bot.main_db.iterate_licensed_members():
+            member_id = int(row[0])
+            member_guild_id = int(row[1])
+            if not self.bot.owns_guild(member_guild_id):
+                # Guild is handled by another cluster
+                continue
+            expiration_date = parser.parse(row[2])
+            licensed_role_id = int(row[3])
+            if await LicenseHandler.has_license_expired(expiration_date):
+                logger.debug("Expired license for member:%s role:%s guild:%s",
+                             member_id, licensed_role_id, member_guild_id)
+                try:
+                    with tracing.span("expiry remove role"):
+                        removed = await self.remove_role(member_id, member_guild_id, licensed_role_id)
+                    if not removed:
+                        left_guild_count += 1
+                except RoleNotFound as e1:
+                    # Someone must have manually removed it before it expired, continue to db entry removal
+                    logger.debug("%s Member ID:%s, guild ID:%s, role ID:%s",
+                                 e1.message, member_id, member_guild_id, licensed_role_id)
+                    missing_role_count += 1
+                except GuildNotFound as e2:
+                    # If guild is not found log it and continue to guild database deletion
+                    logger.warning(e2)
+                    logger.warning(f"Guild {member_guild_id} saved in database but not found in bot guilds!"
+                                   "Removing all entries of it from database!")
+                    with tracing.span("expiry remove guild data"):
                         await self.bot.main_db.remove_all_guild_data(member_guild_id, guild_table_too=True)
-                        logger.info(f"Successfully deleted all database data for guild {member_guild_id}")
-                        continue
-                    except Exception as e3:
-                        logger.warning(f"Can't remove role {licensed_role_id } from member {member_id } guild {member_guild_id }, ignoring error: {e3}")
-                        continue
-                    await self.bot.main_db.delete_licensed_member(member_id, licensed_role_id)
-                    logger.info(f"Role {licensed_role_id} successfully removed from member:{member_id}")
+                    logger.info(f"Successfully deleted all database data for guild {member_guild_id}")
+                    continue
+                except Exception as e3:
+                    logger.debug("Can't remove role %s from member %s guild %s, ignoring error: %s",
+                                 licensed_role_id, member_id, member_guild_id, e3)
+                    failed_count += 1
+                    continue
+                expired_rows.append((member_id, licensed_role_id))
+                if len(expired_rows) >= self.ARCHIVE_BATCH_SIZE:
+                    await self.archive_expired(expired_rows)
+                    expired_rows = []
+                expired_count += 1
+                expired_guild_ids.add(member_guild_id)
+        if expired_rows:
+            await self.archive_expired(expired_rows)
+
+        duration = time.monotonic() - start
+        metrics.expiry_pass_duration.observe(duration)
+        metrics.expiry_backlog.set(failed_count)
+        metrics.subscriptions_expired.inc(amount=expired_count)
+        if expired_count or failed_count:
+            logger.info(
+                f"Expired {expired_count:,} subscriptions in {len(expired_guild_ids):,} guilds in {duration:.1f}s "
+                f"(role already missing: {missing_role_count:,}, member left: {left_guild_count:,}, "
+                f"failed: {failed_count:,})",
+                extra={
+                    "expired": expired_count,
+                    "guilds": len(expired_guild_ids),
+                    "duration": round(duration, 3),
+                    "role_missing": missing_role_count,
+                    "member_left": left_guild_count,
+                    "failed": failed_count
+                }
+            )
+
+    async def archive_expired(self, rows):
+        """
+        Moves expired rows to subscription history.
+        If the pass fails before rows are archived they stay in database and the next pass archives them.
+        :param rows: list of tuples (member id, licensed role id)
+        """
+        try:
+            with tracing.span("expiry archive rows"):
+                await self.bot.main_db.archive_licensed_members(rows, self.bot.main_db.HISTORY_EXPIRED)
+        finally:
+            self.removing_roles.difference_update(rows)
 
     @staticmethod
     async def has_license_expired(expiration_date: datetime) -> bool:
@@ -87,7 +171,7 @@ class LicenseHandler(commands.Cog):
         else:
             return False
 
-    async def remove_role(self, member_id, guild_id, licensed_role_id):
+    async def remove_role(self, member_id, guild_id, licensed_role_id) -> bool:
         """
         Removes the specified role from member based on @params
 
@@ -98,37 +182,35 @@ class LicenseHandler(commands.Cog):
         :raise RoleNotFound: if roles to be removed isn't in member roles (case when in db it's saved but someone
                 manually removed their role so when db role expires and needs to be removed there is nothing to be
                 removed)
+        :return: True if role was removed, False if member has left the guild
         """
         guild = self.bot.get_guild(guild_id)
         if guild is None:
             raise GuildNotFound(f"Fatal exception. "
                                 f"Guild **{guild_id}** loaded from database cannot be found in bot guilds!")
 
-        # Temporal fix for intents, waiting for Discord to approve them so the bot can cache members as usual
-        # member = guild.get_member(member_id)
-        try:
-            member = await guild.fetch_member(member_id)
-        except (Forbidden, discord.HTTPException):
-            member = None
+        member = await self.bot.member_cache.get_member(guild, member_id)
 
-        # If member has left the guild just return
+        # If member has left the guild just return, caller counts these in expiry summary
         if member is None:
-            logger.warning(f"Can't remove licensed role {licensed_role_id} from member {member_id} "
-                           f"because he has left the guild {licensed_role_id} ({guild.name}).")
-            return
+            logger.debug("Can't remove licensed role %s from member %s because he has left the guild %s (%s).",
+                         licensed_role_id, member_id, guild_id, guild.name)
+            return False
 
         member_role = discord.utils.get(member.roles, id=licensed_role_id)
         if member_role is None:
             raise RoleNotFound(f"Can't remove licensed role {member_role} for {member.mention}."
                                f"Role not found ")
         else:
-            await member.remove_roles(member_role)
+            # Archived as expired by the pass, discarded from removing_roles then
+            await self._remove_own_role(member, member_role)
             try:
                 expired = f"Your license in guild **{guild}** has expired for the following role: **{member_role}** "
                 await member.send(embed=simple_embed(expired, "Notification", discord.Colour.blue()))
             except Forbidden:
                 # Ignore if user has blocked DM
                 pass
+            return True
 
     @commands.Cog.listener()
     async def on_guild_join(self, guild):
@@ -156,8 +238,30 @@ class LicenseHandler(commands.Cog):
     async def on_member_update(self, before, after):
         if len(before.roles) > len(after.roles):
             removed_roles_list = list(set(before.roles) - set(after.roles))
-            for role in removed_roles_list:
-                await self.bot.main_db.delete_licensed_member(before.id, role.id)
+            removed = [(before.id, role.id) for role in removed_roles_list]
+            # Roles removed by the bot are archived with their own reason by whatever removed them
+            removed = [pair for pair in removed if pair not in self.removing_roles]
+            if removed:
+                await self.bot.main_db.archive_licensed_members(removed, self.bot.main_db.HISTORY_ROLE_REMOVED)
+
+    async def _remove_own_role(self, member, role):
+        """
+        Removes param role from param member and marks it as removed by the bot until caller archives it.
+        :raise: whatever remove_roles raises, the mark is dropped then
+        """
+        self.removing_roles.add((member.id, role.id))
+        try:
+            await member.remove_roles(role)
+        except Exception:
+            self.removing_roles.discard((member.id, role.id))
+            raise
+
+    async def _archive_revoked(self, member, role_id: int):
+        """Archives subscription as revoked, after its role was removed by _remove_own_role."""
+        try:
+            await self.bot.main_db.archive_licensed_members([(member.id, role_id)], self.bot.main_db.HISTORY_REVOKED)
+        finally:
+            self.removing_roles.discard((member.id, role_id))
 
     @commands.command()
     @commands.bot_has_permissions(manage_roles=True)
@@ -178,8 +282,8 @@ class LicenseHandler(commands.Cog):
             return
 
         # First remove the role from member because this can fail in case of changed role hierarchy.
-        await member.remove_roles(role)
-        await self.bot.main_db.delete_licensed_member(member.id, role.id)
+        await self._remove_own_role(member, role)
+        await self._archive_revoked(member, role.id)
         msg = f"Successfully revoked subscription for {role.mention} from {member.mention}"
         await ctx.send(embed=success(msg, ctx.me))
         logger.info(f"{ctx.author} is revoking subscription for role {role} from member {member} in guild {ctx.guild}")
@@ -205,13 +309,14 @@ class LicenseHandler(commands.Cog):
                 logger.info(f"'revoke_all' called in guild {ctx.guild} and role that's loaded from database with "
                             f"ID:{role_id} cannot be removed from {member} because it doesn't exist in guild anymore! "
                             f"Continuing to removal from database.")
-                await self.bot.main_db.delete_licensed_member(member.id, role_id)
+                await self.bot.main_db.archive_licensed_members([(member.id, role_id)],
+                                                                self.bot.main_db.HISTORY_REVOKED)
                 count += 1
             else:
                 try:
                     # First remove the role from member because this can fail in case of changed role hierarchy.
-                    await member.remove_roles(role)
-                    await self.bot.main_db.delete_licensed_member(member.id, role_id)
+                    await self._remove_own_role(member, role)
+                    await self._archive_revoked(member, role_id)
                     count += 1
                 except Forbidden as e:
                     msg = (f"Can't remove {role.mention} from {member.mention}, no permissions to manage that role as "
@@ -287,7 +392,7 @@ class LicenseHandler(commands.Cog):
 
         # Passed member can be a user if redeem was activated in dm, so get the member
         if ctx.guild is None:
-            member = guild.get_member(member.id)
+            member = await self.bot.member_cache.get_member(guild, member.id)
             if member is None:
                 await ctx.send(embed=failure("You are no longer it the guild you're trying to activate license!"))
                 return
@@ -358,7 +463,8 @@ class LicenseHandler(commands.Cog):
             except IntegrityError:
                 # We remove the database entry because when role was remove the bot was
                 # probably offline and couldn't register the role remove event
-                await self.bot.main_db.delete_licensed_member(member.id, role_id)
+                await self.bot.main_db.archive_licensed_members([(member.id, role_id)],
+                                                                self.bot.main_db.HISTORY_ROLE_REMOVED)
                 await self.bot.main_db.add_new_licensed_member(member.id, guild.id, expiration_date, role_id)
                 msg = (f"Someone removed the role manually from {member.mention} but no worries,\n"
                        "since the license is valid we're just gonna reactivate it :)")
@@ -448,6 +554,7 @@ class LicenseHandler(commands.Cog):
         else:
             generated = await self.bot.main_db.generate_guild_licenses(num, guild_id, license_role.id, license_duration)
 
+        self.bot.member_cache.mark_licensed(guild_id)
         count_generated = len(generated)
         ctx_msg = (f"Successfully generated {count_generated} licenses for role {license_role.mention}"
                    f" in duration of {license_duration}h.\n"
@@ -472,6 +579,7 @@ class LicenseHandler(commands.Cog):
     @commands.cooldown(1, 10, commands.BucketType.guild)
     @commands.has_permissions(administrator=True)
     @commands.guild_only()
+    @low_priority()
     async def licenses(self, ctx, license_role: discord.Role = None):
         """
         Shows all licenses for a role in DM.
@@ -519,6 +627,7 @@ class LicenseHandler(commands.Cog):
     @commands.cooldown(1, 10, commands.BucketType.guild)
     @commands.has_permissions(administrator=True)
     @commands.guild_only()
+    @low_priority()
     async def random_license(self, ctx, number: int = 10):
         """
         Shows random guild licenses in DM.
@@ -560,6 +669,7 @@ class LicenseHandler(commands.Cog):
 
     @commands.command(aliases=["data"])
     @commands.guild_only()
+    @low_priority()
     async def member_data(self, ctx, member: discord.Member = None):
         """
         Shows active subscriptions of member.
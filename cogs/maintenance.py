@@ -0,0 +1,209 @@
+import time
+import asyncio
+import logging
+from typing import Union
+
+from discord.ext import commands, tasks
+
+from helpers import backup, metrics
+from helpers.embed_handler import success, failure
+
+
+logger = logging.getLogger(__name__)
+
+
+class Maintenance(commands.Cog):
+    """
+    Database upkeep that runs in the background, only on the database writer when clustered.
+
+    Backups are taken every database_backup interval_hours (0 disables the schedule, backup command
+    still works). A restart doesn't cause an extra backup, schedule is based on age of the newest backup.
+
+    Maintenance pass runs every database_maintenance interval_minutes but only when the bot is quiet
+    (no commands running, no expiry pass, no load shedding pressure). It records page and freelist
+    sizes, drops subscription history months older than history_keep_months (0 keeps all), returns
+    free pages to the file system with incremental vacuum in small steps and refreshes query planner
+    statistics with PRAGMA optimize.
+    """
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.settings = self.bot.config["database_backup"]
+        self.maintenance_settings = self.bot.config["database_maintenance"]
+        self.backup_running = False
+        self.maintenance_running = False
+        if self.bot.cluster.is_writer:
+            if self.settings["interval_hours"]:
+                self.backup_loop.start()
+            if self.maintenance_settings["interval_minutes"]:
+                self.maintenance_loop.change_interval(minutes=self.maintenance_settings["interval_minutes"])
+                self.maintenance_loop.start()
+
+    def cog_unload(self):
+        self.backup_loop.cancel()
+        self.maintenance_loop.cancel()
+
+    @tasks.loop(minutes=10.0)
+    async def backup_loop(self):
+        age = backup.latest_backup_age(self.settings["directory"], self.bot.main_db.db_name)
+        if age is not None and age < self.settings["interval_hours"] * 3600:
+            return
+        try:
+            await self.make_backup()
+        except Exception as e:
+            logger.critical(f"Scheduled database backup failed: {e}")
+
+    @backup_loop.before_loop
+    async def before_backup_loop(self):
+        logger.info("Starting database backup loop..")
+        await self.bot.wait_until_ready()
+        logger.info("Database backup loop started!")
+
+    async def make_backup(self) -> str:
+        """
+        Backs up main database and prunes old backups.
+        :return: str description of the backup
+        :raise: RuntimeError if a backup is already running
+        """
+        if self.backup_running:
+            raise RuntimeError("Backup is already running.")
+        self.backup_running = True
+        database = self.bot.main_db
+        directory = self.settings["directory"]
+        try:
+            path, size, duration, steps = await self.bot.loop.run_in_executor(
+                None, backup.run_backup, database.path, directory, database.db_name,
+                self.settings["pages_per_step"], self.settings["step_sleep_seconds"], self.settings["compress"]
+            )
+            # At least the backup that was just made is kept
+            deleted = await self.bot.loop.run_in_executor(
+                None, backup.prune, directory, database.db_name, max(self.settings["keep"], 1)
+            )
+        finally:
+            self.backup_running = False
+
+        description = (f"Backed up to {path} in {duration:.1f}s ({steps} steps), size {size / 1024 / 1024:.2f}MB. "
+                       f"Pruned {len(deleted)} old backups.")
+        logger.info(description)
+        return description
+
+    @tasks.loop(minutes=30.0)
+    async def maintenance_loop(self):
+        busy_reason = self.busy_reason()
+        if busy_reason is not None:
+            logger.info(f"Skipping database maintenance, bot is busy: {busy_reason}")
+            return
+        try:
+            await self.run_maintenance()
+        except Exception as e:
+            logger.critical(f"Database maintenance failed: {e}")
+
+    @maintenance_loop.before_loop
+    async def before_maintenance_loop(self):
+        logger.info("Starting database maintenance loop..")
+        await self.bot.wait_until_ready()
+        logger.info("Database maintenance loop started!")
+
+    def busy_reason(self) -> Union[str, None]:
+        """
+        :return: string describing what the bot is doing or None if it's quiet
+        """
+        if self.bot.shutting_down:
+            return "shutting down"
+        if self.bot.commands_in_flight:
+            return f"{len(self.bot.commands_in_flight)} commands running"
+        licenses = self.bot.get_cog("LicenseHandler")
+        if licenses is not None and licenses.expiry_pass_running:
+            return "expiry pass running"
+        if self.backup_running:
+            return "backup running"
+        writes_in_flight = self.bot.cluster.writes_in_flight
+        if writes_in_flight:
+            return f"{writes_in_flight} forwarded database writes"
+        return self.bot.admission_controller.pressure_reason()
+
+    async def run_maintenance(self, stop_when_busy: bool = True) -> str:
+        """
+        Vacuums free pages in steps until there are none left, the time budget is used up or
+        the bot stops being quiet, then runs PRAGMA optimize.
+        :param stop_when_busy: stop vacuuming once the bot is not quiet anymore
+        :return: str description of what was done
+        :raise: RuntimeError if maintenance is already running
+        """
+        if self.maintenance_running:
+            raise RuntimeError("Maintenance is already running.")
+        self.maintenance_running = True
+        try:
+            return await self._run_maintenance(stop_when_busy)
+        finally:
+            self.maintenance_running = False
+
+    async def _run_maintenance(self, stop_when_busy: bool) -> str:
+        database = self.bot.main_db
+        settings = self.maintenance_settings
+        start = time.monotonic()
+        dropped_months = []
+        if settings["history_keep_months"]:
+            dropped_months = await database.prune_subscription_history(settings["history_keep_months"])
+        # Dropped history tables are counted in free pages so they get vacuumed right away
+        page_size, page_count, free_pages = await database.get_page_stats()
+        initial_page_count, initial_free_pages = page_count, free_pages
+        vacuum_steps = 0
+        stop_reason = None
+        if free_pages >= settings["min_free_pages"]:
+            while free_pages:
+                await database.incremental_vacuum(settings["vacuum_pages_per_step"])
+                vacuum_steps += 1
+                page_size, page_count, free_pages = await database.get_page_stats()
+                if time.monotonic() - start > settings["max_vacuum_seconds"]:
+                    stop_reason = "time budget used up"
+                    break
+                # Lets commands run between steps
+                await asyncio.sleep(settings["vacuum_step_pause_seconds"])
+                stop_reason = self.busy_reason() if stop_when_busy else None
+                if stop_reason is not None:
+                    break
+        await database.optimize()
+        metrics.database_pages.set(page_count)
+        metrics.database_free_pages.set(free_pages)
+
+        fragmentation = initial_free_pages / initial_page_count if initial_page_count else 0
+        description = (
+            f"Database maintenance done in {time.monotonic() - start:.1f}s: "
+            f"{initial_page_count:,} pages ({initial_free_pages:,} free, {fragmentation:.1%}) -> "
+            f"{page_count:,} pages ({free_pages:,} free), "
+            f"file {initial_page_count * page_size / 1024 / 1024:.1f}MB -> "
+            f"{page_count * page_size / 1024 / 1024:.1f}MB "
+            f"in {vacuum_steps} vacuum steps, dropped {len(dropped_months)} history months"
+            f"{f', stopped early: {stop_reason}' if stop_reason else ''}."
+        )
+        logger.info(description)
+        return description
+
+    @commands.command(name="backup", hidden=True)
+    @commands.is_owner()
+    async def backup_command(self, ctx):
+        """Backs up main database right away, same as scheduled backup."""
+        await ctx.send(embed=success("Backing up database..", ctx.me))
+        try:
+            description = await self.make_backup()
+        except Exception as e:
+            await ctx.send(embed=failure(f"Backup failed: {e}"))
+            return
+        await ctx.send(embed=success(description, ctx.me))
+
+    @commands.command(hidden=True)
+    @commands.is_owner()
+    async def database_maintenance(self, ctx):
+        """Runs database maintenance pass right away, even if the bot is busy."""
+        try:
+            # This command itself is running so the bot is never quiet
+            description = await self.run_maintenance(stop_when_busy=False)
+        except Exception as e:
+            await ctx.send(embed=failure(f"Maintenance failed: {e}"))
+            return
+        await ctx.send(embed=success(description, ctx.me))
+
+
+def setup(bot):
+    bot.add_cog(Maintenance(bot))
@@ -0,0 +1,42 @@
+import logging
+import asyncio
+
+from discord.ext import commands
+
+from helpers import metrics
+
+
+logger = logging.getLogger(__name__)
+
+
+class Metrics(commands.Cog):
+    """
+    Serves Prometheus metrics on http://metrics_host:metrics_port/metrics
+    Disabled if metrics_port in config is 0.
+    """
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.runner = None
+        metrics.gateway_latency.function = lambda: self.bot.latency
+        metrics.event_loop_tasks.function = lambda: len(asyncio.all_tasks(self.bot.loop))
+        metrics.guilds.function = lambda: len(self.bot.guilds)
+        metrics.log_records_dropped.function = lambda: self.bot.log_queue_handler.dropped
+        if self.bot.config["metrics_port"]:
+            self.bot.loop.create_task(self.start_server())
+
+    async def start_server(self):
+        host, port = self.bot.config["metrics_host"], self.bot.config["metrics_port"]
+        try:
+            self.runner = await metrics.start_server(host, port)
+            logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+        except OSError as e:
+            logger.critical(f"Can't start metrics server on {host}:{port} {e}")
+
+    def cog_unload(self):
+        if self.runner is not None:
+            self.bot.loop.create_task(self.runner.cleanup())
+
+
+def setup(bot):
+    bot.add_cog(Metrics(bot))
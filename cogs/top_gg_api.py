@@ -1,10 +1,12 @@
 import logging
 
-import dbl
 from discord.ext import commands, tasks
 
+from helpers.misc import lazy_import
+
 
 logger = logging.getLogger(__name__)
+dbl = lazy_import("dbl")
 
 
 class TopGGApi(commands.Cog):
@@ -12,7 +14,8 @@ class TopGGApi(commands.Cog):
 
     def __init__(self, bot):
         self.bot = bot
-        self.dbl_client = dbl.DBLClient(self.bot, self.bot.config["top_gg_api_key"])
+        # Created once the bot is ready, creating it imports dbl
+        self.dbl_client = None
         self.update_stats_loop.start()
 
     @tasks.loop(hours=12.0)
@@ -28,6 +31,7 @@ class TopGGApi(commands.Cog):
     async def before_update_stats_loop(self):
         logger.info("Starting update stats loop loop..")
         await self.bot.wait_until_ready()
+        self.dbl_client = dbl.DBLClient(self.bot, self.bot.config["top_gg_api_key"])
         logger.info("Update stats loop started!")
 
 
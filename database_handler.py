@@ -1,31 +1,69 @@
+import time
+import asyncio
+import calendar
 import logging
+import functools
 import aiosqlite
 from pathlib import Path
-from datetime import datetime
-from typing import Tuple, List, Union
+from datetime import datetime, timedelta
+from typing import Tuple, List, Union, Iterable, Set, Dict, AsyncIterator
 
 from helpers import misc
+from helpers import metrics
+from helpers import tracing
 from helpers import licence_helper
+from helpers.query_stats import QueryStats
+from helpers.subscription_columns import SubscriptionColumns
 from helpers.errors import DefaultGuildRoleNotSet, DatabaseMissingData
 
 
 logger = logging.getLogger(__name__)
+# Statement types EXPLAIN QUERY PLAN works for, slow query log only explains these
+_EXPLAINABLE_STATEMENTS = ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH")
 
 
 class DatabaseHandler:
     DB_PATH = "databases/"
     DB_EXTENSION = ".sqlite3"
+    # Methods that modify the database, when clustered these are executed by the writer process only
+    WRITE_METHODS = (
+        "setup_new_guild", "setup_new_guilds", "change_guild_prefix", "change_default_guild_role",
+        "change_default_license_expiration", "add_new_licensed_member", "archive_licensed_members",
+        "prune_subscription_history", "generate_guild_licenses", "delete_license", "remove_all_stored_guild_licenses",
+        "remove_all_guild_data", "remove_all_guild_role_data"
+    )
+    # Write methods that change GUILDS rows, first argument is guild id (or ids for setup_new_guilds)
+    GUILD_WRITE_METHODS = (
+        "setup_new_guild", "setup_new_guilds", "change_guild_prefix", "change_default_guild_role",
+        "change_default_license_expiration", "remove_all_guild_data"
+    )
+
+    # Query plans of slow statements are logged at most once per this many seconds per statement
+    PLAN_LOG_INTERVAL = 600
+    AUTO_VACUUM_INCREMENTAL = 2
+    # Why a subscription ended, stored in SUBSCRIPTION_HISTORY_* REASON column
+    HISTORY_EXPIRED = 1
+    HISTORY_REVOKED = 2
+    HISTORY_ROLE_REMOVED = 3
+    HISTORY_TABLE_PREFIX = "SUBSCRIPTION_HISTORY_"
+    # SUBSCRIPTION_ROLLUPS column incremented for each HISTORY_* reason
+    ROLLUP_COLUMNS = {HISTORY_EXPIRED: "EXPIRED", HISTORY_REVOKED: "REVOKED", HISTORY_ROLE_REMOVED: "REMOVED"}
+    ROLLUP_BUCKET_SECONDS = 3600
+    FETCH_BATCH = 1000
 
     @classmethod
-    async def create_instance(cls, db_name: str = "main"):
+    async def create_instance(cls, db_name: str = "main", slow_query_threshold: float = None):
         """"
         Can't use await in __init__ so we create a factory pattern.
         To correctly create this object you need to call :
             await DatabaseHandler.create_instance()
 
+        :param slow_query_threshold: seconds, statements that take longer are logged together with their
+                                     query plan. None disables slow query log.
         """
         self = DatabaseHandler()
         self.db_name = db_name
+        self.slow_query_threshold = slow_query_threshold
         self.connection = await self._get_connection()
         logger.info("Connection to database established.")
         return self
@@ -33,6 +71,21 @@ class DatabaseHandler:
     def __init__(self):
         self.db_name = None
         self.connection = None
+        # guild id: (prefix, default license role id, default license duration hours)
+        # Read for every message (prefix) so rows are cached, write methods invalidate them
+        self.guild_cache: Dict[int, tuple] = {}
+        self.slow_query_threshold = None
+        self.query_stats = QueryStats()
+        # Optional in-memory copy of LICENSED_MEMBERS, see enable_subscription_columns
+        self.subscription_columns: Union[SubscriptionColumns, None] = None
+        # LICENSED_MEMBERS change counter value the subscription columns are in sync with
+        self._columns_change_counter = None
+        # Months (ints yyyymm) whose history partition is known to exist
+        self._history_partitions: Set[int] = set()
+        # Slow query log tasks that are still running, referenced so they are not garbage collected
+        self._slow_query_tasks: Set[asyncio.Future] = set()
+        # statement template: monotonic time its plan was last logged
+        self._plan_logged_at: Dict[str, float] = {}
 
     async def _get_connection(self) -> aiosqlite.core.Connection:
         """
@@ -42,11 +95,159 @@ class DatabaseHandler:
         path = DatabaseHandler._construct_path(self.db_name)
         if Path(path).is_file():
             conn = await aiosqlite.connect(path)
-            return conn
         else:
             logger.warning("Database not found! Creating fresh ...")
             misc.check_create_directory(DatabaseHandler.DB_PATH)
-            return await DatabaseHandler._create_database(path)
+            conn = await DatabaseHandler._create_database(path)
+        # WAL lets readers (other clusters) read while the writer is writing
+        await conn.execute("PRAGMA journal_mode=WAL")
+        await conn.executescript(DatabaseHandler._construct_change_counter_script())
+        await conn.executescript(DatabaseHandler._construct_rollup_table_script())
+        await DatabaseHandler._add_missing_rollup_columns(conn)
+        return conn
+
+    @staticmethod
+    def _construct_change_counter_script() -> str:
+        """
+        Change counter is incremented by triggers on every row change in any table, used to detect
+        if cached state saved outside of database is stale.
+        Members change counter is the same but only for LICENSED_MEMBERS, used by subscription columns.
+        Uses IF NOT EXISTS so it's added to existing databases too.
+        """
+        script = []
+        for counter in ("CHANGE_COUNTER", "MEMBERS_CHANGE_COUNTER"):
+            script.append(f"CREATE TABLE IF NOT EXISTS {counter} "
+                          f"(ID INTEGER PRIMARY KEY CHECK(ID = 0), VALUE INTEGER NOT NULL);")
+            script.append(f"INSERT OR IGNORE INTO {counter}(ID, VALUE) VALUES(0, 0);")
+        for table in ("GUILDS", "LICENSED_MEMBERS", "GUILD_LICENSES"):
+            for operation in ("INSERT", "UPDATE", "DELETE"):
+                script.append(
+                    f"CREATE TRIGGER IF NOT EXISTS {table}_{operation}_CHANGE_COUNTER AFTER {operation} ON {table} "
+                    f"BEGIN UPDATE CHANGE_COUNTER SET VALUE=VALUE+1; END;"
+                )
+        for operation in ("INSERT", "UPDATE", "DELETE"):
+            script.append(
+                f"CREATE TRIGGER IF NOT EXISTS LICENSED_MEMBERS_{operation}_MEMBERS_CHANGE_COUNTER AFTER {operation} "
+                f"ON LICENSED_MEMBERS BEGIN UPDATE MEMBERS_CHANGE_COUNTER SET VALUE=VALUE+1; END;"
+            )
+        return "\n".join(script)
+
+    @staticmethod
+    def _construct_rollup_table_script() -> str:
+        """
+        Hourly counters per guild and role, HOUR is epoch seconds of the start of the hour.
+        Uses IF NOT EXISTS so it's added to existing databases too.
+        """
+        return """CREATE TABLE IF NOT EXISTS SUBSCRIPTION_ROLLUPS (
+                      GUILD_ID INTEGER NOT NULL,
+                      HOUR INTEGER NOT NULL,
+                      ROLE_ID INTEGER NOT NULL,
+                      REDEEMED INTEGER NOT NULL DEFAULT 0,
+                      EXPIRED INTEGER NOT NULL DEFAULT 0,
+                      REVOKED INTEGER NOT NULL DEFAULT 0,
+                      GENERATED INTEGER NOT NULL DEFAULT 0,
+                      REMOVED INTEGER NOT NULL DEFAULT 0,
+                      PRIMARY KEY (GUILD_ID, HOUR, ROLE_ID)
+                  ) WITHOUT ROWID;"""
+
+    @staticmethod
+    async def _add_missing_rollup_columns(conn: aiosqlite.core.Connection):
+        """
+        Adds columns that were added to SUBSCRIPTION_ROLLUPS after the table was first created.
+        Every cluster process runs this at startup so another one may add the column first.
+        """
+        async with conn.execute("PRAGMA table_info(SUBSCRIPTION_ROLLUPS)") as cursor:
+            columns = {row[1] for row in await cursor.fetchall()}
+        if "REMOVED" not in columns:
+            try:
+                await conn.execute("ALTER TABLE SUBSCRIPTION_ROLLUPS ADD COLUMN REMOVED INTEGER NOT NULL DEFAULT 0")
+            except aiosqlite.OperationalError as e:
+                if "duplicate column name" not in str(e):
+                    raise
+            await conn.commit()
+
+    @staticmethod
+    def _to_epoch(date: Union[datetime, str]) -> int:
+        """
+        :param date: datetime or string as saved in EXPIRATION_DATE
+        :return: epoch in the same clock as _current_epoch
+        """
+        if isinstance(date, str):
+            date = datetime.fromisoformat(date)
+        return calendar.timegm(date.timetuple())
+
+    @staticmethod
+    def _current_epoch() -> int:
+        """
+        :return: current time in the same clock as EXPIRATION_DATE when converted by strftime('%s')
+                 (naive local time taken as UTC)
+        """
+        return calendar.timegm(licence_helper.get_current_time().timetuple())
+
+    async def checkpoint(self) -> Tuple[int, int, int]:
+        """
+        Copies all WAL content to the database file and truncates the WAL.
+        :return: tuple(1 if checkpoint was blocked by other connection else 0, WAL pages, checkpointed pages)
+        """
+        row = await self._fetch_one("PRAGMA wal_checkpoint(TRUNCATE)")
+        return tuple(row)
+
+    async def close(self):
+        await self._commit()
+        await self.connection.close()
+
+    # MAINTENANCE ########################################################################
+
+    async def enable_incremental_vacuum(self) -> bool:
+        """
+        Migrates database created without auto_vacuum to auto_vacuum=INCREMENTAL.
+        Changing the mode of an existing database requires VACUUM which rewrites the whole file, so this
+        blocks the connection for a while, call it at startup and only from the database writer.
+        :return: True if database was migrated, False if it already had incremental vacuum
+        """
+        row = await self._fetch_one("PRAGMA auto_vacuum")
+        if row[0] == DatabaseHandler.AUTO_VACUUM_INCREMENTAL:
+            return False
+        logger.warning("Migrating database to auto_vacuum=INCREMENTAL, this rewrites the database file ..")
+        await self._commit()
+        await self._execute(f"PRAGMA auto_vacuum={DatabaseHandler.AUTO_VACUUM_INCREMENTAL}")
+        await self._execute("VACUUM")
+        logger.info("Database migrated to auto_vacuum=INCREMENTAL.")
+        return True
+
+    async def get_page_stats(self) -> Tuple[int, int, int]:
+        """
+        :return: tuple(page size in bytes, total pages, free pages)
+        """
+        page_size = await self._fetch_one("PRAGMA page_size")
+        page_count = await self._fetch_one("PRAGMA page_count")
+        freelist_count = await self._fetch_one("PRAGMA freelist_count")
+        return page_size[0], page_count[0], freelist_count[0]
+
+    async def incremental_vacuum(self, pages: int):
+        """
+        Returns up to param pages free pages to the file system, needs auto_vacuum=INCREMENTAL.
+        Runs on it's own connection so it never commits a transaction some other coroutine has pending
+        on the shared one, it waits for that transaction to commit instead (busy timeout).
+        """
+        # Pragma frees one page per step and returns no columns, so execute would only run the first step.
+        # executescript runs it to completion.
+        script = f"PRAGMA incremental_vacuum({int(pages)});"
+        start = time.perf_counter()
+        conn = await aiosqlite.connect(self.path)
+        try:
+            await conn.executescript(script)
+        finally:
+            await conn.close()
+            self._record_query(script, start)
+
+    async def optimize(self):
+        """Runs ANALYZE on tables whose statistics are likely outdated, cheap when there is nothing to do."""
+        await self._execute("PRAGMA optimize")
+
+    @property
+    def path(self) -> str:
+        return DatabaseHandler._construct_path(self.db_name)
 
     @staticmethod
     def _construct_path(db_name: str) -> str:
@@ -59,6 +260,8 @@ class DatabaseHandler:
         :return: aiosqlite.core.Connection
         """
         conn = await aiosqlite.connect(path)
+        # Has to be set before any table is created, otherwise it needs a VACUUM to take effect
+        await conn.execute(f"PRAGMA auto_vacuum={DatabaseHandler.AUTO_VACUUM_INCREMENTAL}")
         await conn.execute("CREATE TABLE GUILDS "
                            "("
                            "GUILD_ID TEXT PRIMARY KEY, "
@@ -93,30 +296,207 @@ class DatabaseHandler:
         logger.info("Database successfully created!")
         return conn
 
+    def forward_writes(self, call_writer):
+        """
+        Replaces all WRITE_METHODS of this instance so they are executed by another process instead.
+        Used by clusters that are not the database writer, reads are still done trough own connection.
+        :param call_writer: coroutine function (method_name, *args, **kwargs) that executes method remotely
+        """
+        for method_name in self.WRITE_METHODS:
+            setattr(self, method_name, functools.partial(self._forward_write, call_writer, method_name))
+
+    async def _forward_write(self, call_writer, method_name: str, *args, **kwargs):
+        try:
+            return await call_writer(method_name, *args, **kwargs)
+        finally:
+            # Rows were changed by the writer so they have to be dropped from cache of this process
+            if method_name in self.GUILD_WRITE_METHODS:
+                guild_ids = args[0] if method_name == "setup_new_guilds" else (args[0],)
+                for guild_id in guild_ids:
+                    self.guild_cache.pop(guild_id, None)
+
+    # QUERY EXECUTION ####################################################################
+    # Every statement should go trough these methods so it gets timed.
+
+    async def _execute(self, query: str, *args) -> int:
+        """
+        Executes query without committing.
+        :return: number of rows changed by the query
+        """
+        start = time.perf_counter()
+        try:
+            cursor = await self.connection.execute(query, args)
+            return cursor.rowcount
+        finally:
+            self._record_query(query, start, args)
+
+    async def _execute_many(self, query: str, rows: Iterable[tuple]) -> int:
+        """
+        Executes query for each row in param rows without committing.
+        :return: number of rows changed by all executions together
+        """
+        start = time.perf_counter()
+        try:
+            cursor = await self.connection.executemany(query, rows)
+            return cursor.rowcount
+        finally:
+            # Parameters differ per row so there is no single plan to explain
+            self._record_query(query, start)
+
+    async def _fetch_one(self, query: str, *args) -> Union[tuple, None]:
+        start = time.perf_counter()
+        try:
+            async with self.connection.execute(query, args) as cursor:
+                return await cursor.fetchone()
+        finally:
+            self._record_query(query, start, args)
+
+    async def _fetch_all(self, query: str, *args) -> List[tuple]:
+        start = time.perf_counter()
+        try:
+            async with self.connection.execute(query, args) as cursor:
+                return await cursor.fetchall()
+        finally:
+            self._record_query(query, start, args)
+
+    async def _iterate(self, query: str, *args) -> AsyncIterator[tuple]:
+        """
+        Yields rows fetched in batches of FETCH_BATCH, for results too big to load at once.
+        Each batch fetch is timed separately so time spent by the caller between rows is not counted.
+        """
+        start = time.perf_counter()
+        async with self.connection.execute(query, args) as cursor:
+            while True:
+                try:
+                    rows = await cursor.fetchmany(self.FETCH_BATCH)
+                finally:
+                    self._record_query(query, start, args)
+                if not rows:
+                    return
+                for row in rows:
+                    yield row
+                start = time.perf_counter()
+
+    async def _commit(self):
+        start = time.perf_counter()
+        try:
+            await self.connection.commit()
+        finally:
+            self._record_query("COMMIT", start)
+
+    def _record_query(self, query: str, start: float, args: tuple = None):
+        """
+        :param args: query parameters, needed to explain the query if it was slow
+        """
+        duration = time.perf_counter() - start
+        template = _statement_template(query)
+        metrics.database_query_duration.observe(duration, template)
+        tracing.record_span(f"db {template}", start)
+        self.query_stats.record(template, duration)
+        if self.slow_query_threshold is not None and duration >= self.slow_query_threshold:
+            task = asyncio.ensure_future(self._log_slow_query(template, query, args, duration))
+            self._slow_query_tasks.add(task)
+            task.add_done_callback(self._slow_query_task_done)
+
+    def _slow_query_task_done(self, task: asyncio.Future):
+        self._slow_query_tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Can't log slow query: {task.exception()}")
+
+    async def _log_slow_query(self, template: str, query: str, args: Union[tuple, None], duration: float):
+        plan = ""
+        last_logged = self._plan_logged_at.get(template)
+        explainable = args is not None and template.split(" ", 1)[0].upper() in _EXPLAINABLE_STATEMENTS
+        if explainable and (last_logged is None or time.monotonic() - last_logged > self.PLAN_LOG_INTERVAL):
+            self._plan_logged_at[template] = time.monotonic()
+            try:
+                plan = await self.explain_query_plan(query, *args)
+            except Exception as e:
+                plan = f"Can't explain query plan: {e}"
+            # Plain inserts have no plan
+            plan = f"\n{plan}" if plan else ""
+        logger.warning(
+            f"Slow query {duration * 1000:.1f}ms: {template}{plan}",
+            extra={"duration": round(duration, 4), "statement": template}
+        )
+
+    async def explain_query_plan(self, query: str, *args) -> str:
+        """
+        Not timed so explaining a slow query doesn't count as another execution of it.
+        :return: EXPLAIN QUERY PLAN output indented as a tree, example:
+                 SEARCH LICENSED_MEMBERS USING INDEX ... (MEMBER_ID=?)
+        """
+        async with self.connection.execute(f"EXPLAIN QUERY PLAN {query}", args) as cursor:
+            rows = await cursor.fetchall()
+        depths = {0: -1}
+        lines = []
+        for node_id, parent_id, _unused, detail in rows:
+            depths[node_id] = depths.get(parent_id, -1) + 1
+            lines.append(f"{'  ' * depths[node_id]}{detail}")
+        return "\n".join(lines)
+
     async def update_database(self, query: str, *args):
-        await self.connection.execute(query, args)
-        await self.connection.commit()
+        await self._execute(query, *args)
+        await self._commit()
+
+    async def get_change_counter(self) -> int:
+        """
+        :return: int that is incremented on every row change in the database
+        """
+        row = await self._fetch_one("SELECT VALUE FROM CHANGE_COUNTER WHERE ID=0")
+        return row[0]
+
+    async def get_members_change_counter(self) -> int:
+        """
+        :return: int that is incremented on every row change in table LICENSED_MEMBERS
+        """
+        row = await self._fetch_one("SELECT VALUE FROM MEMBERS_CHANGE_COUNTER WHERE ID=0")
+        return row[0]
 
     # TABLE GUILDS #######################################################################
+    async def _get_guild_row(self, guild_id: int) -> Union[tuple, None]:
+        """
+        :return: cached tuple(prefix, default license role id, default license duration hours)
+                 or None if guild is not in database
+        """
+        row = self.guild_cache.get(guild_id)
+        if row is None:
+            query = """SELECT PREFIX, DEFAULT_LICENSE_ROLE_ID, DEFAULT_LICENSE_DURATION_HOURS
+                       FROM GUILDS WHERE GUILD_ID=?"""
+            row = await self._fetch_one(query, guild_id)
+            if row is not None:
+                self.guild_cache[guild_id] = row = tuple(row)
+        return row
+
     async def setup_new_guild(self, guild_id: int, default_prefix: str):
         insert_guild_query = "INSERT INTO GUILDS(GUILD_ID, PREFIX) VALUES(?,?)"
         await self.update_database(insert_guild_query, guild_id, default_prefix)
+        self.guild_cache.pop(guild_id, None)
+
+    async def setup_new_guilds(self, guild_ids: Iterable[int], default_prefix: str):
+        """
+        Registers all param guilds in one transaction, guilds that are already registered are skipped.
+        :param guild_ids: ids of guilds to register
+        :param default_prefix: prefix to set for all of them
+        """
+        query = "INSERT OR IGNORE INTO GUILDS(GUILD_ID, PREFIX) VALUES(?,?)"
+        await self._execute_many(query, ((guild_id, default_prefix) for guild_id in guild_ids))
+        await self._commit()
+        for guild_id in guild_ids:
+            self.guild_cache.pop(guild_id, None)
 
     async def get_guild_prefix(self, guild_id: int) -> str:
-        query = "SELECT PREFIX FROM GUILDS WHERE GUILD_ID=?"
-        async with self.connection.execute(query, (guild_id,)) as cursor:
-            row = await cursor.fetchone()
-            return row[0]
+        row = await self._get_guild_row(guild_id)
+        return row[0]
 
-    async def get_all_guild_ids(self):
+    async def get_all_guild_ids(self) -> Set[int]:
         """
-        :return: a tuple of all guild ids (ints)
+        :return: a set of all guild ids (ints)
 
         """
         query = "SELECT GUILD_ID FROM GUILDS"
-        async with self.connection.execute(query) as cursor:
-            results = await cursor.fetchall()
-            return tuple(int(guild_id[0]) for guild_id in results)
+        results = await self._fetch_all(query)
+        return {int(guild_id[0]) for guild_id in results}
 
     async def change_guild_prefix(self, guild_id: int, prefix: str):
         """
@@ -126,14 +506,17 @@ class DatabaseHandler:
         """
         query = "UPDATE GUILDS SET PREFIX=? WHERE GUILD_ID=?"
         await self.update_database(query, prefix, guild_id)
+        self.guild_cache.pop(guild_id, None)
 
     async def change_default_guild_role(self, guild_id: int, role_id: int):
         query = "UPDATE GUILDS SET DEFAULT_LICENSE_ROLE_ID=? WHERE GUILD_ID=?"
         await self.update_database(query, role_id, guild_id)
+        self.guild_cache.pop(guild_id, None)
 
     async def change_default_license_expiration(self, guild_id: int, expiration_hours: int):
         query = "UPDATE GUILDS SET DEFAULT_LICENSE_DURATION_HOURS=? WHERE GUILD_ID=?"
         await self.update_database(query, expiration_hours, guild_id)
+        self.guild_cache.pop(guild_id, None)
 
     async def get_default_guild_license_role_id(self, guild_id: int) -> int:
         """
@@ -143,17 +526,15 @@ class DatabaseHandler:
         :raise: DefaultGuildRoleNotSet if it's None
 
         """
-        query = "SELECT DEFAULT_LICENSE_ROLE_ID FROM GUILDS WHERE GUILD_ID=?"
-        async with self.connection.execute(query, (guild_id,)) as cursor:
-            row = await cursor.fetchone()
-            try:
-                return int(row[0])
-            except TypeError:
-                raise DefaultGuildRoleNotSet("Default guild license not set!\n\n"
-                                             "For more information call command:\n"
-                                             "{prefix}help default_role\n\n"
-                                             "If still in doubt call:\n"
-                                             "{prefix}help")
+        row = await self._get_guild_row(guild_id)
+        try:
+            return int(row[1])
+        except TypeError:
+            raise DefaultGuildRoleNotSet("Default guild license not set!\n\n"
+                                         "For more information call command:\n"
+                                         "{prefix}help default_role\n\n"
+                                         "If still in doubt call:\n"
+                                         "{prefix}help")
 
     async def get_default_guild_license_duration_hours(self, guild_id: int) -> int:
         """
@@ -161,52 +542,75 @@ class DatabaseHandler:
         :return: int representing hours of license duration
 
         """
-        query = "SELECT DEFAULT_LICENSE_DURATION_HOURS FROM GUILDS WHERE GUILD_ID=?"
-        async with self.connection.execute(query, (guild_id,)) as cursor:
-            row = await cursor.fetchone()
-            #
-            if not row:
-                # License duration has default value.
-                # So if this is None it means the guild is not found in database.
-                raise DatabaseMissingData(f"Guild {guild_id} not found in database!")
-            return int(row[0])
+        row = await self._get_guild_row(guild_id)
+        #
+        if not row:
+            # License duration has default value.
+            # So if this is None it means the guild is not found in database.
+            raise DatabaseMissingData(f"Guild {guild_id} not found in database!")
+        return int(row[2])
 
     async def get_guild_info(self, guild_id: int) -> Tuple[str, str, int]:
         """
         :param guild_id:
         :return: tuple(str prefix, str role_id, int expiration hours)
         """
-        query = "SELECT * FROM GUILDS WHERE GUILD_ID=?"
-        async with self.connection.execute(query, (guild_id,)) as cursor:
-            row = await cursor.fetchone()
-            # ('guild_id', 'prefix', 0, None, 'role_id', hours)
-            return row[1], row[4], row[5]
+        row = await self._get_guild_row(guild_id)
+        # ('prefix', 'role_id', hours)
+        return row[0], row[1], row[2]
 
     # TABLE LICENSED_MEMBERS #############################################################
 
     async def add_new_licensed_member(self, member_id: int, guild_id: int,
                                       expiration_date: datetime, licensed_role_id: int):
         query = "INSERT INTO LICENSED_MEMBERS(MEMBER_ID, GUILD_ID, EXPIRATION_DATE, LICENSED_ROLE_ID) VALUES(?,?,?,?)"
-        await self.update_database(query, member_id, guild_id, expiration_date, licensed_role_id)
-
-    async def delete_licensed_member(self, member_id: int, licensed_role_id: int):
+        changed = await self._execute(query, member_id, guild_id, expiration_date, licensed_role_id)
+        await self._execute(self._rollup_query("REDEEMED"), guild_id, licensed_role_id, self._current_hour(), 1)
+        await self._commit()
+        if self.subscription_columns is not None:
+            self.subscription_columns.add(member_id, guild_id, licensed_role_id, self._to_epoch(expiration_date))
+            self._columns_change_counter += changed
+
+    async def archive_licensed_members(self, members: List[Tuple[int, int]], reason: int):
         """
-        Called when member licensed role has expired
-        The member row is deleted from table LICENSED_MEMBERS.
+        Called when subscriptions expire, are revoked or their role was removed.
+        Rows are moved from LICENSED_MEMBERS to history partition of current month in one transaction.
         MEMBER_ID and LICENSED_ROLE_ID are unique so we only need that to differentiate
-
+        :param members: list of tuples (member id, licensed role id)
+        :param reason: one of HISTORY_* constants
         """
+        table = await self._get_history_partition(int(licence_helper.get_current_time().strftime("%Y%m")))
+        ended_at = self._current_epoch()
+        archive_query = f"""INSERT OR IGNORE INTO {table}(GUILD_ID, ENDED_AT, MEMBER_ID, ROLE_ID, EXPIRATION, REASON)
+                            SELECT CAST(GUILD_ID AS INTEGER), ?, CAST(MEMBER_ID AS INTEGER),
+                                   CAST(LICENSED_ROLE_ID AS INTEGER),
+                                   CAST(strftime('%s', EXPIRATION_DATE) AS INTEGER), ?
+                            FROM LICENSED_MEMBERS WHERE MEMBER_ID=? AND LICENSED_ROLE_ID=?"""
+        archive_rows = [(ended_at, reason, member_id, role_id) for member_id, role_id in members]
+        await self._execute_many(archive_query, archive_rows)
+        rollup_column = self.ROLLUP_COLUMNS[reason]
+        rollup_query = f"""INSERT INTO SUBSCRIPTION_ROLLUPS(GUILD_ID, ROLE_ID, HOUR, {rollup_column})
+                           SELECT CAST(GUILD_ID AS INTEGER), CAST(LICENSED_ROLE_ID AS INTEGER), ?, 1
+                           FROM LICENSED_MEMBERS WHERE MEMBER_ID=? AND LICENSED_ROLE_ID=?
+                           ON CONFLICT(GUILD_ID, HOUR, ROLE_ID) DO UPDATE
+                           SET {rollup_column}={rollup_column}+excluded.{rollup_column}"""
+        hour = self._current_hour()
+        await self._execute_many(rollup_query, [(hour, member_id, role_id) for member_id, role_id in members])
         delete_query = "DELETE FROM LICENSED_MEMBERS WHERE MEMBER_ID=? AND LICENSED_ROLE_ID=?"
-        await self.update_database(delete_query, member_id, licensed_role_id)
+        changed = await self._execute_many(delete_query, members)
+        await self._commit()
+        if self.subscription_columns is not None:
+            for member_id, role_id in members:
+                self.subscription_columns.remove(member_id, role_id)
+            self._columns_change_counter += changed
 
     async def get_member_license_expiration_date(self, member_id: int, licensed_role_id: int) -> str:
         query = "SELECT EXPIRATION_DATE FROM LICENSED_MEMBERS WHERE MEMBER_ID=? AND LICENSED_ROLE_ID=?"
-        async with self.connection.execute(query, (member_id, licensed_role_id)) as cursor:
-            row = await cursor.fetchone()
-            if row is not None:
-                return row[0]
-            else:
-                raise DatabaseMissingData(f"ID {member_id} doesn't exists in database table LICENSED_MEMBERS.")
+        row = await self._fetch_one(query, member_id, licensed_role_id)
+        if row is not None:
+            return row[0]
+        else:
+            raise DatabaseMissingData(f"ID {member_id} doesn't exists in database table LICENSED_MEMBERS.")
 
     async def get_member_data(self, guild_id: int, member_id: int) -> List[Tuple]:
         """
@@ -215,24 +619,220 @@ class DatabaseHandler:
         Note that returned LICENSED_ROLE_ID is string
         """
         query = "SELECT LICENSED_ROLE_ID, EXPIRATION_DATE FROM LICENSED_MEMBERS WHERE GUILD_ID=? AND MEMBER_ID=?"
-        async with self.connection.execute(query, (guild_id, member_id)) as cursor:
-            results = await cursor.fetchall()
-            if results is not None:
-                return results
-            else:
-                raise DatabaseMissingData(f"No active licenses for member {member_id} in guild {guild_id}.")
+        results = await self._fetch_all(query, guild_id, member_id)
+        if results is not None:
+            return results
+        else:
+            raise DatabaseMissingData(f"No active licenses for member {member_id} in guild {guild_id}.")
 
     async def get_guild_licensed_roles_total_count(self, guild_id: int) -> int:
+        columns = await self._get_subscription_columns()
+        if columns is not None:
+            return columns.guild_count(guild_id)
         query = "SELECT COUNT(*) FROM LICENSED_MEMBERS WHERE GUILD_ID=?"
-        async with self.connection.execute(query, (guild_id,)) as cursor:
-            result = await cursor.fetchone()
-            return result[0]
+        result = await self._fetch_one(query, guild_id)
+        return result[0]
 
     async def get_licensed_roles_total_count(self) -> int:
+        columns = await self._get_subscription_columns()
+        if columns is not None:
+            return len(columns)
         query = "SELECT COUNT(*) FROM LICENSED_MEMBERS"
-        async with self.connection.execute(query) as cursor:
-            result = await cursor.fetchone()
-            return result[0]
+        result = await self._fetch_one(query)
+        return result[0]
+
+    async def get_guild_licensed_member_ids(self, guild_id: int) -> Tuple[int, ...]:
+        """
+        :return: tuple of unique ids (ints) of members that have at least one active subscription in param guild
+        """
+        query = "SELECT DISTINCT MEMBER_ID FROM LICENSED_MEMBERS WHERE GUILD_ID=?"
+        results = await self._fetch_all(query, guild_id)
+        return tuple(int(row[0]) for row in results)
+
+    async def get_licensed_guild_ids(self) -> Tuple[int, ...]:
+        """
+        :return: tuple of ids (ints) of guilds that have active subscriptions or stored licenses
+        """
+        query = "SELECT GUILD_ID FROM LICENSED_MEMBERS UNION SELECT GUILD_ID FROM GUILD_LICENSES"
+        results = await self._fetch_all(query)
+        return tuple(int(row[0]) for row in results)
+
+    def iterate_licensed_members(self) -> AsyncIterator[tuple]:
+        """
+        Used by expiry pass, rows are fetched in batches so the whole table is never loaded at once.
+        :return: async iterator of rows (MEMBER_ID, GUILD_ID, EXPIRATION_DATE, LICENSED_ROLE_ID)
+        """
+        query = "SELECT MEMBER_ID, GUILD_ID, EXPIRATION_DATE, LICENSED_ROLE_ID FROM LICENSED_MEMBERS"
+        return self._iterate(query)
+
+    async def get_guild_role_subscription_counts(self, guild_id: int) -> Dict[int, int]:
+        """
+        :return: dict role id: number of active subscriptions, for roles of param guild
+        """
+        columns = await self._get_subscription_columns()
+        if columns is not None:
+            return columns.role_counts(guild_id)
+        query = "SELECT LICENSED_ROLE_ID, COUNT(*) FROM LICENSED_MEMBERS WHERE GUILD_ID=? GROUP BY LICENSED_ROLE_ID"
+        return {int(role_id): count for role_id, count in await self._fetch_all(query, guild_id)}
+
+    async def get_expiring_count(self, hours: int, guild_id: int = None) -> int:
+        """
+        :return: number of subscriptions that expire in next param hours, in param guild or all guilds if None
+        """
+        columns = await self._get_subscription_columns()
+        if columns is not None:
+            now = self._current_epoch()
+            return columns.expiring_count(now, now + hours * 3600, guild_id)
+        now = licence_helper.get_current_time()
+        query = "SELECT COUNT(*) FROM LICENSED_MEMBERS WHERE EXPIRATION_DATE>=? AND EXPIRATION_DATE<?"
+        args = [now, now + timedelta(hours=hours)]
+        if guild_id is not None:
+            query += " AND GUILD_ID=?"
+            args.append(guild_id)
+        result = await self._fetch_one(query, *args)
+        return result[0]
+
+    async def get_top_licensed_guilds(self, count: int) -> List[Tuple[int, int]]:
+        """
+        :return: list of tuples (guild id, number of active subscriptions) of guilds with most subscriptions
+        """
+        columns = await self._get_subscription_columns()
+        if columns is not None:
+            return columns.top_guilds(count)
+        query = "SELECT GUILD_ID, COUNT(*) FROM LICENSED_MEMBERS GROUP BY GUILD_ID ORDER BY 2 DESC LIMIT ?"
+        return [(int(guild_id), guild_count) for guild_id, guild_count in await self._fetch_all(query, count)]
+
+    # SUBSCRIPTION COLUMNS ###############################################################
+    # Aggregates over LICENSED_MEMBERS are answered from memory when enabled. Write methods that update
+    # the columns add the rows they changed to the expected members change counter, any other change to
+    # LICENSED_MEMBERS (other processes, queries outside these methods) leaves the counter ahead of the
+    # expected value and causes a full reload. Only enable it in the database writer so that is rare.
+
+    async def enable_subscription_columns(self):
+        """Loads LICENSED_MEMBERS to memory, from now on write methods keep the copy in sync."""
+        start = time.perf_counter()
+        await self._load_subscription_columns()
+        logger.info(f"Loaded {len(self.subscription_columns):,} subscriptions to memory in "
+                    f"{time.perf_counter() - start:.1f}s"
+                    f"{'' if self.subscription_columns.vectorized else ', NumPy not installed'}.")
+
+    async def _load_subscription_columns(self):
+        # Read before loading, a change in between only causes another reload
+        change_counter = await self.get_members_change_counter()
+        query = """SELECT CAST(MEMBER_ID AS INTEGER), CAST(GUILD_ID AS INTEGER), CAST(LICENSED_ROLE_ID AS INTEGER),
+                          CAST(strftime('%s', EXPIRATION_DATE) AS INTEGER)
+                   FROM LICENSED_MEMBERS"""
+        columns = SubscriptionColumns()
+        async for row in self._iterate(query):
+            columns.add(*row)
+        self.subscription_columns = columns
+        self._columns_change_counter = change_counter
+
+    async def _get_subscription_columns(self) -> Union[SubscriptionColumns, None]:
+        """
+        :return: SubscriptionColumns in sync with database or None if they are not enabled
+        """
+        if self.subscription_columns is None:
+            return None
+        if await self.get_members_change_counter() != self._columns_change_counter:
+            logger.info("Subscription columns are stale, reloading.")
+            await self._load_subscription_columns()
+        return self.subscription_columns
+
+    # TABLES SUBSCRIPTION_HISTORY_yyyymm ################################################
+    # Append only, one table per month of subscription end so old months can be dropped at once instead
+    # of deleting rows one by one. All columns are integers, times are epoch seconds.
+
+    async def _get_history_partition(self, month: int) -> str:
+        """
+        :param month: int yyyymm
+        :return: name of history table of param month, created if it doesn't exist
+        """
+        table = f"{self.HISTORY_TABLE_PREFIX}{month}"
+        if month not in self._history_partitions:
+            await self._execute(f"""CREATE TABLE IF NOT EXISTS {table} (
+                                    GUILD_ID INTEGER NOT NULL,
+                                    ENDED_AT INTEGER NOT NULL,
+                                    MEMBER_ID INTEGER NOT NULL,
+                                    ROLE_ID INTEGER NOT NULL,
+                                    EXPIRATION INTEGER,
+                                    REASON INTEGER NOT NULL,
+                                    PRIMARY KEY (GUILD_ID, ENDED_AT, MEMBER_ID, ROLE_ID)
+                                 ) WITHOUT ROWID""")
+            self._history_partitions.add(month)
+        return table
+
+    async def get_history_months(self) -> List[int]:
+        """
+        :return: sorted list of months (ints yyyymm) that have a history partition
+        """
+        query = "SELECT NAME FROM sqlite_master WHERE TYPE='table' AND NAME LIKE ?"
+        rows = await self._fetch_all(query, f"{self.HISTORY_TABLE_PREFIX}%")
+        return sorted(int(row[0][len(self.HISTORY_TABLE_PREFIX):]) for row in rows)
+
+    async def get_guild_history_counts(self, guild_id: int, months: int) -> List[Tuple[int, int, int]]:
+        """
+        :param months: how many most recent history partitions to count in
+        :return: list of tuples (month yyyymm, reason, count) of ended subscriptions in param guild
+        """
+        recent_months = (await self.get_history_months())[-months:]
+        if not recent_months:
+            return []
+        query = " UNION ALL ".join(
+            f"SELECT {month}, REASON, COUNT(*) FROM {self.HISTORY_TABLE_PREFIX}{month} WHERE GUILD_ID=? GROUP BY REASON"
+            for month in recent_months
+        )
+        return await self._fetch_all(query, *(guild_id for _ in recent_months))
+
+    async def prune_subscription_history(self, keep_months: int) -> List[int]:
+        """
+        Drops history partitions older than param keep_months, current month counts as one.
+        :return: list of dropped months (ints yyyymm)
+        """
+        now = licence_helper.get_current_time()
+        # Months counted from year 0 so subtraction works across years
+        oldest_kept = now.year * 12 + now.month - 1 - (keep_months - 1)
+        oldest_kept = (oldest_kept // 12) * 100 + oldest_kept % 12 + 1
+        dropped = [month for month in await self.get_history_months() if month < oldest_kept]
+        for month in dropped:
+            await self._execute(f"DROP TABLE IF EXISTS {self.HISTORY_TABLE_PREFIX}{month}")
+            self._history_partitions.discard(month)
+        await self._commit()
+        return dropped
+
+    # TABLE SUBSCRIPTION_ROLLUPS ########################################################
+    # Updated in the same transaction as the rows they count, so stats never need to scan raw rows.
+
+    def _current_hour(self) -> int:
+        return self._current_epoch() // self.ROLLUP_BUCKET_SECONDS * self.ROLLUP_BUCKET_SECONDS
+
+    @staticmethod
+    def _rollup_query(column: str) -> str:
+        """
+        :return: query with parameters (guild id, role id, hour, amount) that adds amount to param column
+        """
+        return f"""INSERT INTO SUBSCRIPTION_ROLLUPS(GUILD_ID, ROLE_ID, HOUR, {column}) VALUES(?,?,?,?)
+                   ON CONFLICT(GUILD_ID, HOUR, ROLE_ID) DO UPDATE SET {column}={column}+excluded.{column}"""
+
+    async def get_guild_rollups(self, guild_id: int, hours: int, bucket_hours: int = 1,
+                                role_id: int = None) -> List[Tuple[int, int, int, int, int, int]]:
+        """
+        :param hours: how many hours back to include, current hour counts as one
+        :param bucket_hours: hourly rollups are summed into buckets of this many hours
+        :param role_id: only count this role, None for all roles
+        :return: list of tuples (bucket start epoch, redeemed, expired, revoked, role removed, generated)
+                 sorted by time, buckets without any change are missing
+        """
+        bucket = bucket_hours * self.ROLLUP_BUCKET_SECONDS
+        since = self._current_hour() - (hours - 1) * self.ROLLUP_BUCKET_SECONDS
+        query = """SELECT HOUR / ? * ?, SUM(REDEEMED), SUM(EXPIRED), SUM(REVOKED), SUM(REMOVED),
+                          SUM(GENERATED)
+                   FROM SUBSCRIPTION_ROLLUPS WHERE GUILD_ID=? AND HOUR>=?"""
+        args = [bucket, bucket, guild_id, since]
+        if role_id is not None:
+            query += " AND ROLE_ID=?"
+            args.append(role_id)
+        return await self._fetch_all(f"{query} GROUP BY 1 ORDER BY 1", *args)
 
     # TABLE GUILD_LICENSES ###############################################################
 
@@ -244,13 +844,12 @@ class DatabaseHandler:
 
         """
         query = "SELECT GUILD_ID, LICENSED_ROLE_ID FROM GUILD_LICENSES WHERE LICENSE=?"
-        async with self.connection.execute(query, (license,)) as cursor:
-            row = await cursor.fetchone()
-            # TODO: Temporal quick fix. Refactor
-            if row is None:
-                return None
-            else:
-                return int(row[0]), int(row[1])
+        row = await self._fetch_one(query, license)
+        # TODO: Temporal quick fix. Refactor
+        if row is None:
+            return None
+        else:
+            return int(row[0]), int(row[1])
 
     async def get_license_duration_hours(self, license):
         """
@@ -258,9 +857,8 @@ class DatabaseHandler:
         :return: int representing license duration in hours
         """
         query = "SELECT LICENSE_DURATION_HOURS FROM GUILD_LICENSES WHERE LICENSE=?"
-        async with self.connection.execute(query, (license,)) as cursor:
-            row = await cursor.fetchone()
-            return int(row[0])
+        row = await self._fetch_one(query, license)
+        return int(row[0])
 
     async def generate_guild_licenses(self, number: int, guild_id: int,
                                       license_role_id: int, license_duration: int) -> list:
@@ -277,9 +875,10 @@ class DatabaseHandler:
         licenses = licence_helper.generate_multiple(number)
         query = """INSERT INTO GUILD_LICENSES(LICENSE, GUILD_ID, LICENSED_ROLE_ID, LICENSE_DURATION_HOURS)
                    VALUES(?,?,?,?)"""
-        for license in licenses:
-            await self.connection.execute(query, (license, guild_id, license_role_id, license_duration))
-        await self.connection.commit()
+        rows = ((license, guild_id, license_role_id, license_duration) for license in licenses)
+        await self._execute_many(query, rows)
+        await self._execute(self._rollup_query("GENERATED"), guild_id, license_role_id, self._current_hour(), number)
+        await self._commit()
         return licenses
 
     async def delete_license(self, license: str):
@@ -308,20 +907,17 @@ class DatabaseHandler:
         """
         query = """SELECT LICENSE, LICENSE_DURATION_HOURS FROM GUILD_LICENSES
                    WHERE GUILD_ID=? AND LICENSED_ROLE_ID=? LIMIT ?"""
-        async with self.connection.execute(query, (guild_id, license_role_id, number)) as cursor:
-            return await cursor.fetchall()
+        return await self._fetch_all(query, guild_id, license_role_id, number)
 
     async def get_guild_license_total_count(self, guild_id: int) -> int:
         query = "SELECT COUNT(*) FROM GUILD_LICENSES WHERE GUILD_ID=?"
-        async with self.connection.execute(query, (guild_id,)) as cursor:
-            result = await cursor.fetchone()
-            return result[0]
+        result = await self._fetch_one(query, guild_id)
+        return result[0]
 
     async def get_stored_license_total_count(self) -> int:
         query = "SELECT COUNT(*) FROM GUILD_LICENSES"
-        async with self.connection.execute(query) as cursor:
-            result = await cursor.fetchone()
-            return result[0]
+        result = await self._fetch_one(query)
+        return result[0]
 
     async def is_valid_license(self, license: str, guild_id: int) -> bool:
         """
@@ -333,17 +929,15 @@ class DatabaseHandler:
 
         """
         query = "SELECT LICENSE FROM GUILD_LICENSES WHERE LICENSE=? AND GUILD_ID=?"
-        async with self.connection.execute(query, (license, guild_id)) as cursor:
-            row = await cursor.fetchone()
-            if row is not None:
-                return True
+        row = await self._fetch_one(query, license, guild_id)
+        if row is not None:
+            return True
         return False
 
     async def get_random_licenses(self, guild_id: int, amount: int):
         query = """SELECT LICENSE, LICENSED_ROLE_ID, LICENSE_DURATION_HOURS FROM GUILD_LICENSES
                    WHERE GUILD_ID=? ORDER BY RANDOM() LIMIT ?"""
-        async with self.connection.execute(query, (guild_id, amount)) as cursor:
-            return await cursor.fetchall()
+        return await self._fetch_all(query, guild_id, amount)
 
     async def remove_all_stored_guild_licenses(self, guild_id: int):
         query = "DELETE FROM GUILD_LICENSES WHERE GUILD_ID=?"
@@ -352,19 +946,31 @@ class DatabaseHandler:
     # ALL TABLES #########################################################################
 
     async def remove_all_guild_data(self, guild_id: int, guild_table_too=False):
-        queries = ["DELETE FROM LICENSED_MEMBERS WHERE GUILD_ID=?",
-                   "DELETE FROM GUILD_LICENSES WHERE GUILD_ID=?"]
+        changed = await self._execute("DELETE FROM LICENSED_MEMBERS WHERE GUILD_ID=?", guild_id)
+        queries = ["DELETE FROM GUILD_LICENSES WHERE GUILD_ID=?"]
         if guild_table_too:
             queries.append("DELETE FROM GUILDS WHERE GUILD_ID=?")
+            queries.append("DELETE FROM SUBSCRIPTION_ROLLUPS WHERE GUILD_ID=?")
         for query in queries:
-            await self.connection.execute(query, (guild_id,))
+            await self._execute(query, guild_id)
 
-        await self.connection.commit()
+        await self._commit()
+        self.guild_cache.pop(guild_id, None)
+        if self.subscription_columns is not None:
+            self.subscription_columns.remove_where(guild_id=guild_id)
+            self._columns_change_counter += changed
 
     async def remove_all_guild_role_data(self, role_id: int):
-        queries = ["DELETE FROM LICENSED_MEMBERS WHERE LICENSED_ROLE_ID=?",
-                   "DELETE FROM GUILD_LICENSES WHERE LICENSED_ROLE_ID=?"]
-        for query in queries:
-            await self.connection.execute(query, (role_id,))
+        changed = await self._execute("DELETE FROM LICENSED_MEMBERS WHERE LICENSED_ROLE_ID=?", role_id)
+        await self._execute("DELETE FROM GUILD_LICENSES WHERE LICENSED_ROLE_ID=?", role_id)
+
+        await self._commit()
+        if self.subscription_columns is not None:
+            self.subscription_columns.remove_where(role_id=role_id)
+            self._columns_change_counter += changed
+
 
-        await self.connection.commit()
+@functools.lru_cache(maxsize=256)
+def _statement_template(query: str) -> str:
+    """Collapses whitespace so multi line queries make readable metric labels."""
+    return " ".join(query.split())
@@ -0,0 +1,85 @@
+import asyncio
+import logging
+from typing import Union
+
+from discord.ext import commands
+
+from helpers import metrics
+from helpers.errors import BotBusy
+from helpers.loop_monitor import LoopMonitor
+
+
+logger = logging.getLogger(__name__)
+
+
+class AdmissionController:
+    """
+    Decides if the bot has spare capacity for low priority commands.
+    Pressure is measured by event loop lag and by amount of pending work (tasks, open paginators).
+    Critical paths (redeem, expiry loop) are never checked so they keep their latency.
+    """
+
+    def __init__(self, loop_monitor: LoopMonitor, settings: dict):
+        """
+        :param loop_monitor: started LoopMonitor
+        :param settings: load_shedding dict from config
+        """
+        self.loop_monitor = loop_monitor
+        self.max_loop_lag = settings["max_loop_lag_seconds"]
+        self.max_event_loop_tasks = settings["max_event_loop_tasks"]
+        self.max_active_paginators = settings["max_active_paginators"]
+        self.defer_seconds = settings["defer_seconds"]
+
+    def pressure_reason(self) -> Union[str, None]:
+        """
+        :return: string describing why bot is under pressure or None if it's not
+        """
+        lag = self.loop_monitor.current_lag()
+        if lag > self.max_loop_lag:
+            return f"event loop lag {lag * 1000:.0f}ms"
+        tasks = len(asyncio.all_tasks(self.loop_monitor.loop))
+        if tasks > self.max_event_loop_tasks:
+            return f"{tasks} pending tasks"
+        paginators = metrics.active_paginators.get()
+        if paginators > self.max_active_paginators:
+            return f"{paginators} active paginators"
+        return None
+
+    async def admit(self) -> Union[str, None]:
+        """
+        Defers the caller for up to defer_seconds while the bot is under pressure.
+        :return: None if admitted, otherwise the pressure reason
+        """
+        reason = self.pressure_reason()
+        waited = 0.0
+        while reason is not None and waited < self.defer_seconds:
+            await asyncio.sleep(0.5)
+            waited += 0.5
+            reason = self.pressure_reason()
+        return reason
+
+
+async def _admit_command(*args):
+    """
+    Before invoke hook of low priority commands, called with (cog, ctx) for cog commands else (ctx).
+    :raise: BotBusy if the bot is still under pressure after deferring
+    """
+    ctx = args[-1]
+    reason = await ctx.bot.admission_controller.admit()
+    if reason is None:
+        return
+    metrics.commands_shed.inc(ctx.command.qualified_name)
+    # Hooks run after cooldown was applied, shed command shouldn't put the retry on cooldown
+    ctx.command.reset_cooldown(ctx)
+    logger.info(f"Shedding command {ctx.command} because of {reason}")
+    raise BotBusy("I'm busy right now, please retry shortly.")
+
+
+def low_priority():
+    """
+    Decorator for nice to have commands that can be deferred/rejected when the bot is under pressure.
+    Admission runs as a before invoke hook, not as a check, so help (which runs checks of every command
+    to filter them) is never deferred and doesn't count as shed.
+    :raise: BotBusy if the bot is still under pressure after deferring
+    """
+    return commands.before_invoke(_admit_command)
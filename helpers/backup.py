@@ -0,0 +1,114 @@
+"""
+Online backups of SQLite databases trough the SQLite backup API.
+
+The backup runs on it's own connection and copies pages_per_step pages at a time, sleeping between
+steps so the live connection can keep writing (with WAL readers never block the writer anyway).
+Backup connection holds one read transaction for the whole copy. Without it every write from the bot
+connection would restart the backup and under constant writes it would never finish, with it the
+backup is a consistent snapshot of the moment it started. WAL can't be checkpointed past that
+snapshot until the backup is done, so the WAL may grow a bit while backing up.
+
+Backups are written to a .part file first and renamed when complete, so a backup file that exists is
+always a complete database.
+"""
+import os
+import gzip
+import time
+import shutil
+import sqlite3
+import logging
+from pathlib import Path
+from typing import List, Tuple, Union
+
+
+logger = logging.getLogger(__name__)
+
+_PART_SUFFIX = ".part"
+
+
+def backup_file_name(db_name: str, compress: bool) -> str:
+    return f"{db_name}-{time.strftime('%Y%m%d-%H%M%S')}.sqlite3{'.gz' if compress else ''}"
+
+
+def run_backup(source_path: str, directory: str, db_name: str, pages_per_step: int, step_sleep: float,
+               compress: bool) -> Tuple[str, int, float, int]:
+    """
+    Blocking, call it from executor.
+    :param source_path: path of the live database
+    :param directory: where to save the backup, created if missing
+    :param db_name: used as prefix of backup file name
+    :param pages_per_step: pages copied per backup step
+    :param step_sleep: seconds to sleep between steps
+    :param compress: gzip the backup
+    :return: tuple(str path, int size in bytes, float duration in seconds, int steps)
+    """
+    start = time.monotonic()
+    Path(directory).mkdir(parents=True, exist_ok=True)
+    path = os.path.join(directory, backup_file_name(db_name, compress))
+    copy_path = os.path.join(directory, f"{db_name}.sqlite3{_PART_SUFFIX}")
+    steps = 0
+
+    def progress(_status, _remaining, _total):
+        nonlocal steps
+        steps += 1
+
+    # Autocommit mode so the read transaction is controlled explicitly
+    source = sqlite3.connect(f"file:{source_path}?mode=ro", uri=True, isolation_level=None)
+    destination = sqlite3.connect(copy_path)
+    try:
+        source.execute("BEGIN")
+        # Read transaction (snapshot) starts with the first read
+        source.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+        source.backup(destination, pages=pages_per_step, progress=progress, sleep=step_sleep)
+        source.execute("COMMIT")
+    finally:
+        destination.close()
+        source.close()
+
+    if compress:
+        compressed_path = path + _PART_SUFFIX
+        with open(copy_path, "rb") as copy_file, gzip.open(compressed_path, "wb", compresslevel=6) as gzip_file:
+            shutil.copyfileobj(copy_file, gzip_file, 1024 * 1024)
+        os.remove(copy_path)
+        os.replace(compressed_path, path)
+    else:
+        os.replace(copy_path, path)
+    return path, os.path.getsize(path), time.monotonic() - start, steps
+
+
+def list_backups(directory: str, db_name: str) -> List[Path]:
+    """
+    :return: list of complete backup paths of param db_name, newest first
+    """
+    backup_directory = Path(directory)
+    if not backup_directory.is_dir():
+        return []
+    backups = (path for path in backup_directory.glob(f"{db_name}-*.sqlite3*") if path.suffix != _PART_SUFFIX)
+    # Timestamp in the name sorts chronologically
+    return sorted(backups, reverse=True)
+
+
+def latest_backup_age(directory: str, db_name: str) -> Union[float, None]:
+    """
+    :return: seconds since newest backup was made or None if there are no backups
+    """
+    backups = list_backups(directory, db_name)
+    if not backups:
+        return None
+    return time.time() - backups[0].stat().st_mtime
+
+
+def prune(directory: str, db_name: str, keep: int) -> List[str]:
+    """
+    Deletes all but param keep newest backups and leftover .part files of interrupted backups.
+    Blocking, call it from executor.
+    :return: list of deleted file names
+    """
+    deleted = []
+    for path in list_backups(directory, db_name)[keep:]:
+        path.unlink()
+        deleted.append(path.name)
+    for path in Path(directory).glob(f"{db_name}*{_PART_SUFFIX}"):
+        path.unlink()
+        deleted.append(path.name)
+    return deleted
@@ -0,0 +1,216 @@
+import hmac
+import pickle
+import struct
+import asyncio
+import logging
+from typing import Callable, Dict, List, Union
+
+
+logger = logging.getLogger(__name__)
+
+_HEADER = struct.Struct("!I")
+_CONNECT_RETRIES = 30
+
+
+async def _send_raw(writer: asyncio.StreamWriter, data: bytes):
+    writer.write(_HEADER.pack(len(data)) + data)
+    await writer.drain()
+
+
+async def _receive_raw(reader: asyncio.StreamReader, max_length: int = None) -> bytes:
+    header = await reader.readexactly(_HEADER.size)
+    (length,) = _HEADER.unpack(header)
+    if max_length is not None and length > max_length:
+        raise ConnectionError(f"Message too long ({length} bytes).")
+    return await reader.readexactly(length)
+
+
+async def _send(writer: asyncio.StreamWriter, message):
+    await _send_raw(writer, pickle.dumps(message))
+
+
+async def _receive(reader: asyncio.StreamReader):
+    return pickle.loads(await _receive_raw(reader))
+
+
+class Cluster:
+    """
+    Coordinates bot processes started by cluster.py trough a local TCP channel.
+
+    Cluster 0 is the writer: it owns the SQLite writer connection and the expiry scheduler.
+    Other clusters read from the database directly but forward all database writes to the writer and
+    run their expiry pass when the writer broadcasts it.
+
+    When the bot is not clustered this is a single writer with no peers, so calling code doesn't have
+    to differentiate between the two.
+
+    Messages are length prefixed pickles. Only processes that know the token (generated by cluster.py)
+    are accepted and the server only listens on localhost.
+    """
+
+    def __init__(self, cluster_id: int = 0, ipc_port: int = None, ipc_token: str = None):
+        self.cluster_id = cluster_id
+        self.ipc_port = ipc_port
+        self.ipc_token = ipc_token
+        self.is_writer = cluster_id == 0
+        self.is_clustered = ipc_port is not None
+        self._database = None
+        self._server = None
+        self._peers: List[asyncio.StreamWriter] = []
+        self._reader = None
+        self._writer = None
+        self._connected = False
+        self._request_id = 0
+        self._pending: Dict[int, asyncio.Future] = {}
+        self._handling = 0
+        self._closing = False
+        self._listeners: Dict[str, Callable] = {}
+
+    async def connect(self, database):
+        """
+        Writer starts listening for other clusters, other clusters connect to the writer and
+        redirect param database writes trough it.
+        :param database: DatabaseHandler of this process
+        """
+        if not self.is_clustered:
+            return
+
+        self._database = database
+        if self.is_writer:
+            self._server = await asyncio.start_server(self._handle_peer, "127.0.0.1", self.ipc_port)
+            logger.info(f"Cluster {self.cluster_id} is database writer, listening on port {self.ipc_port}.")
+            return
+
+        for _ in range(_CONNECT_RETRIES):
+            try:
+                self._reader, self._writer = await asyncio.open_connection("127.0.0.1", self.ipc_port)
+                break
+            except OSError:
+                # Writer is probably still starting
+                await asyncio.sleep(1)
+        else:
+            raise ConnectionError(f"Cluster {self.cluster_id} can't connect to database writer.")
+
+        await _send_raw(self._writer, self.ipc_token.encode())
+        self._connected = True
+        asyncio.get_event_loop().create_task(self._read_from_writer())
+        database.forward_writes(self.call_writer)
+        logger.info(f"Cluster {self.cluster_id} connected to database writer.")
+
+    def add_listener(self, event: str, coroutine: Callable):
+        """
+        :param event: name of event broadcast by the writer
+        :param coroutine: coroutine function to call when the event is received
+        """
+        self._listeners[event] = coroutine
+
+    async def broadcast(self, event: str):
+        """Sends param event to all connected clusters, no-op if not clustered."""
+        for peer in list(self._peers):
+            try:
+                await _send(peer, {"event": event})
+            except ConnectionError:
+                self._peers.remove(peer)
+
+    async def call_writer(self, method: str, *args, **kwargs):
+        """
+        Calls DatabaseHandler method in the writer process and returns it's result.
+        Exceptions raised in the writer (example IntegrityError) are re-raised here.
+        :raise: ConnectionError if connection to writer is lost
+        """
+        if not self._connected:
+            raise ConnectionError("Not connected to database writer.")
+        self._request_id += 1
+        request_id = self._request_id
+        future = asyncio.get_event_loop().create_future()
+        self._pending[request_id] = future
+        await _send(self._writer, {"id": request_id, "method": method, "args": args, "kwargs": kwargs})
+        return await future
+
+    @property
+    def writes_in_flight(self) -> int:
+        """Writes sent to the writer and not yet answered plus, in the writer, requests from peers being executed."""
+        return len(self._pending) + self._handling
+
+    async def close(self):
+        """
+        Stops accepting connections and forwarded writes from other clusters and disconnects them.
+        Requests that are already being executed are not waited for, see writes_in_flight.
+        """
+        self._closing = True
+        if self._server is not None:
+            self._server.close()
+            for peer in self._peers:
+                peer.close()
+            await self._server.wait_closed()
+        if self._writer is not None:
+            self._writer.close()
+
+    async def _handle_peer(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        # Token is compared as raw bytes, nothing is unpickled before the peer is authenticated
+        try:
+            token = await _receive_raw(reader, max_length=256)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            writer.close()
+            return
+        if not hmac.compare_digest(token, self.ipc_token.encode()):
+            logger.critical("Rejected cluster connection with invalid token.")
+            writer.close()
+            return
+
+        self._peers.append(writer)
+        try:
+            while True:
+                request = await _receive(reader)
+                asyncio.get_event_loop().create_task(self._handle_request(writer, request))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            logger.warning("Cluster disconnected from database writer.")
+        finally:
+            if writer in self._peers:
+                self._peers.remove(writer)
+
+    async def _handle_request(self, writer: asyncio.StreamWriter, request: dict):
+        self._handling += 1
+        try:
+            try:
+                if self._closing:
+                    raise ConnectionError("Database writer is shutting down.")
+                if request["method"] not in self._database.WRITE_METHODS:
+                    raise AttributeError(f"{request['method']} is not a database write method.")
+                method = getattr(self._database, request["method"])
+                response = {"id": request["id"], "result": await method(*request["args"], **request["kwargs"])}
+            except Exception as e:
+                response = {"id": request["id"], "error": e}
+            try:
+                await _send(writer, response)
+            except ConnectionError:
+                pass
+        finally:
+            self._handling -= 1
+
+    async def _read_from_writer(self):
+        try:
+            while True:
+                message = await _receive(self._reader)
+                if "event" in message:
+                    self._dispatch(message["event"])
+                    continue
+                future = self._pending.pop(message["id"], None)
+                if future is None or future.done():
+                    continue
+                if "error" in message:
+                    future.set_exception(message["error"])
+                else:
+                    future.set_result(message["result"])
+        except (asyncio.IncompleteReadError, ConnectionError):
+            self._connected = False
+            logger.critical(f"Cluster {self.cluster_id} lost connection to database writer.")
+            for future in self._pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("Lost connection to database writer."))
+            self._pending.clear()
+
+    def _dispatch(self, event: str):
+        listener: Union[Callable, None] = self._listeners.get(event)
+        if listener is not None:
+            asyncio.get_event_loop().create_task(listener())
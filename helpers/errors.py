@@ -1,4 +1,5 @@
 from discord.errors import DiscordException
+from discord.ext.commands import CheckFailure
 
 
 class GuildNotFound(DiscordException):
@@ -19,3 +20,9 @@ class DefaultGuildRoleNotSet(DiscordException):
 class DatabaseMissingData(DiscordException):
     def __init__(self, message):
         self.message = message
+
+
+class BotBusy(CheckFailure):
+    def __init__(self, message):
+        super().__init__(message)
+        self.message = message
@@ -0,0 +1,148 @@
+import os
+import re
+import gzip
+import json
+import zlib
+import threading
+from collections import defaultdict
+from typing import List, Dict, Tuple
+
+# Discord IDs (snowflakes) are 17-20 digit integers
+_ID_PATTERN = re.compile(rb"(?<!\d)\d{17,20}(?!\d)")
+# Uncompressed size of each independently compressed gzip member
+_BLOCK_SIZE = 64 * 1024
+INDEX_SUFFIX = ".idx"
+
+
+def compress_with_index(source_path: str, destination_path: str):
+    """
+    Compresses param source_path into param destination_path as a series of independent gzip members
+    (so the result is still a valid .gz file) and writes sidecar index next to it.
+    Index maps each Discord ID found in the log to the blocks that contain it so search only has to
+    decompress blocks that actually match.
+    Source file is removed once both files are written.
+    Doesn't log anything since it's called from the log file handler itself.
+    :param source_path: path to plain text rotated log
+    :param destination_path: path of compressed log to create, index is saved to destination_path + INDEX_SUFFIX
+    """
+    blocks: List[Tuple[int, int]] = []
+    ids: Dict[str, List[int]] = defaultdict(list)
+    temp_path = destination_path + ".tmp"
+
+    with open(source_path, "rb") as source, open(temp_path, "wb") as destination:
+        def write_block(lines: list):
+            data = b"".join(lines)
+            compressed = gzip.compress(data)
+            block_number = len(blocks)
+            blocks.append((destination.tell(), len(compressed)))
+            destination.write(compressed)
+            for found_id in set(_ID_PATTERN.findall(data)):
+                ids[found_id.decode("ascii")].append(block_number)
+
+        block_lines, block_size = [], 0
+        for line in source:
+            block_lines.append(line)
+            block_size += len(line)
+            if block_size >= _BLOCK_SIZE:
+                write_block(block_lines)
+                block_lines, block_size = [], 0
+        if block_lines:
+            write_block(block_lines)
+
+    with open(temp_path + INDEX_SUFFIX, "w") as index_file:
+        json.dump({"blocks": blocks, "ids": ids}, index_file, separators=(",", ":"))
+
+    # Index first so a compressed file never exists without it
+    os.replace(temp_path + INDEX_SUFFIX, destination_path + INDEX_SUFFIX)
+    os.replace(temp_path, destination_path)
+    os.remove(source_path)
+
+
+def search_compressed(path: str, snowflake_id: str) -> List[str]:
+    """
+    Searches file created by compress_with_index.
+    Only blocks that contain param snowflake_id are read and decompressed.
+    If the index is missing the whole file is scanned.
+    :param path: path to compressed log
+    :param snowflake_id: Discord ID to search for
+    :return: list of matching lines in order they were logged
+    """
+    try:
+        with open(path + INDEX_SUFFIX) as index_file:
+            index = json.load(index_file)
+    except (FileNotFoundError, ValueError):
+        with gzip.open(path, "rb") as log_file:
+            return _matching_lines(log_file.read(), snowflake_id)
+
+    matches = []
+    with open(path, "rb") as log_file:
+        for block_number in index["ids"].get(snowflake_id, ()):
+            offset, length = index["blocks"][block_number]
+            log_file.seek(offset)
+            # wbits 16 + MAX_WBITS tells zlib to expect gzip header
+            data = zlib.decompress(log_file.read(length), 16 + zlib.MAX_WBITS)
+            matches.extend(_matching_lines(data, snowflake_id))
+    return matches
+
+
+def search_plain(path: str, snowflake_id: str) -> List[str]:
+    """Fallback for rotated logs that are not compressed (yet), scans the whole file."""
+    with open(path, "rb") as log_file:
+        return _matching_lines(log_file.read(), snowflake_id)
+
+
+def _matching_lines(data: bytes, snowflake_id: str) -> List[str]:
+    encoded_id = snowflake_id.encode("ascii")
+    return [
+        line.decode("utf-8", errors="backslashreplace")
+        for line in data.splitlines(keepends=True)
+        if encoded_id in _ID_PATTERN.findall(line)
+    ]
+
+
+class LiveLogIndex:
+    """
+    Index of Discord IDs to line offsets for the log file that is currently being written to.
+    Index is built lazily, each search only reads what was appended since the previous search.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._indexed_offset = 0
+        self._ids: Dict[str, List[int]] = defaultdict(list)
+
+    def reset(self):
+        """Has to be called when the file is rotated (rewritten from start)."""
+        with self._lock:
+            self._indexed_offset = 0
+            self._ids.clear()
+
+    def search(self, snowflake_id: str) -> List[str]:
+        """
+        :param snowflake_id: Discord ID to search for
+        :return: list of matching lines in order they were logged
+        """
+        with self._lock:
+            try:
+                with open(self.path, "rb") as log_file:
+                    self._catch_up(log_file)
+                    matches = []
+                    for offset in self._ids.get(snowflake_id, ()):
+                        log_file.seek(offset)
+                        matches.append(log_file.readline().decode("utf-8", errors="backslashreplace"))
+                    return matches
+            except FileNotFoundError:
+                return []
+
+    def _catch_up(self, log_file):
+        log_file.seek(self._indexed_offset)
+        offset = self._indexed_offset
+        for line in log_file:
+            if not line.endswith(b"\n"):
+                # Line is still being written, index it next time
+                break
+            for found_id in set(_ID_PATTERN.findall(line)):
+                self._ids[found_id.decode("ascii")].append(offset)
+            offset += len(line)
+        self._indexed_offset = offset
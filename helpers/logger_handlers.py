@@ -1,11 +1,215 @@
+import os
+import json
+import time
+import queue
 import logging
-from sys import stdout
-from logging.handlers import TimedRotatingFileHandler
+from sys import stdout, stderr
+from typing import Tuple, Dict, Iterable, Iterator, List
+from concurrent.futures import ThreadPoolExecutor
+from logging.handlers import TimedRotatingFileHandler, QueueHandler, QueueListener
 
-from helpers import misc
+from helpers import misc, log_index
 
 
 _log_directory = "logs/"
+_log_queue_size = 10_000
+_log_date_format = "%d-%m-%Y %H:%M:%S"
+# Anything else found on a record was passed trough extra={} and goes to json output as a separate key
+_standard_record_attributes = frozenset(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+
+class BoundedQueueHandler(QueueHandler):
+    """
+    Queue handler that never blocks the thread that is logging (in our case the event loop).
+    If the queue is full the record is dropped and counted instead of waiting for the listener thread.
+    """
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class DrainingQueueListener(QueueListener):
+    """
+    Queue listener that waits for room in a full queue when stopping.
+    Default implementation would raise queue.Full and leave the listener thread running.
+    """
+
+    def enqueue_sentinel(self):
+        # Listener thread is still consuming so there will be room, this can only block for a moment
+        self.queue.put(self._sentinel)
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats each record as one json object per line so logs can be parsed without regex.
+    Values passed with extra={} are added as separate keys, example:
+        logger.info("Expiry pass done", extra={"expired": 5, "guilds": 2})
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record, self.datefmt),
+            "level": record.levelname,
+            "logger": record.name,
+            "function": record.funcName,
+            "message": record.getMessage()
+        }
+        for key, value in vars(record).items():
+            if key not in _standard_record_attributes:
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class RateSamplingFilter(logging.Filter):
+    """
+    Lets trough at most param rate records per logger in each param per seconds window.
+    Records at or above param level are never sampled.
+    Number of suppressed records is appended to the first record that passes in the next window.
+    """
+
+    def __init__(self, rate: int, per: float = 1.0, level: int = logging.WARNING):
+        super().__init__()
+        self.rate = rate
+        self.per = per
+        self.level = level
+        # logger name: [window start, records passed in window, records suppressed]
+        self._windows: Dict[str, list] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= self.level:
+            return True
+
+        now = time.monotonic()
+        window = self._windows.get(record.name)
+        if window is None or now - window[0] >= self.per:
+            suppressed = 0 if window is None else window[2]
+            self._windows[record.name] = [now, 1, 0]
+            if suppressed:
+                record.msg = f"{record.msg} (suppressed {suppressed} records from this logger)"
+            return True
+
+        if window[1] < self.rate:
+            window[1] += 1
+            return True
+
+        window[2] += 1
+        return False
+
+
+class IndexedTimedRotatingFileHandler(TimedRotatingFileHandler):
+    """
+    TimedRotatingFileHandler that gzip compresses rotated files in a background thread and
+    keeps index of Discord IDs for all retained logs so they can be searched without reading everything.
+    See helpers.log_index for compression/index format.
+    """
+    _COMPRESSED_SUFFIX = ".gz"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.live_index = log_index.LiveLogIndex(self.baseFilename)
+        self._compressor = ThreadPoolExecutor(max_workers=1)
+        # Leftovers from before compression was added or from a shutdown in the middle of compressing
+        for _, path in self._iterate_rotated_files():
+            if path.endswith(self._COMPRESSED_SUFFIX):
+                continue
+            if os.path.exists(path + self._COMPRESSED_SUFFIX):
+                # Shutdown after the compressed file was written but before the plain one was removed
+                os.remove(path)
+            else:
+                self._compress_in_background(path)
+
+    def rotate(self, source: str, dest: str):
+        super().rotate(source, dest)
+        self.live_index.reset()
+        self._compress_in_background(dest)
+
+    def _compress_in_background(self, path: str):
+        self._compressor.submit(self._compress, path)
+
+    def _compress(self, path: str):
+        try:
+            log_index.compress_with_index(path, path + self._COMPRESSED_SUFFIX)
+        except Exception as e:
+            # Can't log from here, handler lock is held during close() while it waits for us
+            stderr.write(f"Failed to compress rotated log {path}: {e}\n")
+
+    def _iterate_rotated_files(self) -> Iterator[Tuple[str, str]]:
+        """
+        :return: iterator of tuples (date suffix, path) of rotated logs, both compressed and not, in no order.
+                 While a log is being compressed both of its files exist and have the same suffix.
+        """
+        directory, base_name = os.path.split(self.baseFilename)
+        prefix = base_name + "."
+        for file_name in os.listdir(directory):
+            if not file_name.startswith(prefix) or file_name.endswith((log_index.INDEX_SUFFIX, ".tmp")):
+                continue
+            suffix = file_name[len(prefix):]
+            if suffix.endswith(self._COMPRESSED_SUFFIX):
+                suffix = suffix[:-len(self._COMPRESSED_SUFFIX)]
+            if self.extMatch.match(suffix):
+                yield suffix, os.path.join(directory, file_name)
+
+    def _get_rotated_files(self) -> List[str]:
+        """
+        :return: sorted list (oldest first) of rotated log paths, one per rotated log.
+                 Compressed file is used when it exists, plain one is then just waiting to be removed.
+        """
+        rotated = {}
+        for suffix, path in self._iterate_rotated_files():
+            if suffix not in rotated or path.endswith(self._COMPRESSED_SUFFIX):
+                rotated[suffix] = path
+        return [rotated[suffix] for suffix in sorted(rotated)]
+
+    def getFilesToDelete(self) -> List[str]:
+        """
+        Overwritten because default implementation doesn't recognize compressed files.
+        Returns oldest rotated logs (and their indexes) that exceed backupCount.
+        """
+        rotated = self._get_rotated_files()
+        if len(rotated) <= self.backupCount:
+            return []
+        to_delete = []
+        for path in rotated[:len(rotated) - self.backupCount]:
+            to_delete.append(path)
+            if os.path.exists(path + log_index.INDEX_SUFFIX):
+                to_delete.append(path + log_index.INDEX_SUFFIX)
+        return to_delete
+
+    def search(self, snowflake_id: int, max_lines: int) -> List[str]:
+        """
+        Searches all retained logs for lines containing param snowflake_id.
+        Blocking, call it from executor.
+        :param snowflake_id: Discord ID (guild, member, role..) to search for
+        :param max_lines: maximum number of lines to return, newest matches are kept
+        :return: list of matching lines, oldest first
+        """
+        snowflake_id = str(snowflake_id)
+        matches = []
+        for path in self._get_rotated_files():
+            try:
+                if path.endswith(self._COMPRESSED_SUFFIX):
+                    matches.extend(log_index.search_compressed(path, snowflake_id))
+                else:
+                    matches.extend(log_index.search_plain(path, snowflake_id))
+            except FileNotFoundError:
+                # Got compressed or deleted in the meantime
+                continue
+        matches.extend(self.live_index.search(snowflake_id))
+        return matches[-max_lines:]
+
+    def close(self):
+        # Let the compression finish so we don't leave half written files
+        self._compressor.shutdown(wait=True)
+        super().close()
 
 
 def get_console_handler():
@@ -18,19 +222,65 @@ def get_console_handler():
     return console_handler
 
 
-def get_file_handler() -> TimedRotatingFileHandler:
+def get_file_handler(file_name: str = "log.txt") -> IndexedTimedRotatingFileHandler:
     """
     Returns file handler which outputs to file with log level of info
     File output is done in a way that logs are separated into 10 files where each file is valid for 1 day
     Oldest one gets rewritten by the newest one.
+    Rotated files are compressed and indexed, see IndexedTimedRotatingFileHandler.
     Log messages have a timestamp prefix
-    :return: TimedRotatingFileHandler
+    :param file_name: name of the log file inside logs directory
+    :return: IndexedTimedRotatingFileHandler
     """
     misc.check_create_directory(_log_directory)
-    log_file_full_path = _log_directory + "log.txt"
-    file_handler = TimedRotatingFileHandler(log_file_full_path, when="D", interval=7, backupCount=10, encoding="utf-8")
+    log_file_full_path = _log_directory + file_name
+    file_handler = IndexedTimedRotatingFileHandler(log_file_full_path, when="D", interval=7, backupCount=10, encoding="utf-8")
     file_handler.setFormatter(
-        logging.Formatter("%(asctime)s - %(levelname)s - %(message)s [%(name)s/%(funcName)s]", "%d-%m-%Y %H:%M:%S")
+        logging.Formatter("%(asctime)s - %(levelname)s - %(message)s [%(name)s/%(funcName)s]", _log_date_format)
     )
     file_handler.setLevel(logging.INFO)
     return file_handler
+
+
+def use_json_formatter(handlers: Iterable[logging.Handler]):
+    """
+    Switches all file handlers from param handlers to JsonFormatter.
+    Console output stays human readable.
+    :param handlers: handlers to check, example QueueListener.handlers
+    """
+    for handler in handlers:
+        if isinstance(handler, logging.FileHandler):
+            handler.setFormatter(JsonFormatter(datefmt=_log_date_format))
+
+
+def get_queue_logging(*handlers: logging.Handler,
+                      max_queue_size: int = _log_queue_size) -> Tuple[BoundedQueueHandler, DrainingQueueListener]:
+    """
+    Returns handler/listener pair that moves all handler I/O (file writes, rotation, stdout) to a background thread.
+    Attach the returned handler to a logger and call start() on the listener.
+    :param handlers: handlers that will be owned by the listener thread, example console and file handler
+    :param max_queue_size: maximum number of records waiting in queue, if exceeded new records are dropped
+    :return: tuple(BoundedQueueHandler, DrainingQueueListener)
+    """
+    log_queue = queue.Queue(maxsize=max_queue_size)
+    queue_handler = BoundedQueueHandler(log_queue)
+    queue_listener = DrainingQueueListener(log_queue, *handlers, respect_handler_level=True)
+    return queue_handler, queue_listener
+
+
+def stop_queue_logging(logger: logging.Logger, queue_handler: BoundedQueueHandler, queue_listener: QueueListener):
+    """
+    Flushes all queued records and stops the listener thread.
+    Listener handlers are then attached directly to param logger so anything logged
+    during interpreter shutdown still gets written.
+    :param logger: logger that param queue_handler is attached to
+    :param queue_handler: handler returned from get_queue_logging
+    :param queue_listener: listener returned from get_queue_logging
+    """
+    if queue_handler.dropped:
+        logger.warning(f"Dropped {queue_handler.dropped} log records because the log queue was full.")
+    queue_listener.stop()
+    logger.removeHandler(queue_handler)
+    for handler in queue_listener.handlers:
+        handler.flush()
+        logger.addHandler(handler)
@@ -0,0 +1,77 @@
+import sys
+import time
+import asyncio
+import logging
+import threading
+import traceback
+
+from helpers import metrics
+
+
+logger = logging.getLogger(__name__)
+
+
+class LoopMonitor:
+    """
+    Measures event loop scheduling lag by sleeping for a fixed interval and checking how late it woke up.
+
+    A watchdog thread checks that the monitor keeps ticking. If the loop is blocked for longer than
+    param threshold the watchdog logs the stack of the event loop thread, which points to the code
+    that is blocking it, and once the loop recovers logs for how long it was blocked.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, threshold: float, interval: float = 0.25):
+        """
+        :param loop: event loop to monitor
+        :param threshold: seconds of blocking after which stack is captured
+        :param interval: seconds between lag measurements
+        """
+        self.loop = loop
+        self.threshold = threshold
+        self.interval = interval
+        self.lag = 0.0
+        self._last_tick = time.monotonic()
+        self._loop_thread_id = None
+        self._stop_event = threading.Event()
+        self._task = None
+        self._watchdog = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+
+    def start(self):
+        self._task = self.loop.create_task(self._measure())
+        self._watchdog.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+
+    def current_lag(self) -> float:
+        """
+        :return: last measured lag or, if the loop is blocked right now, for how long it has been blocked.
+        """
+        return max(self.lag, time.monotonic() - self._last_tick - self.interval)
+
+    async def _measure(self):
+        self._loop_thread_id = threading.get_ident()
+        while True:
+            self._last_tick = time.monotonic()
+            await asyncio.sleep(self.interval)
+            self.lag = max(0.0, time.monotonic() - self._last_tick - self.interval)
+            metrics.event_loop_lag.observe(self.lag)
+
+    def _watch(self):
+        stalled_since = None
+        while not self._stop_event.wait(self.threshold / 2):
+            blocked_for = time.monotonic() - self._last_tick - self.interval
+            if blocked_for >= self.threshold and self._loop_thread_id is not None:
+                if stalled_since is None:
+                    stalled_since = self._last_tick
+                    metrics.event_loop_stalls.inc()
+                    frame = sys._current_frames().get(self._loop_thread_id)
+                    stack = "".join(traceback.format_stack(frame)) if frame is not None else "<no frame>"
+                    logger.warning(f"Event loop blocked for {blocked_for:.2f}s, loop thread stack:\n{stack}")
+            elif stalled_since is not None:
+                # Last tick happened after the stall so it's the moment loop got free again
+                total = self._last_tick - stalled_since - self.interval
+                logger.warning(f"Event loop was blocked for {total:.2f}s in total.")
+                stalled_since = None
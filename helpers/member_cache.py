@@ -0,0 +1,114 @@
+import asyncio
+import logging
+from typing import Iterable, Set, Union
+
+import discord
+
+
+logger = logging.getLogger(__name__)
+
+
+def construct_intents(settings: dict) -> discord.Intents:
+    """
+    :param settings: gateway_intents dict from config, keys are discord.Intents flag names
+    :return: discord.Intents with only the flags from param settings that are set to True enabled
+    """
+    intents = discord.Intents.none()
+    for flag_name, enabled in settings.items():
+        setattr(intents, flag_name, enabled)
+    return intents
+
+
+class MemberCachePolicy:
+    """
+    Keeps only members that the bot has to manage in the member cache.
+
+    Library member caching is disabled (MemberCacheFlags.none and no chunking on startup) so the cache
+    doesn't grow with total guild members. Instead members are requested from the gateway and cached
+    only for guilds that have active subscriptions or stored licenses:
+        - on ready all members with active subscriptions are requested, so role updates of licensed
+          members are received and expiry doesn't need a HTTP call per member
+        - any other member is requested lazily the first time it's needed (example license redeem)
+
+    Requesting members needs the privileged members intent, without it members are fetched trough HTTP
+    and never cached.
+    """
+    # Maximum user ids per gateway member request
+    QUERY_BATCH_SIZE = 100
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.licensed_guild_ids: Set[int] = set()
+        # Set when licensed guild ids were restored from warm restart snapshot, first ready skips refresh
+        self.restored = False
+
+    @staticmethod
+    def construct_cache_flags() -> discord.MemberCacheFlags:
+        return discord.MemberCacheFlags.none()
+
+    @property
+    def can_query(self) -> bool:
+        return self.bot.intents.members
+
+    def mark_licensed(self, guild_id: int):
+        """Call when guild gets stored licenses so it's members can be cached from now on."""
+        self.licensed_guild_ids.add(guild_id)
+
+    async def refresh(self):
+        self.licensed_guild_ids = set(await self.bot.main_db.get_licensed_guild_ids())
+
+    async def cache_licensed_members(self):
+        """
+        Requests all members with active subscriptions, for guilds of this process, that are not yet cached.
+        Called on ready, can be called again after reconnect since cached members are skipped.
+        """
+        if self.restored:
+            self.restored = False
+        else:
+            await self.refresh()
+        if not self.can_query:
+            return
+
+        cached_count = 0
+        for guild_id in self.licensed_guild_ids:
+            guild = self.bot.get_guild(guild_id)
+            if guild is None:
+                continue
+            member_ids = await self.bot.main_db.get_guild_licensed_member_ids(guild_id)
+            cached_count += len(await self.query_members(guild, member_ids))
+        logger.info(f"Cached {cached_count:,} licensed members from {len(self.licensed_guild_ids):,} guilds.")
+
+    async def query_members(self, guild: discord.Guild, member_ids: Iterable[int]) -> list:
+        """
+        Requests members that are not already cached from the gateway and caches them.
+        :param guild: guild to request members from
+        :param member_ids: ids of members to request
+        :return: list of newly cached members, members that left the guild are missing from it
+        """
+        missing_ids = [member_id for member_id in member_ids if guild.get_member(member_id) is None]
+        members = []
+        for i in range(0, len(missing_ids), self.QUERY_BATCH_SIZE):
+            batch = missing_ids[i:i + self.QUERY_BATCH_SIZE]
+            try:
+                members.extend(await guild.query_members(user_ids=batch, cache=True))
+            except asyncio.TimeoutError:
+                logger.warning(f"Timed out requesting {len(batch)} members of guild {guild.id}.")
+        return members
+
+    async def get_member(self, guild: discord.Guild, member_id: int) -> Union[discord.Member, None]:
+        """
+        Returns member from cache and if it's not cached requests it.
+        :return: discord.Member or None if member is not in param guild
+        """
+        member = guild.get_member(member_id)
+        if member is not None:
+            return member
+
+        if self.can_query and guild.id in self.licensed_guild_ids:
+            members = await self.query_members(guild, (member_id,))
+            return members[0] if members else None
+
+        try:
+            return await guild.fetch_member(member_id)
+        except (discord.Forbidden, discord.HTTPException):
+            return None
@@ -0,0 +1,80 @@
+import tracemalloc
+from collections import OrderedDict
+from typing import List
+
+
+class MemoryTracker:
+    """
+    Thin wrapper around tracemalloc that keeps named snapshots so memory growth between
+    two points in time can be attributed to file:line allocation sites.
+    """
+    MAX_SNAPSHOTS = 10
+    # Allocations done by tracemalloc/import machinery only add noise to the diff
+    _SNAPSHOT_FILTERS = (
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+        tracemalloc.Filter(False, "<unknown>")
+    )
+
+    def __init__(self):
+        self.snapshots = OrderedDict()
+
+    @staticmethod
+    def is_tracing() -> bool:
+        return tracemalloc.is_tracing()
+
+    @staticmethod
+    def start(frames: int = 1):
+        """
+        :param frames: number of frames stored per allocation, more frames = more memory/cpu overhead
+        """
+        tracemalloc.start(frames)
+
+    def stop(self):
+        """Stops tracing and drops all snapshots since they can't be compared to new ones anyway."""
+        tracemalloc.stop()
+        self.snapshots.clear()
+
+    def take_snapshot(self, name: str) -> tracemalloc.Snapshot:
+        """
+        Blocking, can take a while with large heap so call it from executor.
+        Oldest snapshot is dropped if there are more than MAX_SNAPSHOTS.
+        :param name: name under which the snapshot will be saved, overwrites existing one
+        :return: taken snapshot
+        """
+        snapshot = tracemalloc.take_snapshot().filter_traces(self._SNAPSHOT_FILTERS)
+        self.snapshots.pop(name, None)
+        self.snapshots[name] = snapshot
+        while len(self.snapshots) > self.MAX_SNAPSHOTS:
+            self.snapshots.popitem(last=False)
+        return snapshot
+
+    def diff(self, old_name: str, new_name: str, top: int) -> List[str]:
+        """
+        Blocking, call it from executor.
+        :param old_name: name of earlier snapshot
+        :param new_name: name of later snapshot
+        :param top: number of allocation sites to return
+        :return: list of strings, allocation sites that grew the most sorted by size difference
+        :raise: KeyError if any of the snapshots doesn't exist
+        """
+        return self.compare(self.snapshots[old_name], self.snapshots[new_name], top)
+
+    @staticmethod
+    def compare(old: tracemalloc.Snapshot, new: tracemalloc.Snapshot, top: int) -> List[str]:
+        statistics = new.compare_to(old, "lineno")
+        growers = [stat for stat in statistics if stat.size_diff > 0][:top]
+        return [
+            f"{stat.size_diff / 1024:+10.1f} KiB {stat.count_diff:+8} blocks  "
+            f"{stat.traceback[0].filename}:{stat.traceback[0].lineno}"
+            for stat in growers
+        ]
+
+    def snapshot_names(self) -> List[str]:
+        return list(self.snapshots)
+
+    @staticmethod
+    def traced_memory() -> str:
+        current, peak = tracemalloc.get_traced_memory()
+        return f"Traced memory: {current / 1024 ** 2:.2f} MB (peak {peak / 1024 ** 2:.2f} MB)"
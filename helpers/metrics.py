@@ -0,0 +1,215 @@
+"""
+Minimal metrics registry that renders Prometheus text exposition format.
+Metrics are module level so any part of the bot can record without holding a reference to the bot.
+
+All updates happen on the event loop thread so no locking is done.
+"""
+import math
+import bisect
+from typing import Callable, Dict, Tuple, List
+
+from aiohttp import web
+
+
+_DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(label_names: Tuple[str, ...], label_values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(label_names, label_values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    type_name = ""
+
+    def __init__(self, name: str, documentation: str, label_names: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        registry.append(self)
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+
+
+class Counter(_Metric):
+    type_name = "counter"
+
+    def __init__(self, name: str, documentation: str, label_names: Tuple[str, ...] = ()):
+        super().__init__(name, documentation, label_names)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, *label_values, amount: float = 1):
+        self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        for label_values, value in self._values.items():
+            lines.append(f"{self.name}{_format_labels(self.label_names, label_values)} {_format_value(value)}")
+        return lines
+
+
+class Gauge(_Metric):
+    """
+    Gauge can either be set manually or have a function that will be called on each scrape.
+    """
+    type_name = "gauge"
+
+    def __init__(self, name: str, documentation: str, label_names: Tuple[str, ...] = (),
+                 function: Callable[[], float] = None):
+        super().__init__(name, documentation, label_names)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self.function = function
+
+    def set(self, value: float, *label_values):
+        self._values[label_values] = value
+
+    def get(self, *label_values) -> float:
+        if self.function is not None and not label_values:
+            return self.function()
+        return self._values.get(label_values, 0)
+
+    def inc(self, *label_values, amount: float = 1):
+        self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def dec(self, *label_values, amount: float = 1):
+        self.inc(*label_values, amount=-amount)
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        if self.function is not None:
+            try:
+                lines.append(f"{self.name} {_format_value(self.function())}")
+            except Exception:
+                # Source of value not available (example bot not yet connected), skip it for this scrape
+                pass
+        for label_values, value in self._values.items():
+            lines.append(f"{self.name}{_format_labels(self.label_names, label_values)} {_format_value(value)}")
+        return lines
+
+
+class Histogram(_Metric):
+    type_name = "histogram"
+
+    def __init__(self, name: str, documentation: str, label_names: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = _DEFAULT_BUCKETS):
+        super().__init__(name, documentation, label_names)
+        self.buckets = buckets
+        # label values: [bucket counts..., +Inf count], sum
+        self._counts: Dict[Tuple[str, ...], List[int]] = {}
+        self._sums: Dict[Tuple[str, ...], float] = {}
+
+    def observe(self, value: float, *label_values):
+        counts = self._counts.get(label_values)
+        if counts is None:
+            counts = self._counts[label_values] = [0] * (len(self.buckets) + 1)
+            self._sums[label_values] = 0.0
+        # Counts are stored per bucket and made cumulative when rendering
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        self._sums[label_values] += value
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        for label_values, counts in self._counts.items():
+            cumulative = 0
+            for upper_bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                le = f'le="{_format_value(upper_bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.label_names, label_values, le)} {cumulative}")
+            labels = _format_labels(self.label_names, label_values)
+            lines.append(f"{self.name}_sum{labels} {_format_value(self._sums[label_values])}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+registry: List[_Metric] = []
+
+
+def render_registry() -> str:
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+command_duration = Histogram(
+    "licensy_command_duration_seconds", "Command invocation duration.", ("command", "status")
+)
+database_query_duration = Histogram(
+    "licensy_database_query_duration_seconds", "DatabaseHandler query duration per statement.", ("statement",)
+)
+expiry_pass_duration = Histogram(
+    "licensy_expiry_pass_duration_seconds", "Duration of one pass over all active subscriptions.",
+    buckets=(0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+)
+expiry_backlog = Gauge(
+    "licensy_expiry_backlog", "Expired subscriptions that could not be removed in the last expiry pass."
+)
+subscriptions_expired = Counter(
+    "licensy_subscriptions_expired_total", "Subscriptions removed because they expired."
+)
+active_paginators = Gauge(
+    "licensy_active_paginators", "Paginators currently waiting for reactions."
+)
+event_loop_lag = Histogram(
+    "licensy_event_loop_lag_seconds", "How late the event loop woke up a sleeping task.",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+)
+event_loop_stalls = Counter(
+    "licensy_event_loop_stalls_total", "Times the event loop was blocked for longer than the warning threshold."
+)
+startup_duration = Gauge(
+    "licensy_startup_duration_seconds", "Duration of each startup stage of the last start.", ("stage",)
+)
+commands_shed = Counter(
+    "licensy_commands_shed_total", "Low priority commands rejected because the bot was under pressure.", ("command",)
+)
+database_pages = Gauge(
+    "licensy_database_pages", "Pages in the database file at the last maintenance pass."
+)
+database_free_pages = Gauge(
+    "licensy_database_free_pages", "Unused pages in the database file at the last maintenance pass."
+)
+# Values of these are read on scrape, function is set by the metrics cog once bot is available
+gateway_latency = Gauge(
+    "licensy_gateway_latency_seconds", "Latency between a HEARTBEAT and a HEARTBEAT_ACK."
+)
+event_loop_tasks = Gauge(
+    "licensy_event_loop_tasks", "Tasks currently scheduled on the event loop."
+)
+guilds = Gauge(
+    "licensy_guilds", "Guilds the bot is in."
+)
+log_records_dropped = Gauge(
+    "licensy_log_records_dropped", "Log records dropped because the log queue was full."
+)
+
+
+async def start_server(host: str, port: int) -> web.AppRunner:
+    """
+    Starts HTTP server that serves all registered metrics on /metrics.
+    :param host: interface to bind to, keep it on localhost unless scraper is remote
+    :param port: port to bind to
+    :return: web.AppRunner, call cleanup() on it to stop the server
+    """
+    async def handle_metrics(_request):
+        return web.Response(text=render_registry(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
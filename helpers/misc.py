@@ -1,14 +1,39 @@
 import os
+import sys
 import logging
+import importlib.util
 from pathlib import Path
+from types import ModuleType
 
-import timeago as timesince
 from discord import Embed, Colour
 
 
 logger = logging.getLogger(__name__)
 
 
+def lazy_import(name: str) -> ModuleType:
+    """
+    Returns module that is actually imported on first attribute access.
+    Use for modules that are only needed by some commands/loops so they don't slow down startup.
+    :param name: absolute module name, example 'dateutil.parser'
+    :raise: ModuleNotFoundError right away if module is not installed
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ModuleNotFoundError(f"No module named '{name}'", name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+timesince = lazy_import("timeago")
+
+
 def construct_load_bar_string(percent, message=None, size=None):
     if size is None:
         size = 10
@@ -82,12 +107,12 @@ def maximize_size(message: str):
     return (message[:1980] + "...too long") if len(message) > 1980 else message
 
 
-def tail(n=1):
+def tail(n=1, path="logs/log.txt"):
     """
     Tail a file and get X lines from the end
     Source(modified to work): https://stackoverflow.com/a/57277212/11311072
     """
-    with open("logs/log.txt", "r", errors="backslashreplace") as f:
+    with open(path, "r", errors="backslashreplace") as f:
         assert n >= 0
         pos, lines = n + 1, []
 
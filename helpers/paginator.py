@@ -1,5 +1,8 @@
+import asyncio
 from asyncio import TimeoutError
 
+from helpers import metrics
+
 _MAX_MSG_SIZE = 2000
 _ARROW_TO_BEGINNING = "\u23ee"
 _ARROW_BACKWARD = "\u25c0"
@@ -17,6 +20,8 @@ class Paginator:
     It would be prettier to use embeds but as they really don't like codeblocks I was forced to make this.
 
     """
+    # Paginators waiting for reactions, so they can be closed on shutdown instead of waiting for timeout
+    active = set()
 
     @classmethod
     async def paginate(cls, bot, user, output, string, title="", separator="\n", prefix="```", suffix="```"):
@@ -38,8 +43,27 @@ class Paginator:
 
         """
         self = Paginator(user, output, string, title, separator, prefix, suffix)
-        await self.make_message()
-        await self.start_listener(bot, user, self.message)
+        metrics.active_paginators.inc()
+        cls.active.add(self)
+        try:
+            await self.make_message()
+            await self.start_listener(bot, user, self.message)
+        finally:
+            cls.active.discard(self)
+            metrics.active_paginators.dec()
+
+    @classmethod
+    def close_all(cls) -> int:
+        """
+        Makes all active paginators stop listening and clear their reactions as if they timed out.
+        :return: number of closed paginators
+        """
+        count = 0
+        for paginator in cls.active:
+            if not paginator.closed.done():
+                paginator.closed.set_result(None)
+                count += 1
+        return count
 
     def __init__(self, user, output, string, title, separator, prefix, suffix):
         self.user = user
@@ -51,6 +75,7 @@ class Paginator:
         self.chunks = Paginator.make_chunks(title, string, separator, self._max_msg_size)
         self.paginating = sum(map(len, self.chunks)) > self._max_msg_size
         self.message = None
+        self.closed = asyncio.get_event_loop().create_future()
 
     @staticmethod
     def make_chunks(title, string, separator, max_msg_size):
@@ -146,8 +171,16 @@ class Paginator:
             return str(reaction_) in _PAGINATION_EMOJIS and user_.id == user.id and reaction_.message.id == message.id
 
         while self.paginating:
+            reaction_future = asyncio.ensure_future(bot.wait_for("reaction_add", check=react_check, timeout=_TIMEOUT))
+            await asyncio.wait((reaction_future, self.closed), return_when=asyncio.FIRST_COMPLETED)
+            if self.closed.done():
+                reaction_future.cancel()
+                self.paginating = False
+                await self.clear_reactions()
+                break
+
             try:
-                reaction, user = await bot.wait_for("reaction_add", check=react_check, timeout=_TIMEOUT)
+                reaction, user = reaction_future.result()
             except TimeoutError:
                 self.paginating = False
                 await self.clear_reactions()
@@ -0,0 +1,141 @@
+import io
+import os
+import sys
+import pstats
+import cProfile
+import threading
+from collections import Counter
+from typing import Tuple, List
+
+from helpers import misc
+from helpers.licence_helper import get_current_time
+
+
+PROFILES_DIRECTORY = "profiles/"
+
+
+class SamplingProfiler:
+    """
+    Low overhead profiler that runs on it's own thread and periodically looks at the stack
+    of the target thread trough sys._current_frames.
+    Nothing is added to the target thread so it can be used on production event loop.
+
+    Results are collected as collapsed stacks (format used by flamegraph.pl, speedscope, inferno..):
+        outer_function (file:line);inner_function (file:line) sample_count
+    """
+
+    def __init__(self, thread_id: int, interval: float = 0.005):
+        """
+        :param thread_id: ident of the thread to sample, for event loop use threading.get_ident() from a coroutine
+        :param interval: seconds between samples
+        """
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.sample_count = 0
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(self._frame_name(frame))
+                frame = frame.f_back
+            stack.reverse()
+            self.stacks[";".join(stack)] += 1
+            self.sample_count += 1
+
+    @staticmethod
+    def _frame_name(frame) -> str:
+        code = frame.f_code
+        # Semicolons are collapsed stack separators
+        return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})".replace(";", ":")
+
+    def collapsed(self) -> str:
+        return "\n".join(f"{stack} {count}" for stack, count in self.stacks.most_common())
+
+    def summary(self, top: int) -> str:
+        """
+        :param top: number of functions to show in each table
+        :return: string table of functions with most samples, by self time and by total (inclusive) time.
+        """
+        if not self.sample_count:
+            return "No samples collected."
+
+        self_counts = Counter()
+        total_counts = Counter()
+        for stack, count in self.stacks.items():
+            frames = stack.split(";")
+            self_counts[frames[-1]] += count
+            # Recursive functions are counted once per sample
+            for frame_name in set(frames):
+                total_counts[frame_name] += count
+
+        lines = [f"Samples: {self.sample_count} every {self.interval * 1000:.1f}ms", "", f"Top {top} by self time:"]
+        for frame_name, count in self_counts.most_common(top):
+            lines.append(f"{count / self.sample_count * 100:6.2f}%  {frame_name}")
+        lines.extend(("", f"Top {top} by total time:"))
+        for frame_name, count in total_counts.most_common(top):
+            lines.append(f"{count / self.sample_count * 100:6.2f}%  {frame_name}")
+        return "\n".join(lines)
+
+
+def cprofile_summary(profiler: cProfile.Profile, top: int) -> str:
+    """
+    :param profiler: disabled cProfile.Profile
+    :param top: number of functions to show
+    :return: pstats output of top functions sorted by cumulative time
+    """
+    stream = io.StringIO()
+    stats = pstats.Stats(profiler, stream=stream)
+    stats.strip_dirs().sort_stats("cumulative").print_stats(top)
+    return stream.getvalue()
+
+
+def save_cprofile(profiler: cProfile.Profile, top: int) -> Tuple[str, List[str]]:
+    """
+    Saves raw profile data (readable by pstats, snakeviz, flameprof..) and text summary to PROFILES_DIRECTORY.
+    Blocking, call it from executor.
+    :param profiler: disabled cProfile.Profile
+    :param top: number of functions in summary
+    :return: tuple(str summary, list of saved file paths)
+    """
+    base_path = _construct_base_path("cprofile")
+    summary = cprofile_summary(profiler, top)
+    profiler.dump_stats(base_path + ".prof")
+    with open(base_path + ".txt", "w") as summary_file:
+        summary_file.write(summary)
+    return summary, [base_path + ".prof", base_path + ".txt"]
+
+
+def save_sampling_profile(profiler: SamplingProfiler, top: int) -> Tuple[str, List[str]]:
+    """
+    Saves collapsed stacks (flamegraph input) and text summary to PROFILES_DIRECTORY.
+    Blocking, call it from executor.
+    :param profiler: stopped SamplingProfiler
+    :param top: number of functions in summary
+    :return: tuple(str summary, list of saved file paths)
+    """
+    base_path = _construct_base_path("sample")
+    summary = profiler.summary(top)
+    with open(base_path + ".collapsed", "w") as collapsed_file:
+        collapsed_file.write(profiler.collapsed())
+    with open(base_path + ".txt", "w") as summary_file:
+        summary_file.write(summary)
+    return summary, [base_path + ".collapsed", base_path + ".txt"]
+
+
+def _construct_base_path(kind: str) -> str:
+    misc.check_create_directory(PROFILES_DIRECTORY)
+    return f"{PROFILES_DIRECTORY}{kind}-{get_current_time():%Y-%m-%d_%H-%M-%S}"
@@ -0,0 +1,65 @@
+"""
+Per statement timing statistics kept by DatabaseHandler.
+
+Totals and counts are exact since start, percentiles are computed from the last RECENT_SAMPLES
+durations of each statement so memory stays bounded and they reflect current behaviour.
+"""
+from collections import deque
+from typing import Dict, List, Tuple
+
+
+RECENT_SAMPLES = 1000
+
+
+class StatementStats:
+    __slots__ = ("count", "total", "max", "recent")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.recent = deque(maxlen=RECENT_SAMPLES)
+
+    def add(self, duration: float):
+        self.count += 1
+        self.total += duration
+        if duration > self.max:
+            self.max = duration
+        self.recent.append(duration)
+
+    @property
+    def p99(self) -> float:
+        durations = sorted(self.recent)
+        return durations[min(len(durations) - 1, int(len(durations) * 0.99))]
+
+
+class QueryStats:
+    SORT_KEYS = ("total", "p99", "max", "count")
+
+    def __init__(self):
+        self.statements: Dict[str, StatementStats] = {}
+
+    def record(self, statement: str, duration: float):
+        stats = self.statements.get(statement)
+        if stats is None:
+            stats = self.statements[statement] = StatementStats()
+        stats.add(duration)
+
+    def worst(self, count: int, sort_key: str = "total") -> List[Tuple[str, StatementStats]]:
+        """
+        :param count: max number of statements to return
+        :param sort_key: one of SORT_KEYS
+        :return: list of tuples (statement, StatementStats) sorted by param sort_key, descending
+        """
+        if sort_key not in self.SORT_KEYS:
+            raise ValueError(f"Sort key has to be one of {', '.join(self.SORT_KEYS)}")
+        return sorted(self.statements.items(), key=lambda item: getattr(item[1], sort_key), reverse=True)[:count]
+
+    def format_worst(self, count: int, sort_key: str = "total") -> str:
+        lines = []
+        for statement, stats in self.worst(count, sort_key):
+            lines.append(
+                f"total {stats.total:9.3f}s  calls {stats.count:>9,}  avg {stats.total / stats.count * 1000:8.2f}ms  "
+                f"p99 {stats.p99 * 1000:8.2f}ms  max {stats.max * 1000:8.2f}ms\n{statement}\n"
+            )
+        return "\n".join(lines)
@@ -0,0 +1,102 @@
+import time
+import asyncio
+import logging
+from typing import List
+
+from helpers.paginator import Paginator
+
+
+logger = logging.getLogger(__name__)
+
+
+class GracefulShutdown:
+    """
+    Shuts the bot down without cutting off work that is in progress:
+        1. stops accepting commands and starting new expiry passes, backups and maintenance passes
+        2. closes paginators so commands waiting on reactions return right away
+        3. waits, up to deadline, for in-flight commands, running expiry pass, backup, maintenance pass
+           and forwarded database writes
+        4. stops accepting forwarded database writes from other clusters
+        5. saves warm restart snapshot, closes traffic log, checkpoints the WAL and closes the database
+    Work that is still running at the deadline is abandoned and reported.
+    """
+    POLL_INTERVAL = 0.1
+
+    def __init__(self, bot, deadline: float):
+        """
+        :param bot: Bot
+        :param deadline: maximum seconds to wait for in-flight work
+        """
+        self.bot = bot
+        self.deadline = deadline
+
+    async def run(self, current_ctx=None) -> str:
+        """
+        Does everything except logging out, so the caller can still send the report.
+        :param current_ctx: context of the command that started the shutdown, it is not waited for
+        :return: string report of what was drained and what was abandoned
+        """
+        start = time.monotonic()
+        self.bot.shutting_down = True
+        licenses = self.bot.get_cog("LicenseHandler")
+        if licenses is not None:
+            # Lets the current iteration finish, only stops scheduling new ones
+            licenses.license_check.stop()
+        maintenance = self.bot.get_cog("Maintenance")
+        if maintenance is not None:
+            maintenance.backup_loop.stop()
+            maintenance.maintenance_loop.stop()
+        closed_paginators = Paginator.close_all()
+
+        initial_work = self._pending_work(current_ctx)
+        logger.info(f"Shutting down, draining {len(initial_work)} in-flight items: {initial_work}")
+        remaining_work = initial_work
+        while remaining_work and time.monotonic() - start < self.deadline:
+            await asyncio.sleep(self.POLL_INTERVAL)
+            remaining_work = self._pending_work(current_ctx)
+        # No await since the last poll, so no forwarded write can start between the drain and this
+        await self.bot.cluster.close()
+        drain_duration = time.monotonic() - start
+
+        if self.bot.config["warm_restart_snapshot"]:
+            try:
+                await self.bot.save_snapshot()
+            except Exception as e:
+                # Next start will just be cold
+                logger.error(f"Can't save warm restart snapshot: {e}")
+        self.bot.traffic_recorder.close()
+        busy, wal_pages, checkpointed_pages = await self.bot.main_db.checkpoint()
+        await self.bot.main_db.close()
+        logger.info("Database closed.")
+
+        drained = [work for work in initial_work if work not in remaining_work]
+        report = (
+            f"Drained in {drain_duration:.1f}s: {len(drained)} {drained or ''}\n"
+            f"Abandoned: {len(remaining_work)} {remaining_work or ''}\n"
+            f"Closed paginators: {closed_paginators}\n"
+            f"WAL checkpoint: {checkpointed_pages}/{wal_pages} pages{' (blocked)' if busy else ''}"
+        )
+        if remaining_work:
+            logger.warning(f"Shutdown deadline of {self.deadline}s reached.\n{report}")
+        else:
+            logger.info(f"Shutdown drained everything.\n{report}")
+        return report
+
+    def _pending_work(self, current_ctx) -> List[str]:
+        work = [
+            f"command {ctx.command.qualified_name} by {ctx.author.id}"
+            for ctx in self.bot.commands_in_flight if ctx is not current_ctx
+        ]
+        licenses = self.bot.get_cog("LicenseHandler")
+        if licenses is not None and licenses.expiry_pass_running:
+            work.append("expiry pass")
+        maintenance = self.bot.get_cog("Maintenance")
+        if maintenance is not None:
+            if maintenance.backup_running:
+                work.append("database backup")
+            if maintenance.maintenance_running:
+                work.append("database maintenance")
+        writes_in_flight = self.bot.cluster.writes_in_flight
+        if writes_in_flight:
+            work.append(f"{writes_in_flight} forwarded database writes")
+        return work
@@ -0,0 +1,57 @@
+import time
+import logging
+from contextlib import contextmanager
+from collections import OrderedDict
+
+from helpers import metrics
+
+
+logger = logging.getLogger(__name__)
+
+
+class StartupTimer:
+    """
+    Records how long each startup stage took so slow restarts can be attributed.
+    Stages are reported in the order they finished, stages can be nested so they don't have to add up
+    to the total which is measured from start.
+    """
+
+    def __init__(self, start: float = None):
+        """
+        :param start: time.perf_counter() value to measure from, defaults to now
+        """
+        self.start = time.perf_counter() if start is None else start
+        self.stages = OrderedDict()
+        self.reported = False
+        self._last_end = self.start
+
+    @contextmanager
+    def stage(self, name: str):
+        stage_start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - stage_start)
+
+    def record(self, name: str, duration: float):
+        self.stages[name] = duration
+        self._last_end = time.perf_counter()
+        metrics.startup_duration.set(duration, name)
+
+    def mark(self, name: str):
+        """Records param name as the time elapsed since the end of the previous stage (or since start)."""
+        self.record(name, time.perf_counter() - self._last_end)
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.start
+
+    def report(self):
+        """Logs all stages once, further calls (example on_ready after reconnect) are ignored."""
+        if self.reported:
+            return
+        self.reported = True
+        total = self.elapsed()
+        metrics.startup_duration.set(total, "total")
+        stages = ", ".join(f"{name} {duration:.2f}s" for name, duration in self.stages.items())
+        logger.info(f"Startup took {total:.2f}s ({stages})",
+                    extra={"startup": {name: round(duration, 3) for name, duration in self.stages.items()}})
@@ -0,0 +1,154 @@
+"""
+Columnar in-memory copy of LICENSED_MEMBERS for aggregate queries.
+
+Rows are kept in parallel int64 arrays (member id, guild id, role id, expiration epoch) so aggregates
+over all subscriptions don't go trough SQLite row by row. Removing a row moves the last row into its
+slot so arrays stay dense, row order is meaningless. Index of (member id, role id) to row position
+makes add and remove O(1), it's also what takes most of the memory.
+
+Aggregates use NumPy on zero copy views of the arrays when it's installed and plain loops otherwise.
+An array can't be resized while a view of it exists so views never leave the method that made them.
+"""
+from array import array
+from typing import Dict, List, Tuple, Iterable
+
+from helpers.misc import lazy_import
+
+try:
+    numpy = lazy_import("numpy")
+except ModuleNotFoundError:
+    numpy = None
+
+
+class SubscriptionColumns:
+    def __init__(self, rows: Iterable[Tuple[int, int, int, int]] = ()):
+        """
+        :param rows: tuples (member id, guild id, role id, expiration epoch)
+        """
+        self.member_ids = array("q")
+        self.guild_ids = array("q")
+        self.role_ids = array("q")
+        self.expirations = array("q")
+        # (member id, role id): row position, same uniqueness as LICENSED_MEMBERS
+        self._positions: Dict[Tuple[int, int], int] = {}
+        for row in rows:
+            self.add(*row)
+
+    def __len__(self) -> int:
+        return len(self.member_ids)
+
+    @property
+    def vectorized(self) -> bool:
+        return numpy is not None
+
+    def add(self, member_id: int, guild_id: int, role_id: int, expiration: int):
+        """Adds row or replaces the existing row of the same member and role."""
+        key = (member_id, role_id)
+        position = self._positions.get(key)
+        if position is None:
+            self._positions[key] = len(self.member_ids)
+            self.member_ids.append(member_id)
+            self.guild_ids.append(guild_id)
+            self.role_ids.append(role_id)
+            self.expirations.append(expiration)
+        else:
+            self.guild_ids[position] = guild_id
+            self.expirations[position] = expiration
+
+    def remove(self, member_id: int, role_id: int) -> bool:
+        """
+        :return: True if row was removed, False if there was no such row
+        """
+        position = self._positions.pop((member_id, role_id), None)
+        if position is None:
+            return False
+        last = len(self.member_ids) - 1
+        if position != last:
+            for column in (self.member_ids, self.guild_ids, self.role_ids, self.expirations):
+                column[position] = column[last]
+            self._positions[(self.member_ids[position], self.role_ids[position])] = position
+        for column in (self.member_ids, self.guild_ids, self.role_ids, self.expirations):
+            column.pop()
+        return True
+
+    def remove_where(self, guild_id: int = None, role_id: int = None) -> int:
+        """
+        Removes all rows of param guild_id and/or param role_id.
+        :return: number of removed rows
+        """
+        if numpy is not None:
+            keep = numpy.ones(len(self), dtype=bool)
+            if guild_id is not None:
+                keep &= numpy.frombuffer(self.guild_ids, dtype=numpy.int64) != guild_id
+            if role_id is not None:
+                keep &= numpy.frombuffer(self.role_ids, dtype=numpy.int64) != role_id
+            kept = [numpy.frombuffer(column, dtype=numpy.int64)[keep].tobytes() for column in self._columns()]
+            removed = len(self) - int(numpy.count_nonzero(keep))
+        else:
+            keep = [(guild_id is None or guild != guild_id) and (role_id is None or role != role_id)
+                    for guild, role in zip(self.guild_ids, self.role_ids)]
+            kept = [array("q", (value for value, keep_row in zip(column, keep) if keep_row))
+                    for column in self._columns()]
+            removed = len(self) - sum(keep)
+        if not removed:
+            return 0
+        self.member_ids, self.guild_ids, self.role_ids, self.expirations = (array("q", column) for column in kept)
+        self._positions = {key: position for position, key in enumerate(zip(self.member_ids, self.role_ids))}
+        return removed
+
+    def _columns(self) -> Tuple[array, array, array, array]:
+        return self.member_ids, self.guild_ids, self.role_ids, self.expirations
+
+    def guild_count(self, guild_id: int) -> int:
+        """
+        :return: number of subscriptions in param guild
+        """
+        if numpy is not None:
+            return int(numpy.count_nonzero(numpy.frombuffer(self.guild_ids, dtype=numpy.int64) == guild_id))
+        return self.guild_ids.count(guild_id)
+
+    def role_counts(self, guild_id: int) -> Dict[int, int]:
+        """
+        :return: dict role id: number of subscriptions, for roles of param guild
+        """
+        if numpy is not None:
+            roles = numpy.frombuffer(self.role_ids, dtype=numpy.int64)
+            roles = roles[numpy.frombuffer(self.guild_ids, dtype=numpy.int64) == guild_id]
+            role_ids, counts = numpy.unique(roles, return_counts=True)
+            return dict(zip(role_ids.tolist(), counts.tolist()))
+        counts = {}
+        for guild, role in zip(self.guild_ids, self.role_ids):
+            if guild == guild_id:
+                counts[role] = counts.get(role, 0) + 1
+        return counts
+
+    def top_guilds(self, count: int) -> List[Tuple[int, int]]:
+        """
+        :return: list of tuples (guild id, number of subscriptions) of guilds with most subscriptions
+        """
+        if numpy is not None:
+            guild_ids, counts = numpy.unique(numpy.frombuffer(self.guild_ids, dtype=numpy.int64), return_counts=True)
+            order = numpy.argsort(counts, kind="stable")[::-1][:count]
+            return list(zip(guild_ids[order].tolist(), counts[order].tolist()))
+        counts = {}
+        for guild in self.guild_ids:
+            counts[guild] = counts.get(guild, 0) + 1
+        return sorted(counts.items(), key=lambda item: item[1], reverse=True)[:count]
+
+    def expiring_count(self, start: int, end: int, guild_id: int = None) -> int:
+        """
+        :param start: epoch, inclusive
+        :param end: epoch, exclusive
+        :param guild_id: only count subscriptions of this guild, None for all guilds
+        :return: number of subscriptions that expire in the interval
+        """
+        if numpy is not None:
+            expirations = numpy.frombuffer(self.expirations, dtype=numpy.int64)
+            mask = (expirations >= start) & (expirations < end)
+            if guild_id is not None:
+                mask &= numpy.frombuffer(self.guild_ids, dtype=numpy.int64) == guild_id
+            return int(numpy.count_nonzero(mask))
+        if guild_id is None:
+            return sum(1 for expiration in self.expirations if start <= expiration < end)
+        return sum(1 for guild, expiration in zip(self.guild_ids, self.expirations)
+                   if guild == guild_id and start <= expiration < end)
@@ -0,0 +1,80 @@
+import os
+import time
+from collections import deque, namedtuple
+
+from helpers.misc import lazy_import
+
+
+psutil = lazy_import("psutil")
+
+
+SystemSnapshot = namedtuple(
+    "SystemSnapshot",
+    "time bot_ram_mb bot_ram_percent server_ram_used_mb server_ram_percent "
+    "bot_cpu_percent server_cpu_percent io_read_mb io_write_mb"
+)
+
+
+class SystemStatsSampler:
+    """
+    Collects process/server statistics so commands don't have to call psutil themselves.
+    sample() is blocking and should be called periodically from executor.
+
+    CPU usage is reported by psutil as average since the previous call, so with periodic sampling each
+    sample is an interval average and latest() averages it further over the whole history.
+
+    psutil is imported on first sample so it's off the startup path.
+    """
+
+    def __init__(self, history_size: int = 10):
+        self.process = None
+        self.cpu_count = None
+        self.history = deque(maxlen=history_size)
+
+    def _start(self):
+        self.process = psutil.Process(os.getpid())
+        self.cpu_count = psutil.cpu_count()
+        # First cpu_percent call always returns 0.0, this one sets the starting point
+        self.process.cpu_percent()
+        psutil.cpu_percent()
+
+    def sample(self) -> SystemSnapshot:
+        if self.process is None:
+            self._start()
+        # memory_info is cheap, unlike memory_full_info which parses /proc/<pid>/smaps
+        memory_info = self.process.memory_info()
+        virtual_memory = psutil.virtual_memory()
+        io_counters = self.process.io_counters()
+
+        bot_cpu_usage = self.process.cpu_percent()
+        if bot_cpu_usage > 100:
+            bot_cpu_usage = bot_cpu_usage / self.cpu_count
+
+        server_cpu_usage = psutil.cpu_percent()
+        if server_cpu_usage > 100:
+            server_cpu_usage = server_cpu_usage / self.cpu_count
+
+        snapshot = SystemSnapshot(
+            time=time.monotonic(),
+            bot_ram_mb=memory_info.rss / 1024 ** 2,
+            bot_ram_percent=memory_info.rss / virtual_memory.total * 100,
+            server_ram_used_mb=virtual_memory.used / 1024 ** 2,
+            server_ram_percent=virtual_memory.percent,
+            bot_cpu_percent=bot_cpu_usage,
+            server_cpu_percent=server_cpu_usage,
+            io_read_mb=io_counters.read_bytes / 1024 ** 2,
+            io_write_mb=io_counters.write_bytes / 1024 ** 2
+        )
+        self.history.append(snapshot)
+        return snapshot
+
+    def latest(self) -> SystemSnapshot:
+        """
+        :return: latest snapshot with CPU usage averaged over all snapshots in history
+        :raise: IndexError if nothing was sampled yet
+        """
+        latest = self.history[-1]
+        return latest._replace(
+            bot_cpu_percent=sum(snapshot.bot_cpu_percent for snapshot in self.history) / len(self.history),
+            server_cpu_percent=sum(snapshot.server_cpu_percent for snapshot in self.history) / len(self.history)
+        )
@@ -0,0 +1,185 @@
+"""
+Lightweight tracing of commands and the expiry pass.
+
+A trace is started for each processed message (and each expiry pass) and kept in a contextvar, so
+anything awaited from it can record a span without passing the trace around. Database queries,
+Discord HTTP requests and expiry stages record spans, other code can use:
+    with tracing.span("stage name"):
+        ...
+
+Finished traces go to a bounded ring buffer, oldest are dropped. Like metrics this is module level so
+any part of the bot can record without holding a reference to the bot.
+Spans are aggregated per stage for the breakdown, only the first MAX_TIMELINE_SPANS of each trace are
+kept individually for the exported timeline so an expiry pass with thousands of queries stays bounded.
+"""
+import json
+import time
+import itertools
+import functools
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+from typing import Deque, Dict, List, Tuple, Union
+
+from helpers import misc
+
+
+TRACES_DIRECTORY = "traces/"
+MAX_TIMELINE_SPANS = 200
+
+_current_trace = contextvars.ContextVar("current_trace", default=None)
+_trace_ids = itertools.count(1)
+recent_traces: Deque["Trace"] = deque(maxlen=1000)
+enabled = True
+
+
+class Trace:
+    __slots__ = ("trace_id", "name", "start", "wall_start", "duration", "stages", "spans", "_token")
+
+    def __init__(self):
+        self.trace_id = next(_trace_ids)
+        self.name = None
+        self.start = time.perf_counter()
+        self.wall_start = time.time()
+        self.duration = None
+        # stage -> [total seconds, count]
+        self.stages: Dict[str, list] = {}
+        # (stage, start offset, duration) in seconds
+        self.spans: List[Tuple[str, float, float]] = []
+        self._token = None
+
+    def add_span(self, stage: str, start: float, end: float):
+        """
+        :param start: perf_counter value when the stage started
+        :param end: perf_counter value when the stage ended
+        """
+        duration = end - start
+        totals = self.stages.get(stage)
+        if totals is None:
+            self.stages[stage] = [duration, 1]
+        else:
+            totals[0] += duration
+            totals[1] += 1
+        if len(self.spans) < MAX_TIMELINE_SPANS:
+            self.spans.append((stage, start - self.start, duration))
+
+    def breakdown(self) -> List[Tuple[str, float, int]]:
+        """
+        :return: list of tuples (stage, total seconds, count) sorted by total time, descending
+        """
+        return sorted(((stage, total, count) for stage, (total, count) in self.stages.items()),
+                      key=lambda stage: stage[1], reverse=True)
+
+
+def configure(buffer_size: int):
+    """
+    :param buffer_size: number of recent traces to keep, 0 disables tracing
+    """
+    global recent_traces, enabled
+    enabled = buffer_size > 0
+    recent_traces = deque(recent_traces, maxlen=max(buffer_size, 1))
+
+
+def start_trace() -> Union[Trace, None]:
+    """
+    Starts a trace in current context, finish it with finish_trace from the same task.
+    :return: Trace or None if tracing is disabled
+    """
+    if not enabled:
+        return None
+    trace = Trace()
+    trace._token = _current_trace.set(trace)
+    return trace
+
+
+def finish_trace(trace: Union[Trace, None], name: Union[str, None]):
+    """
+    :param trace: trace returned by start_trace
+    :param name: name to store the trace under, if None the trace is dropped (for example message
+                 that turned out not to be a command)
+    """
+    if trace is None:
+        return
+    _current_trace.reset(trace._token)
+    if name is None:
+        return
+    trace.name = name
+    trace.duration = time.perf_counter() - trace.start
+    recent_traces.append(trace)
+
+
+def record_span(stage: str, start: float):
+    """Records span from param start (perf_counter value) to now in the current trace, if any."""
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add_span(stage, start, time.perf_counter())
+
+
+@contextmanager
+def span(stage: str):
+    trace = _current_trace.get()
+    if trace is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add_span(stage, start, time.perf_counter())
+
+
+def traced_request(request):
+    """
+    Wraps discord HTTPClient.request so each Discord API call is recorded as a span.
+    :param request: bound HTTPClient.request (or a stand-in with the same signature)
+    """
+    @functools.wraps(request)
+    async def wrapper(route, **kwargs):
+        with span(f"http {route.method} {route.path}"):
+            return await request(route, **kwargs)
+    return wrapper
+
+
+def slowest(count: int, name: str = None) -> List[Trace]:
+    """
+    :param count: max number of traces to return
+    :param name: only return traces with this name
+    :return: list of slowest recent traces, slowest first
+    """
+    traces = [trace for trace in recent_traces if name is None or trace.name == name]
+    return sorted(traces, key=lambda trace: trace.duration, reverse=True)[:count]
+
+
+def format_trace(trace: Trace) -> str:
+    started = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(trace.wall_start))
+    lines = [f"{trace.name} {trace.duration * 1000:.1f}ms (trace {trace.trace_id} at {started})"]
+    for stage, total, count in trace.breakdown():
+        stage = stage if len(stage) <= 80 else stage[:77] + "..."
+        lines.append(f"{total * 1000:10.1f}ms  x{count:<4} {stage}")
+    return "\n".join(lines)
+
+
+def export(traces: List[Trace]) -> str:
+    """
+    Saves param traces in Chrome trace event format (chrome://tracing, Perfetto, speedscope).
+    Each trace is it's own track with spans drawn under it.
+    Blocking, call it from executor.
+    :return: str path of saved file
+    """
+    events = []
+    for trace in traces:
+        trace_start_us = trace.wall_start * 1_000_000
+        events.append({
+            "name": trace.name, "ph": "X", "pid": 1, "tid": trace.trace_id,
+            "ts": trace_start_us, "dur": trace.duration * 1_000_000
+        })
+        for stage, offset, duration in trace.spans:
+            events.append({
+                "name": stage, "ph": "X", "pid": 1, "tid": trace.trace_id,
+                "ts": trace_start_us + offset * 1_000_000, "dur": duration * 1_000_000
+            })
+    misc.check_create_directory(TRACES_DIRECTORY)
+    path = f"{TRACES_DIRECTORY}traces-{time.strftime('%Y%m%d-%H%M%S')}.json"
+    with open(path, "w") as trace_file:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, trace_file)
+    return path
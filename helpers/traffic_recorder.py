@@ -0,0 +1,170 @@
+"""
+Opt-in recorder of production traffic that benchmarks/replay.py feeds back trough the offline Discord stand-in.
+
+Log is JSONL, first line is a header, every other line is one event with short keys:
+    t    milliseconds since recording started
+    e    event type: "m" message, "r" member roles changed, "x" expiry pass started
+    g    anonymized guild id (null for DMs)
+    a    anonymized author id                                  (messages)
+    adm  1 if author has administrator permission              (messages)
+    men  1 if the bot was mentioned                            (messages)
+    c    qualified command name, null if message is not a command
+    x    anonymized command arguments                          (commands)
+    m    anonymized member id                                  (role changes)
+
+Ids and licenses are replaced with keyed hashes. The key is random per recording and never written
+anywhere, so the same id maps to the same value within one log (keeping the traffic shape) but logs
+can't be mapped back to real ids or joined with each other.
+Arguments are reduced to token types: "U:<hash>" user mention, "R:<hash>" role mention,
+"I:<hash>" raw id, "L:<hash>" license, short numbers/durations are kept as they are and anything
+else is "*".
+"""
+import re
+import json
+import time
+import logging
+import secrets
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+from helpers import misc
+
+
+logger = logging.getLogger(__name__)
+
+FORMAT_VERSION = 1
+_WRITE_BATCH = 500
+_user_mention = re.compile(r"<@!?(\d+)>")
+_role_mention = re.compile(r"<@&(\d+)>")
+_raw_id = re.compile(r"\d{15,20}")
+_license = re.compile(r"[a-zA-Z0-9]{30}")
+# Numbers and durations such as 10, 1w, 12hours
+_plain_argument = re.compile(r"\d{1,6}[a-z]{0,6}")
+
+
+class TrafficRecorder:
+    """
+    Does nothing until started, so calling code doesn't have to check if recording is enabled.
+    Lines are buffered and written in batches on a single worker thread which keeps them in order.
+    """
+
+    def __init__(self, max_file_mb: int):
+        """
+        :param max_file_mb: recording stops once the file reaches this size
+        """
+        self.max_file_bytes = max_file_mb * 1024 * 1024
+        self.path = None
+        self.recording = False
+        self.written_bytes = 0
+        self._key = secrets.token_bytes(16)
+        self._start = None
+        self._buffer: List[str] = []
+        self._file = None
+        self._executor = None
+
+    def start(self, directory: str, name: str):
+        """
+        :param directory: where to create the log, created if missing
+        :param name: log file name without extension, current time is appended to it
+        """
+        misc.check_create_directory(directory)
+        self.path = f"{directory}{name}-{time.strftime('%Y%m%d-%H%M%S')}.jsonl"
+        self._file = open(self.path, "w")
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="traffic-recorder")
+        self._start = time.monotonic()
+        self.recording = True
+        self._append({"version": FORMAT_VERSION, "started": time.strftime("%Y-%m-%dT%H:%M:%S")})
+        logger.info(f"Recording traffic to {self.path}")
+
+    def _anonymize(self, value) -> int:
+        digest = hashlib.blake2b(str(value).encode(), key=self._key, digest_size=6).digest()
+        return int.from_bytes(digest, "big")
+
+    def _anonymize_argument(self, argument: str) -> str:
+        for pattern, prefix in ((_user_mention, "U"), (_role_mention, "R")):
+            match = pattern.fullmatch(argument)
+            if match:
+                return f"{prefix}:{self._anonymize(match.group(1))}"
+        if _raw_id.fullmatch(argument):
+            return f"I:{self._anonymize(argument)}"
+        if _plain_argument.fullmatch(argument):
+            return argument
+        if _license.fullmatch(argument):
+            return f"L:{self._anonymize(argument)}"
+        return "*"
+
+    def _timestamp(self) -> int:
+        return int((time.monotonic() - self._start) * 1000)
+
+    def record_message(self, ctx):
+        """
+        :param ctx: context returned by get_context, command is None if message is not a command
+        """
+        if not self.recording:
+            return
+        message = ctx.message
+        event = {
+            "t": self._timestamp(),
+            "e": "m",
+            "g": None if message.guild is None else self._anonymize(message.guild.id),
+            "a": self._anonymize(message.author.id),
+            "adm": int(message.guild is not None and message.author.guild_permissions.administrator),
+            "men": int(any(user.id == ctx.bot.user.id for user in message.mentions)),
+            "c": None
+        }
+        if ctx.command is not None:
+            arguments = message.content[len(ctx.prefix) + len(ctx.invoked_with):].split()
+            event["c"] = ctx.command.qualified_name
+            event["x"] = [self._anonymize_argument(argument) for argument in arguments]
+        self._append(event)
+
+    def record_role_change(self, member):
+        if self.recording:
+            self._append({"t": self._timestamp(), "e": "r", "g": self._anonymize(member.guild.id),
+                          "m": self._anonymize(member.id)})
+
+    def record_expiry_pass(self):
+        if self.recording:
+            self._append({"t": self._timestamp(), "e": "x"})
+
+    def _append(self, event: dict):
+        line = json.dumps(event, separators=(",", ":")) + "\n"
+        self._buffer.append(line)
+        self.written_bytes += len(line)
+        if self.written_bytes >= self.max_file_bytes:
+            logger.warning(f"Traffic log reached {self.max_file_bytes // (1024 * 1024)}MB, recording stopped.")
+            self.close(wait=False)
+        elif len(self._buffer) >= _WRITE_BATCH:
+            self._flush()
+
+    def _flush(self):
+        if self._buffer:
+            self._executor.submit(self._file.writelines, self._buffer)
+            self._buffer = []
+
+    def close(self, wait: bool = True):
+        """
+        Writes buffered events and closes the log.
+        :param wait: block until the writer thread is done
+        """
+        if not self.recording:
+            return
+        self.recording = False
+        self._flush()
+        self._executor.submit(self._file.close)
+        self._executor.shutdown(wait=wait)
+        logger.info(f"Traffic recording saved to {self.path} ({self.written_bytes:,} bytes)")
+
+
+def read_events(path: str) -> List[dict]:
+    """
+    :param path: traffic log written by TrafficRecorder
+    :return: list of event dicts ordered by time, header excluded
+    :raise: ValueError if the log has unknown format version
+    """
+    with open(path) as log_file:
+        header = json.loads(log_file.readline())
+        if header.get("version") != FORMAT_VERSION:
+            raise ValueError(f"Unknown traffic log version {header.get('version')}")
+        return [json.loads(line) for line in log_file if line.strip()]
@@ -0,0 +1,81 @@
+"""
+Snapshot of in-process caches so a restarted bot doesn't start cold.
+
+File layout:
+    header (magic, marshal version, database change counter, crc32 of payload)
+    payload: zlib compressed marshal dump of the state dict
+
+marshal is used instead of pickle since loading it can't execute code and the state only
+consists of builtin types (dict, set, tuple, int, str, None).
+A snapshot is used only if checksum matches and the database change counter is the same as when
+the snapshot was taken, meaning nothing was written to the database in the meantime.
+"""
+import os
+import zlib
+import struct
+import marshal
+import logging
+from typing import Union
+
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"LWS1"
+_HEADER = struct.Struct("!4sBQI")
+
+
+def save(path: str, change_counter: int, state: dict) -> int:
+    """
+    Blocking, call it from executor.
+    File is written to temporary file first so a crash while writing can't leave a half written snapshot.
+    :param path: where to save the snapshot
+    :param change_counter: database change counter at the moment state was taken
+    :param state: dict of builtin types
+    :return: int size of written file in bytes
+    """
+    payload = zlib.compress(marshal.dumps(state))
+    header = _HEADER.pack(MAGIC, marshal.version, change_counter, zlib.crc32(payload))
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as snapshot_file:
+        snapshot_file.write(header)
+        snapshot_file.write(payload)
+    os.replace(temp_path, path)
+    return len(header) + len(payload)
+
+
+def load(path: str, change_counter: int) -> Union[dict, None]:
+    """
+    Blocking, call it from executor.
+    :param path: path of the snapshot
+    :param change_counter: current database change counter
+    :return: saved state dict or None if snapshot is missing, corrupt or stale (reason is logged)
+    """
+    try:
+        with open(path, "rb") as snapshot_file:
+            data = snapshot_file.read()
+    except FileNotFoundError:
+        logger.info("No warm restart snapshot found, starting cold.")
+        return None
+
+    if len(data) < _HEADER.size:
+        logger.warning("Warm restart snapshot is truncated, starting cold.")
+        return None
+
+    magic, marshal_version, saved_change_counter, checksum = _HEADER.unpack_from(data)
+    payload = data[_HEADER.size:]
+    if magic != MAGIC or marshal_version != marshal.version:
+        logger.warning("Warm restart snapshot has unknown format, starting cold.")
+        return None
+    if zlib.crc32(payload) != checksum:
+        logger.warning("Warm restart snapshot checksum mismatch, starting cold.")
+        return None
+    if saved_change_counter != change_counter:
+        logger.info(f"Warm restart snapshot is stale (database changed {saved_change_counter} -> {change_counter}), "
+                    f"starting cold.")
+        return None
+
+    try:
+        return marshal.loads(zlib.decompress(payload))
+    except (zlib.error, ValueError, EOFError, TypeError) as e:
+        logger.warning(f"Can't load warm restart snapshot, starting cold. {e}")
+        return None